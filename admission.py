@@ -0,0 +1,311 @@
+"""
+Admission control for outbound database calls.
+
+Every REST call to a database instance passes through that instance's
+``Gate``:
+
+- a per-user token bucket (``FIREBASE_USER_RATE`` calls per second, bursts of
+  ``FIREBASE_USER_BURST``) keyed by the user the request is served for, so one
+  user cannot monopolise the connection pool; background jobs are not limited;
+- a circuit breaker that opens after ``CIRCUIT_FAILURE_THRESHOLD`` consecutive
+  timeouts, connection errors or 5xx responses, fails calls immediately for
+  ``CIRCUIT_RESET_TIMEOUT`` seconds and then lets ``CIRCUIT_HALF_OPEN_PROBES``
+  calls through; the first probe to succeed closes it again;
+- a concurrency limit of ``FIREBASE_MAX_CONCURRENCY`` calls in flight, with at
+  most ``FIREBASE_MAX_QUEUE`` callers waiting up to ``FIREBASE_QUEUE_TIMEOUT``
+  seconds for a slot.
+
+Calls that are refused raise ``BackendUnavailable`` (``RateLimited`` for the
+token bucket) instead of waiting out the request timeout, so a slow backend
+costs a worker thread milliseconds rather than seconds. app.py turns both
+into 503/429 responses with ``Retry-After``.
+"""
+
+import os
+import time
+import asyncio
+import threading
+import contextvars
+from urllib.parse import urlsplit
+import metrics
+
+FIREBASE_MAX_CONCURRENCY = int(os.environ.get('FIREBASE_MAX_CONCURRENCY',
+                                              os.environ.get('FIREBASE_HTTP_POOL_SIZE', 10)))
+FIREBASE_MAX_QUEUE = int(os.environ.get('FIREBASE_MAX_QUEUE', 50))
+FIREBASE_QUEUE_TIMEOUT = float(os.environ.get('FIREBASE_QUEUE_TIMEOUT', 2))
+FIREBASE_USER_RATE = float(os.environ.get('FIREBASE_USER_RATE', 50))
+FIREBASE_USER_BURST = float(os.environ.get('FIREBASE_USER_BURST', 200))
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get('CIRCUIT_RESET_TIMEOUT', 10))
+CIRCUIT_HALF_OPEN_PROBES = int(os.environ.get('CIRCUIT_HALF_OPEN_PROBES', 1))
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+class BackendUnavailable(Exception):
+    """The database cannot serve this call right now; retry after ``retry_after`` seconds"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class RateLimited(BackendUnavailable):
+    """The user has used up their share of database calls for now"""
+
+# The user the current request is served for (set by app.py); None for background work
+_caller = contextvars.ContextVar('admission_caller', default=None)
+
+def set_caller(user_id):
+    return _caller.set(user_id)
+
+def reset_caller(token):
+    _caller.reset(token)
+
+class TokenBuckets:
+    """One token bucket per key, refilled at ``rate`` per second up to ``burst``"""
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = {}  # key -> [tokens, updated_at]
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """0 if a token was taken, else the seconds until one is available"""
+        if self.rate <= 0 or key is None:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    # Least recently used first; a full bucket is the same as a forgotten one
+                    del self._buckets[next(iter(self._buckets))]
+                bucket = [self.burst, now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self._buckets[key] = bucket
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / self.rate
+
+class CircuitBreaker:
+    def __init__(self, name, threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT,
+                 probes=CIRCUIT_HALF_OPEN_PROBES):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = 0
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            print(f"⚡ Circuit for {self.name}: {self.state} -> {state}")
+            self.state = state
+            metrics.CIRCUIT_STATE.set(STATE_VALUES[state], backend=self.name)
+
+    def before(self):
+        """Admit a call or raise BackendUnavailable; returns True if the call is a half-open probe"""
+        with self._lock:
+            if self.state == CLOSED:
+                return False
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if self.state == OPEN and remaining > 0:
+                raise BackendUnavailable(f"{self.name} is unavailable (circuit open)", retry_after=remaining)
+            if self._probing >= self.probes:
+                raise BackendUnavailable(f"{self.name} is unavailable (recovery probe in flight)",
+                                         retry_after=self.reset_timeout)
+            self._set_state(HALF_OPEN)
+            self._probing += 1
+            return True
+
+    def record(self, ok, probe=False):
+        with self._lock:
+            if probe:
+                self._probing -= 1
+            if ok:
+                self.failures = 0
+                self._set_state(CLOSED)
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+    def cancel_probe(self):
+        """A probe admitted by ``before`` was not sent after all"""
+        with self._lock:
+            self._probing -= 1
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._probing = 0
+
+class ConcurrencyLimiter:
+    """At most ``limit`` holders; up to ``max_queue`` callers wait up to ``timeout`` seconds"""
+
+    def __init__(self, name, limit=FIREBASE_MAX_CONCURRENCY, max_queue=FIREBASE_MAX_QUEUE,
+                 timeout=FIREBASE_QUEUE_TIMEOUT):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def _try_acquire(self, queue):
+        """True if a slot was taken; otherwise joins the queue (or raises when it is full)"""
+        with self._cond:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            if queue:
+                if self.waiting >= self.max_queue:
+                    raise BackendUnavailable(f"{self.name} is overloaded ({self.waiting} calls queued)",
+                                             retry_after=self.timeout)
+                self.waiting += 1
+            return False
+
+    def _timed_out(self):
+        with self._cond:
+            self.waiting -= 1
+        raise BackendUnavailable(f"{self.name} is overloaded (no free slot after {self.timeout:g}s)",
+                                 retry_after=self.timeout)
+
+    def acquire(self):
+        if self._try_acquire(queue=True):
+            return
+        with self._cond:
+            if self._cond.wait_for(lambda: self.active < self.limit, self.timeout):
+                self.waiting -= 1
+                self.active += 1
+                return
+        self._timed_out()
+
+    async def acquire_async(self):
+        if self._try_acquire(queue=True):
+            return
+        # Slots are shared with threads, so an event loop polls rather than blocking on the condition
+        deadline = time.monotonic() + self.timeout
+        delay = 0.002
+        while time.monotonic() < deadline:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.05)
+            if self._try_acquire(queue=False):
+                with self._cond:
+                    self.waiting -= 1
+                return
+        self._timed_out()
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def _after_fork(self):
+        self._cond = threading.Condition()
+        self.active = self.waiting = 0
+
+def _failed(response):
+    # 4xx answers mean the backend is up; only 5xx count against the breaker
+    return getattr(response, 'status_code', 200) >= 500
+
+class Gate:
+    """Rate limit, circuit breaker and concurrency limit for one database instance"""
+
+    def __init__(self, name):
+        self.name = name
+        self.breaker = CircuitBreaker(name)
+        self.limiter = ConcurrencyLimiter(name)
+
+    def _admit(self):
+        wait = user_buckets.take(_caller.get())
+        if wait:
+            metrics.ADMISSION_REJECTED.inc(backend=self.name, reason='rate_limited')
+            raise RateLimited("Too many requests, slow down", retry_after=wait)
+        try:
+            return self.breaker.before()
+        except BackendUnavailable:
+            metrics.ADMISSION_REJECTED.inc(backend=self.name, reason='circuit_open')
+            raise
+
+    def _rejected(self, probe):
+        if probe:
+            # The probe never ran; let the next caller probe instead
+            self.breaker.cancel_probe()
+        metrics.ADMISSION_REJECTED.inc(backend=self.name, reason='overloaded')
+
+    def call(self, send):
+        """``send()`` (an HTTP request) if admitted; its response, or its exception re-raised"""
+        probe = self._admit()
+        try:
+            self.limiter.acquire()
+        except BackendUnavailable:
+            self._rejected(probe)
+            raise
+        metrics.DB_IN_FLIGHT.inc(backend=self.name)
+        try:
+            response = send()
+        except Exception:
+            self.breaker.record(False, probe)
+            raise
+        finally:
+            metrics.DB_IN_FLIGHT.dec(backend=self.name)
+            self.limiter.release()
+        self.breaker.record(not _failed(response), probe)
+        return response
+
+    async def call_async(self, send):
+        """Async ``call``; ``send`` returns an awaitable"""
+        probe = self._admit()
+        try:
+            await self.limiter.acquire_async()
+        except BackendUnavailable:
+            self._rejected(probe)
+            raise
+        metrics.DB_IN_FLIGHT.inc(backend=self.name)
+        try:
+            response = await send()
+        except asyncio.CancelledError:
+            # A hedged read whose twin answered first (see retries.py); says nothing about the backend
+            if probe:
+                self.breaker.cancel_probe()
+            raise
+        except Exception:
+            self.breaker.record(False, probe)
+            raise
+        finally:
+            metrics.DB_IN_FLIGHT.dec(backend=self.name)
+            self.limiter.release()
+        self.breaker.record(not _failed(response), probe)
+        return response
+
+user_buckets = TokenBuckets(FIREBASE_USER_RATE, FIREBASE_USER_BURST)
+_gates = {}
+_gates_lock = threading.Lock()
+
+def gate(base_url):
+    """The Gate of the database at ``base_url`` (one per host, shared by its references)"""
+    name = urlsplit(base_url).netloc or base_url
+    found = _gates.get(name)
+    if found is None:
+        with _gates_lock:
+            found = _gates.setdefault(name, Gate(name))
+    return found
+
+def _after_fork():
+    global _gates_lock
+    _gates_lock = threading.Lock()
+    user_buckets._lock = threading.Lock()
+    for found in _gates.values():
+        found.breaker._after_fork()
+        found.limiter._after_fork()
+
+os.register_at_fork(after_in_child=_after_fork)
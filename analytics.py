@@ -0,0 +1,126 @@
+from datetime import datetime
+from collections import defaultdict
+from profiling import traced
+
+MONTH_LABELS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+def parse_expense_date(date_string):
+    """Parse a stored ISO date, accepting a trailing 'Z'"""
+    return datetime.fromisoformat(date_string.replace('Z', '+00:00'))
+
+def calculate_monthly_expenses(expenses, month, year):
+    total = 0
+    for expense in expenses:
+        expense_date = parse_expense_date(expense.date)
+        if expense_date.month == month and expense_date.year == year:
+            total += expense.amount
+    return total
+
+def calculate_total_expenses(expenses):
+    return sum(expense.amount for expense in expenses)
+
+@traced('analytics.dashboard_summary')
+def dashboard_summary(expenses, monthly_income, now=None, archived=None):
+    """Totals shown on the dashboard cards; ``archived`` is a combined archive summary (see archive.py)"""
+    now = now or datetime.now()
+    monthly_expenses = calculate_monthly_expenses(expenses, now.month, now.year)
+    monthly_savings = monthly_income - monthly_expenses
+    return {
+        'monthly_expenses': monthly_expenses,
+        'total_expenses': calculate_total_expenses(expenses) + (archived['total'] if archived else 0),
+        'monthly_income': monthly_income,
+        'monthly_savings': monthly_savings,
+        'savings_percentage': (monthly_savings / monthly_income * 100) if monthly_income > 0 else 0,
+    }
+
+@traced('analytics.chart_payload')
+def chart_payload(expenses, chart_type, now=None, archived=None):
+    """Build the labels/data payload for /api/chart_data, or None for an unknown type"""
+    if chart_type == 'category':
+        # Category breakdown
+        category_totals = defaultdict(float)
+        for name, total in (archived['by_category'] if archived else {}).items():
+            category_totals[name] += total
+        for expense in expenses:
+            category_totals[expense.category] += expense.amount
+
+        if not category_totals:
+            return {'labels': ['No expenses yet'], 'data': [0]}
+
+        return {
+            'labels': list(category_totals.keys()),
+            'data': list(category_totals.values())
+        }
+
+    elif chart_type == 'monthly':
+        # Monthly expenses for current year
+        current_year = (now or datetime.now()).year
+        monthly_totals = defaultdict(float)
+
+        for expense in expenses:
+            expense_date = parse_expense_date(expense.date)
+            if expense_date.year == current_year:
+                monthly_totals[expense_date.month] += expense.amount
+        for month, total in (archived['by_month'] if archived else {}).items():
+            if int(month[:4]) == current_year:
+                monthly_totals[int(month[5:7])] += total
+
+        return {
+            'labels': MONTH_LABELS,
+            'data': [monthly_totals.get(i, 0) for i in range(1, 13)]
+        }
+
+    elif chart_type == 'expense_type':
+        # Wanted vs Unwanted expenses
+        type_totals = defaultdict(float)
+        for name, total in (archived['by_type'] if archived else {}).items():
+            type_totals[name] += total
+        for expense in expenses:
+            type_totals[expense.expense_type] += expense.amount
+
+        if not type_totals:
+            return {'labels': ['No expenses yet'], 'data': [0]}
+
+        return {
+            'labels': [t.title() for t in type_totals.keys()],
+            'data': list(type_totals.values())
+        }
+
+    return None
+
+@traced('analytics.savings_suggestions')
+def savings_suggestions(expenses, monthly_income, savings_goal, now=None):
+    """Build the list of savings suggestion strings for one user"""
+    now = now or datetime.now()
+
+    monthly_expenses = 0
+    unwanted_expenses = 0
+
+    for expense in expenses:
+        expense_date = parse_expense_date(expense.date)
+        if expense_date.month == now.month and expense_date.year == now.year:
+            monthly_expenses += expense.amount
+            if expense.expense_type == 'unwanted':
+                unwanted_expenses += expense.amount
+
+    suggestions = []
+
+    # Basic suggestions
+    if unwanted_expenses > 0:
+        suggestions.append(f"You spent ₹{unwanted_expenses:.2f} on unwanted items this month. Try to reduce this by 50% to save ₹{unwanted_expenses * 0.5:.2f}.")
+
+    if savings_goal:
+        monthly_savings_needed = savings_goal.target_amount / savings_goal.target_months
+        current_savings = monthly_income - monthly_expenses
+
+        if current_savings < monthly_savings_needed:
+            shortfall = monthly_savings_needed - current_savings
+            suggestions.append(f"To reach your savings goal of ₹{savings_goal.target_amount:.2f} in {savings_goal.target_months} months, you need to save ₹{monthly_savings_needed:.2f} monthly. You're short by ₹{shortfall:.2f}.")
+        else:
+            suggestions.append(f"Great! You're on track to meet your savings goal. Keep it up!")
+
+    if monthly_expenses > monthly_income * 0.8:
+        suggestions.append("Your expenses are quite high (>80% of income). Consider reviewing your spending habits.")
+
+    return suggestions
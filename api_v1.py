@@ -0,0 +1,241 @@
+"""
+Versioned JSON API for the PWA and other clients.
+
+    GET /api/v1/expenses           the user's expenses, newest first, one page at a time
+    GET /api/v1/expenses/<id>      one expense
+    GET /api/v1/goal               the savings goal
+    GET /api/v1/profile            the user's profile
+    GET /api/v1/sync?since=TOKEN   what changed since TOKEN (see change_feed.py)
+
+Query parameters:
+
+- ``fields=id,amount,date`` returns only those fields (an unknown field is a 400);
+- ``limit`` is the page size (default ``API_PAGE_SIZE``, at most
+  ``API_MAX_PAGE_SIZE``); a list response carries ``next``, an opaque cursor
+  to send back as ``cursor`` for the following page, or null on the last one.
+  Cursors mark a position rather than an offset, so expenses added meanwhile
+  do not shift pages;
+- ``start`` and ``end`` (YYYY-MM-DD) bound the expense dates;
+- ``format=compact`` sends a list as ``{"fields": [...], "rows": [[...], ...]}``,
+  so field names are not repeated for every record.
+
+A sync answers ``{"token": ..., "reset": [...], "expenses": {"items": [...],
+"deleted": [ids]}}`` (compact rows with ``format=compact``), plus ``goal`` and
+``profile`` when those changed (null when deleted). Collections named in ``reset`` must be fetched again in full;
+without ``since``, or when the log no longer reaches back that far, all of
+them are. Clients keep the returned token for the next sync; taking a token
+before a full fetch is safe, since replaying a change is harmless.
+
+Responses carry no whitespace and are gzipped when the client accepts it and
+the body is at least ``API_GZIP_MIN_BYTES``. A change that would break
+clients belongs in ``/api/v2``; v1 keeps its fields and shapes.
+"""
+
+import os
+import json
+import gzip
+import base64
+import binascii
+from datetime import date
+from functools import wraps
+from flask import request, make_response
+from flask_login import current_user
+from firebase_db import FirebaseUser, FirebaseExpense, FirebaseSavingsGoal
+from change_feed import changes_since, COLLECTIONS
+from profiling import traced
+
+API_PAGE_SIZE = int(os.environ.get('API_PAGE_SIZE', 50))
+API_MAX_PAGE_SIZE = int(os.environ.get('API_MAX_PAGE_SIZE', 500))
+API_GZIP_MIN_BYTES = int(os.environ.get('API_GZIP_MIN_BYTES', 1024))
+PREFIX = '/api/v1'
+
+# Fields each resource exposes, in the order compact rows use
+EXPENSE_FIELDS = ('id', 'amount', 'category', 'description', 'expense_type', 'date', 'created_at')
+GOAL_FIELDS = ('id', 'target_amount', 'target_months', 'current_savings', 'created_at')
+PROFILE_FIELDS = ('id', 'username', 'email', 'monthly_income', 'is_admin', 'created_at')
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def respond(payload, status=200):
+    body = json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    response = make_response(body, status)
+    response.mimetype = 'application/json'
+    response.vary.add('Accept-Encoding')
+    if len(body) >= API_GZIP_MIN_BYTES and request.accept_encodings['gzip']:
+        response.set_data(gzip.compress(body, 6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+def api_view(view):
+    """JSON errors for API clients instead of login redirects and HTML pages"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            return respond({'error': 'Authentication required'}, 401)
+        try:
+            return view(*args, **kwargs)
+        except ApiError as e:
+            return respond({'error': str(e)}, e.status)
+    return wrapper
+
+def parse_fields(allowed):
+    """The requested fields in the resource's own order; all of them when none are asked for"""
+    raw = request.args.get('fields')
+    if not raw:
+        return allowed
+    wanted = {name.strip() for name in raw.split(',') if name.strip()}
+    unknown = wanted - set(allowed)
+    if unknown:
+        raise ApiError(f"Unknown fields: {', '.join(sorted(unknown))} (available: {', '.join(allowed)})")
+    return tuple(name for name in allowed if name in wanted)
+
+def project(record, fields):
+    data = record.to_dict()
+    return {name: data.get(name) for name in fields}
+
+def encode_cursor(expense):
+    raw = json.dumps([expense.date, expense.id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def decode_cursor(cursor):
+    """(date, id) of the last expense of the previous page"""
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        when, expense_id = position
+        if isinstance(when, str) and isinstance(expense_id, str):
+            date.fromisoformat(when[:10])
+            return when, expense_id
+    except (ValueError, TypeError, binascii.Error):
+        pass
+    raise ApiError('Invalid cursor')
+
+def _parse_date(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ApiError(f"{name} must be YYYY-MM-DD")
+
+def _limit():
+    try:
+        limit = int(request.args.get('limit', API_PAGE_SIZE))
+    except ValueError:
+        raise ApiError('limit must be a number')
+    return max(1, min(limit, API_MAX_PAGE_SIZE))
+
+def _sort_key(expense):
+    return (expense.date, expense.id)
+
+@traced('api.expense_page')
+def expense_page(user_id, size, cursor=None, start_date=None, end_date=None):
+    """Up to ``size`` expenses after ``cursor``, newest first, and whether more follow.
+
+    Reads ask for a limited number of expenses, so archived blocks are only
+    opened as far back as the page reaches. Expenses sharing a date are
+    ordered by id; a read cut off inside a run of equal dates is widened
+    until the run is complete.
+    """
+    if cursor is not None:
+        cursor_day = date.fromisoformat(cursor[0][:10])
+        end_date = min(end_date, cursor_day) if end_date else cursor_day
+    limit = size + 1
+    while True:
+        fetched = FirebaseExpense.get_by_user_id(user_id, start_date=start_date, end_date=end_date, limit=limit)
+        complete = len(fetched) < limit
+        # A truncated read may have dropped some expenses on its oldest date
+        candidates = fetched if complete else [e for e in fetched if e.date > fetched[-1].date]
+        page = sorted((e for e in candidates if cursor is None or _sort_key(e) < cursor), key=_sort_key, reverse=True)
+        if complete or len(page) > size:
+            return page[:size], len(page) > size
+        limit *= 2
+
+def _encode(rows, fields):
+    """Dicts as {'items': [...]}, or {'fields': [...], 'rows': [[...]]} for format=compact"""
+    if request.args.get('format') == 'compact':
+        return {'fields': list(fields), 'rows': [[row.get(name) for name in fields] for row in rows]}
+    return {'items': [{name: row.get(name) for name in fields} for row in rows]}
+
+def listing(records, fields, next_cursor=None):
+    payload = _encode([record.to_dict() for record in records], fields)
+    payload['next'] = next_cursor
+    return payload
+
+def _parse_token():
+    raw = request.args.get('since')
+    if not raw:
+        return None
+    try:
+        return int(raw)
+    except ValueError:
+        raise ApiError('Invalid sync token')
+
+@traced('api.sync')
+def sync_payload(user_id, since, fields):
+    """The delta for a client holding token ``since``; later entries for a record win"""
+    token, entries, reset = changes_since(user_id, since)
+    if reset is None:
+        return {'token': str(token), 'reset': sorted(COLLECTIONS.values())}
+    changed, touched = {}, set()
+    for entry in entries:
+        if entry['kind'] == 'expenses':
+            if not entry.get('reset'):
+                changed[entry['id']] = entry.get('data')
+        else:
+            touched.add(COLLECTIONS.get(entry['kind']))
+    payload = {'token': str(token), 'reset': sorted(reset)}
+    if 'expenses' not in reset:
+        payload['expenses'] = _encode([data for data in changed.values() if data], fields)
+        payload['expenses']['deleted'] = [expense_id for expense_id, data in changed.items() if not data]
+    # One record each; sent as it is now rather than as it was logged
+    if 'goal' in touched:
+        goal = FirebaseSavingsGoal.get_by_user_id(user_id)
+        payload['goal'] = project(goal, GOAL_FIELDS) if goal else None
+    if 'profile' in touched:
+        user = FirebaseUser.get_by_id(user_id)
+        payload['profile'] = project(user, PROFILE_FIELDS) if user else None
+    return payload
+
+def init_app(app):
+    """Register the /api/v1 routes"""
+
+    @app.route(f"{PREFIX}/expenses")
+    @api_view
+    def api_v1_expenses():
+        fields = parse_fields(EXPENSE_FIELDS)
+        cursor = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+        page, more = expense_page(current_user.get_id(), _limit(), cursor, _parse_date('start'), _parse_date('end'))
+        return respond(listing(page, fields, encode_cursor(page[-1]) if more else None))
+
+    @app.route(f"{PREFIX}/expenses/<expense_id>")
+    @api_view
+    def api_v1_expense(expense_id):
+        fields = parse_fields(EXPENSE_FIELDS)
+        expense = FirebaseExpense.get_by_id(expense_id, user_id=current_user.get_id())
+        if expense is None or expense.user_id != current_user.get_id():
+            raise ApiError('Expense not found', 404)
+        return respond(project(expense, fields))
+
+    @app.route(f"{PREFIX}/goal")
+    @api_view
+    def api_v1_goal():
+        fields = parse_fields(GOAL_FIELDS)
+        goal = FirebaseSavingsGoal.get_by_user_id(current_user.get_id())
+        if goal is None:
+            raise ApiError('No savings goal set', 404)
+        return respond(project(goal, fields))
+
+    @app.route(f"{PREFIX}/profile")
+    @api_view
+    def api_v1_profile():
+        return respond(project(current_user, parse_fields(PROFILE_FIELDS)))
+
+    @app.route(f"{PREFIX}/sync")
+    @api_view
+    def api_v1_sync():
+        fields = parse_fields(EXPENSE_FIELDS)
+        return respond(sync_payload(current_user.get_id(), _parse_token(), fields))
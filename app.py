@@ -1,11 +1,29 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, make_response
+import math
+import time
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, make_response, g, send_file, session
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
 import json
-from firebase_db import FirebaseUser, FirebaseExpense, FirebaseSavingsGoal
-from collections import defaultdict
+from firebase_db import FirebaseUser, FirebaseExpense, FirebaseSavingsGoal, WriteConflict
+from firebase_config import check_connection
+from sharding import ShardMoving
+from session_cache import user_cache
+from password_hashing import HashingBusyError
+import metrics
+import profiling
+import assets
+import api_v1
+import admission
+from admission import BackendUnavailable, RateLimited
+from analytics import dashboard_summary, chart_payload, calculate_total_expenses
+from suggestions import suggestion_engine
+from report_index import get_index, range_report, parse_report_args, monthly_chart
+from search_index import search_expenses
+from spending_stats import spending_insights
+from fragment_cache import fragment_cache, FragmentCacheExtension, ALL_USERS
+from exports import write_expenses_csv
+from jobs import job_runner, JobQueueFull, public_view, result_path
 import csv
 import io
 
@@ -28,9 +46,72 @@ app.jinja_env.filters['date_input'] = format_date_for_input
 app.jinja_env.filters['date_display'] = format_date_display
 app.jinja_env.filters['datetime_display'] = format_datetime_display
 
+# {% cache %} blocks (see fragment_cache.py)
+app.jinja_env.add_extension(FragmentCacheExtension)
+
+# Opt-in request tracing (see profiling.py)
+profiling.init_app(app)
+
+# Fingerprinted, precompressed static files when built (see assets.py)
+assets.init_app(app)
+
+# Versioned JSON API for the PWA (see api_v1.py)
+api_v1.init_app(app)
+
+# Request metrics
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    metrics.start_request_tracking()
+    # Database calls are rate limited per user (see admission.py); the session id needs no lookup
+    g.admission_caller = admission.set_caller(session.get('_user_id'))
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        # Label by URL rule, not raw path, to keep the series count bounded
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        size = response.calculate_content_length() or 0
+        metrics.observe_request(route, request.method, response.status_code, time.perf_counter() - started, size)
+    return response
+
+@app.teardown_request
+def reset_admission_caller(error=None):
+    token = g.pop('admission_caller', None)
+    if token is not None:
+        admission.reset_caller(token)
+
+# A user's data is being moved between shards (see sharding.py); writes wait for it
+@app.errorhandler(ShardMoving)
+def shard_moving(error):
+    if request.path.startswith('/api/') or request.accept_mimetypes.best == 'application/json':
+        return jsonify({'error': str(error)}), 503, {'Retry-After': '5'}
+    flash('Your data is being moved right now. Please try again in a few seconds.')
+    return redirect(request.referrer or url_for('dashboard'))
+
+# The database is down, overloaded or this user is over their call rate; say so instead of showing empty data
+@app.errorhandler(BackendUnavailable)
+def backend_unavailable(error):
+    status = 429 if isinstance(error, RateLimited) else 503
+    headers = {'Retry-After': str(max(1, math.ceil(error.retry_after or 5)))}
+    if request.path.startswith('/api/') or request.accept_mimetypes.best == 'application/json':
+        return jsonify({'error': str(error)}), status, headers
+    # Rendered without context processors: Flask-Login's would look the current user up again
+    page = app.jinja_env.get_template('unavailable.html').render(
+        rate_limited=status == 429, retry_url=request.full_path if request.method == 'GET' else url_for('index'))
+    return page, status, headers
+
 @login_manager.user_loader
 def load_user(user_id):
-    return FirebaseUser.get_by_id(user_id)
+    user = user_cache.get(user_id)
+    if user is None:
+        # Capture the version before the round trip so a concurrent invalidation wins
+        version = user_cache.version(user_id)
+        user = FirebaseUser.get_by_id(user_id)
+        if user:
+            user_cache.put(user_id, user, version)
+    return user
 
 # Routes
 @app.route('/')
@@ -39,18 +120,52 @@ def index():
         return redirect(url_for('dashboard'))
     return render_template('index.html')
 
+@app.route('/healthz')
+def healthz():
+    """Liveness check; never touches the database"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """Readiness check with one round trip to the database"""
+    ok, detail = check_connection()
+    return jsonify({'status': 'ready' if ok else 'unavailable', 'detail': detail}), 200 if ok else 503
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition; set METRICS_TOKEN to require a bearer token"""
+    token = os.environ.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return jsonify({'error': 'Unauthorized'}), 401
+    response = make_response(metrics.render())
+    response.headers['Content-Type'] = metrics.CONTENT_TYPE
+    return response
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        user = FirebaseUser.get_by_username(username)
         
-        if user and user.check_password(password):
-            login_user(user)
-            return redirect(url_for('dashboard'))
-        else:
-            flash('Invalid username or password')
+        try:
+            user = FirebaseUser.get_by_username(username)
+            if user and user.check_password(password):
+                # Upgrade hashes made with old cost settings while we have the plaintext
+                if user.password_needs_rehash():
+                    user.set_password(password)
+                    user.save()
+                login_user(user)
+                # The dashboard asks for suggestions next; start building them now
+                suggestion_engine.prefetch(user.get_id())
+                return redirect(url_for('dashboard'))
+            else:
+                flash('Invalid username or password')
+        except HashingBusyError:
+            flash('Server is busy, please try again in a moment')
+            return render_template('login.html'), 503
+        except BackendUnavailable:
+            flash('Cannot reach the database right now, please try again in a moment')
+            return render_template('login.html'), 503
     
     return render_template('login.html')
 
@@ -73,7 +188,11 @@ def register():
         # First user becomes admin
         is_admin = FirebaseUser.count() == 0
         
-        user = FirebaseUser.create_user(username, email, password, monthly_income, is_admin)
+        try:
+            user = FirebaseUser.create_user(username, email, password, monthly_income, is_admin)
+        except HashingBusyError:
+            flash('Server is busy, please try again in a moment')
+            return render_template('register.html'), 503
         
         # Create default savings goal
         FirebaseSavingsGoal.create_goal(user.get_id())
@@ -92,52 +211,42 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    # Get current month expenses
-    current_month = datetime.now().month
-    current_year = datetime.now().year
-    
-    def calculate_monthly_expenses(expenses, current_month, current_year):
-        total = 0
-        for expense in expenses:
-            expense_date = datetime.fromisoformat(expense.date.replace('Z', '+00:00'))
-            if expense_date.month == current_month and expense_date.year == current_year:
-                total += expense.amount
-        return total
-    
-    def calculate_total_expenses(expenses):
-        return sum(expense.amount for expense in expenses)
-    
+    # The cards show the viewer's own goal and this month's totals, so both are part of the key
+    fragments = fragment_cache.scope(ALL_USERS if current_user.is_admin else current_user.get_id(),
+                                     current_user.get_id(), datetime.now().strftime('%Y-%m'))
+    # Kept current by every expense write, so they are not part of the cached fragments
+    insights = [] if current_user.is_admin else spending_insights(current_user.get_id())
+    if fragments.has('dashboard.summary', 'dashboard.recent'):
+        return render_template('dashboard.html', fragments=fragments, insights=insights)
+    
+    # The hot tier plus archive summaries; archived blocks are only read if recent expenses run short
     if current_user.is_admin:
-        all_expenses = FirebaseExpense.get_all_expenses()
-        monthly_expenses = calculate_monthly_expenses(all_expenses, current_month, current_year)
-        total_expenses = calculate_total_expenses(all_expenses)
+        expenses = FirebaseExpense.get_all_expenses(include_archived=False)
+        archived = FirebaseExpense.archived_summary()
         total_users = FirebaseUser.count()
-        recent_expenses = FirebaseExpense.get_all_expenses(limit=5)
     else:
-        user_expenses = FirebaseExpense.get_by_user_id(current_user.get_id())
-        monthly_expenses = calculate_monthly_expenses(user_expenses, current_month, current_year)
-        total_expenses = calculate_total_expenses(user_expenses)
+        expenses = FirebaseExpense.get_by_user_id(current_user.get_id(), include_archived=False)
+        archived = FirebaseExpense.archived_summary(current_user.get_id())
         total_users = None
-        recent_expenses = FirebaseExpense.get_by_user_id(current_user.get_id(), limit=5)
+    
+    # Expenses are already sorted newest first
+    recent_expenses = expenses[:5]
+    if len(recent_expenses) < 5 and archived['count']:
+        recent_expenses = (FirebaseExpense.get_all_expenses(limit=5) if current_user.is_admin
+                           else FirebaseExpense.get_by_user_id(current_user.get_id(), limit=5))
     
     # Get savings data
     savings_goal = FirebaseSavingsGoal.get_by_user_id(current_user.get_id())
     if not savings_goal:
         savings_goal = FirebaseSavingsGoal.create_goal(current_user.get_id())
     
-    monthly_income = current_user.monthly_income
-    monthly_savings = monthly_income - monthly_expenses
-    savings_percentage = (monthly_savings / monthly_income * 100) if monthly_income > 0 else 0
-    
-    return render_template('dashboard.html', 
-                         monthly_expenses=monthly_expenses,
-                         total_expenses=total_expenses,
-                         monthly_income=monthly_income,
-                         monthly_savings=monthly_savings,
-                         savings_percentage=savings_percentage,
+    return render_template('dashboard.html',
+                         fragments=fragments,
+                         insights=insights,
                          recent_expenses=recent_expenses,
                          total_users=total_users,
-                         savings_goal=savings_goal)
+                         savings_goal=savings_goal,
+                         **dashboard_summary(expenses, current_user.monthly_income, archived=archived))
 
 @app.route('/add_expense', methods=['GET', 'POST'])
 @login_required
@@ -177,6 +286,7 @@ def expenses():
     expense_type = request.args.get('type')
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
+    query = request.args.get('q', '').strip()
     
     # Convert string dates to date objects
     start_date_obj = datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else None
@@ -184,14 +294,26 @@ def expenses():
     
     # Get filtered expenses
     user_id = None if current_user.is_admin else current_user.get_id()
-    all_expenses = FirebaseExpense.get_filtered_expenses(
-        user_id=user_id,
-        category=category,
-        expense_type=expense_type,
-        start_date=start_date_obj,
-        end_date=end_date_obj,
-        is_admin=current_user.is_admin
-    )
+    if query:
+        # Ranked by relevance from the search index; only matching expenses are touched
+        all_expenses = search_expenses(
+            query,
+            user_id=current_user.get_id(),
+            is_admin=current_user.is_admin,
+            category=category,
+            expense_type=expense_type,
+            start_date=start_date_obj,
+            end_date=end_date_obj
+        )
+    else:
+        all_expenses = FirebaseExpense.get_filtered_expenses(
+            user_id=user_id,
+            category=category,
+            expense_type=expense_type,
+            start_date=start_date_obj,
+            end_date=end_date_obj,
+            is_admin=current_user.is_admin
+        )
     
     # Simple pagination
     total_expenses = len(all_expenses)
@@ -211,7 +333,19 @@ def expenses():
             self.has_next = page < self.pages
             self.prev_num = page - 1 if self.has_prev else None
             self.next_num = page + 1 if self.has_next else None
-    
+
+        def iter_pages(self, left_edge=2, left_current=2, right_current=5, right_edge=2):
+            # Same contract as Flask-SQLAlchemy: page numbers, None for a gap
+            last = 0
+            for num in range(1, self.pages + 1):
+                if (num <= left_edge or
+                        self.page - left_current - 1 < num < self.page + right_current or
+                        num > self.pages - right_edge):
+                    if last + 1 != num:
+                        yield None
+                    yield num
+                    last = num
+
     pagination = SimplePagination(page, per_page, total_expenses, expenses_page)
     
     categories = ['Food', 'Transportation', 'Entertainment', 'Shopping', 'Bills', 'Healthcare', 'Education', 'Other']
@@ -224,7 +358,10 @@ def expenses():
 @app.route('/edit_expense/<expense_id>', methods=['GET', 'POST'])
 @login_required
 def edit_expense(expense_id):
-    expense = FirebaseExpense.get_by_id(expense_id)
+    # The ETag travels with the form so a save can tell if someone else edited meanwhile
+    # Admins pass the owner so other users' archived expenses can be found
+    owner = request.args.get('owner') or current_user.get_id()
+    expense = FirebaseExpense.get_by_id(expense_id, with_etag=True, user_id=owner)
     if not expense:
         flash('Expense not found')
         return redirect(url_for('expenses'))
@@ -234,7 +371,14 @@ def edit_expense(expense_id):
         flash('You can only edit your own expenses')
         return redirect(url_for('expenses'))
     
+    categories = ['Food', 'Transportation', 'Entertainment', 'Shopping', 'Bills', 'Healthcare', 'Education', 'Other']
+    
     if request.method == 'POST':
+        form_etag = request.form.get('etag')
+        if form_etag and expense.etag and form_etag != expense.etag:
+            flash('This expense was changed on another device. Review the current values and save again.')
+            return render_template('edit_expense.html', expense=expense, categories=categories), 409
+        
         expense.amount = float(request.form['amount'])
         expense.category = request.form['category']
         expense.description = request.form['description']
@@ -242,17 +386,21 @@ def edit_expense(expense_id):
         date_str = request.form['date']
         expense.date = datetime.strptime(date_str, '%Y-%m-%d').isoformat()
         
-        expense.save()
+        try:
+            expense.save()
+        except WriteConflict:
+            flash('This expense was changed on another device. Review the current values and save again.')
+            expense = FirebaseExpense.get_by_id(expense_id, with_etag=True, user_id=expense.user_id) or expense
+            return render_template('edit_expense.html', expense=expense, categories=categories), 409
         flash('Expense updated successfully!')
         return redirect(url_for('expenses'))
     
-    categories = ['Food', 'Transportation', 'Entertainment', 'Shopping', 'Bills', 'Healthcare', 'Education', 'Other']
     return render_template('edit_expense.html', expense=expense, categories=categories)
 
 @app.route('/delete_expense/<expense_id>')
 @login_required
 def delete_expense(expense_id):
-    expense = FirebaseExpense.get_by_id(expense_id)
+    expense = FirebaseExpense.get_by_id(expense_id, user_id=request.args.get('owner') or current_user.get_id())
     if not expense:
         flash('Expense not found')
         return redirect(url_for('expenses'))
@@ -277,68 +425,26 @@ def chart_data():
     chart_type = request.args.get('type', 'category')
     
     try:
+        if chart_type == 'monthly':
+            # Answered from the cached time index instead of a scan
+            index = get_index(current_user.get_id(), current_user.is_admin)
+            return jsonify(monthly_chart(index, datetime.now().year))
+        
+        # Archived months contribute through their summaries
         if current_user.is_admin:
-            expenses = FirebaseExpense.get_all_expenses()
+            expenses = FirebaseExpense.get_all_expenses(include_archived=False)
+            archived = FirebaseExpense.archived_summary()
         else:
-            expenses = FirebaseExpense.get_by_user_id(current_user.get_id())
-        
-        if chart_type == 'category':
-            # Category breakdown
-            category_totals = defaultdict(float)
-            for expense in expenses:
-                category_totals[expense.category] += expense.amount
-            
-            if not category_totals:
-                return jsonify({
-                    'labels': ['No expenses yet'],
-                    'data': [0]
-                })
-            
-            return jsonify({
-                'labels': list(category_totals.keys()),
-                'data': list(category_totals.values())
-            })
-        
-        elif chart_type == 'monthly':
-            # Monthly expenses for current year
-            current_year = datetime.now().year
-            monthly_totals = defaultdict(float)
-            
-            for expense in expenses:
-                expense_date = datetime.fromisoformat(expense.date.replace('Z', '+00:00'))
-                if expense_date.year == current_year:
-                    monthly_totals[expense_date.month] += expense.amount
-            
-            months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
-                     'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
-            
-            monthly_amounts = [monthly_totals.get(i, 0) for i in range(1, 13)]
-            
-            return jsonify({
-                'labels': months,
-                'data': monthly_amounts
-            })
-        
-        elif chart_type == 'expense_type':
-            # Wanted vs Unwanted expenses
-            type_totals = defaultdict(float)
-            for expense in expenses:
-                type_totals[expense.expense_type] += expense.amount
-            
-            if not type_totals:
-                return jsonify({
-                    'labels': ['No expenses yet'],
-                    'data': [0]
-                })
-            
-            return jsonify({
-                'labels': [t.title() for t in type_totals.keys()],
-                'data': list(type_totals.values())
-            })
+            expenses = FirebaseExpense.get_by_user_id(current_user.get_id(), include_archived=False)
+            archived = FirebaseExpense.archived_summary(current_user.get_id())
         
-        else:
+        payload = chart_payload(expenses, chart_type, archived=archived)
+        if payload is None:
             return jsonify({'error': 'Invalid chart type'}), 400
+        return jsonify(payload)
             
+    except BackendUnavailable:
+        raise
     except Exception as e:
         print(f"Chart data error: {str(e)}")
         return jsonify({
@@ -347,6 +453,17 @@ def chart_data():
             'error': str(e)
         }), 500
 
+@app.route('/api/reports')
+@login_required
+def reports_data():
+    """Totals per day/week/month/year over any date range, optionally split by category or type"""
+    try:
+        options = parse_report_args(request.args)
+        index = get_index(current_user.get_id(), current_user.is_admin)
+        return jsonify(range_report(index, **options))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
 @app.route('/admin')
 @login_required
 def admin():
@@ -354,12 +471,17 @@ def admin():
         flash('Access denied. Admin only.')
         return redirect(url_for('dashboard'))
     
+    fragments = fragment_cache.scope(ALL_USERS, current_user.get_id())
+    if fragments.has('admin.stats', 'admin.users', 'admin.user_scripts'):
+        return render_template('admin.html', fragments=fragments)
+    
     users = FirebaseUser.get_all_users()
-    all_expenses = FirebaseExpense.get_all_expenses()
-    total_expenses = sum(expense.amount for expense in all_expenses)
-    total_users = FirebaseUser.count()
+    all_expenses = FirebaseExpense.get_all_expenses(include_archived=False)
+    total_expenses = calculate_total_expenses(all_expenses) + FirebaseExpense.archived_summary()['total']
+    total_users = len(users)
     
-    return render_template('admin.html', users=users, total_expenses=total_expenses, total_users=total_users)
+    return render_template('admin.html', fragments=fragments, users=users, total_expenses=total_expenses,
+                           total_users=total_users)
 
 @app.route('/admin/add_user', methods=['GET', 'POST'])
 @login_required
@@ -378,7 +500,11 @@ def add_user():
             flash('Username already exists')
             return render_template('add_user.html')
         
-        user = FirebaseUser.create_user(username, email, password, monthly_income)
+        try:
+            user = FirebaseUser.create_user(username, email, password, monthly_income)
+        except HashingBusyError:
+            flash('Server is busy, please try again in a moment')
+            return render_template('add_user.html'), 503
         
         # Create default savings goal
         FirebaseSavingsGoal.create_goal(user.get_id())
@@ -419,44 +545,8 @@ def update_savings_goal():
 @app.route('/api/savings_suggestions')
 @login_required
 def savings_suggestions():
-    # Get current month data
-    current_month = datetime.now().month
-    current_year = datetime.now().year
-    
-    user_expenses = FirebaseExpense.get_by_user_id(current_user.get_id())
-    
-    monthly_expenses = 0
-    unwanted_expenses = 0
-    
-    for expense in user_expenses:
-        expense_date = datetime.fromisoformat(expense.date.replace('Z', '+00:00'))
-        if expense_date.month == current_month and expense_date.year == current_year:
-            monthly_expenses += expense.amount
-            if expense.expense_type == 'unwanted':
-                unwanted_expenses += expense.amount
-    
-    savings_goal = FirebaseSavingsGoal.get_by_user_id(current_user.get_id())
-    monthly_income = current_user.monthly_income
-    
-    suggestions = []
-    
-    # Basic suggestions
-    if unwanted_expenses > 0:
-        suggestions.append(f"You spent ₹{unwanted_expenses:.2f} on unwanted items this month. Try to reduce this by 50% to save ₹{unwanted_expenses * 0.5:.2f}.")
-    
-    if savings_goal:
-        monthly_savings_needed = savings_goal.target_amount / savings_goal.target_months
-        current_savings = monthly_income - monthly_expenses
-        
-        if current_savings < monthly_savings_needed:
-            shortfall = monthly_savings_needed - current_savings
-            suggestions.append(f"To reach your savings goal of ₹{savings_goal.target_amount:.2f} in {savings_goal.target_months} months, you need to save ₹{monthly_savings_needed:.2f} monthly. You're short by ₹{shortfall:.2f}.")
-        else:
-            suggestions.append(f"Great! You're on track to meet your savings goal. Keep it up!")
-    
-    if monthly_expenses > monthly_income * 0.8:
-        suggestions.append("Your expenses are quite high (>80% of income). Consider reviewing your spending habits.")
-    
+    # Cached per user and recomputed in the background after writes
+    suggestions = suggestion_engine.get(current_user.get_id())
     return jsonify({'suggestions': suggestions})
 
 @app.route('/api/user_expenses/<user_id>')
@@ -466,8 +556,8 @@ def user_expenses(user_id):
     if not current_user.is_admin and user_id != current_user.get_id():
         return jsonify({'error': 'Unauthorized'}), 403
     
-    user_expenses_list = FirebaseExpense.get_by_user_id(user_id)
-    total_expenses = sum(expense.amount for expense in user_expenses_list)
+    user_expenses_list = FirebaseExpense.get_by_user_id(user_id, include_archived=False)
+    total_expenses = sum(expense.amount for expense in user_expenses_list) + FirebaseExpense.archived_summary(user_id)['total']
     
     return jsonify({'total_expenses': total_expenses})
 
@@ -485,17 +575,13 @@ def delete_user(user_id):
         if not user:
             return jsonify({'error': 'User not found'}), 404
         
-        # Delete user's expenses first
-        FirebaseExpense.delete_by_user_id(user_id)
-        
-        # Delete user's savings goals
-        FirebaseSavingsGoal.delete_by_user_id(user_id)
-        
-        # Delete user
-        user.delete()
-        
-        return jsonify({'success': True, 'message': f'User {user.username} deleted successfully'})
+        # Expenses, goals and the account are removed by a background job
+        job, created = job_runner.enqueue('delete_user', current_user.get_id(), {'user_id': user_id},
+                                          key=f'delete_user:{user_id}')
+        return job_accepted(job, f'Deleting user {user.username}...')
         
+    except JobQueueFull as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -548,7 +634,10 @@ def reset_password(user_id):
     new_password = data.get('password', 'password123')  # Default password
     
     # Hash the new password
-    user.password = generate_password_hash(new_password)
+    try:
+        user.set_password(new_password)
+    except HashingBusyError:
+        return jsonify({'error': 'Server is busy, please try again'}), 503
     user.save()
     
     return jsonify({'success': True, 'message': f'Password reset to: {new_password}'})
@@ -563,6 +652,7 @@ def export_expenses():
         expense_type = request.args.get('type', '')
         start_date = request.args.get('start_date', '')
         end_date = request.args.get('end_date', '')
+        query = request.args.get('q', '').strip()
         
         # Convert string dates to date objects
         start_date_obj = datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else None
@@ -570,54 +660,32 @@ def export_expenses():
         
         # Get filtered expenses
         user_id = None if current_user.is_admin else current_user.get_id()
-        expenses = FirebaseExpense.get_filtered_expenses(
-            user_id=user_id,
-            category=category,
-            expense_type=expense_type,
-            start_date=start_date_obj,
-            end_date=end_date_obj,
-            is_admin=current_user.is_admin
-        )
+        if query:
+            expenses = search_expenses(
+                query,
+                user_id=current_user.get_id(),
+                is_admin=current_user.is_admin,
+                category=category,
+                expense_type=expense_type,
+                start_date=start_date_obj,
+                end_date=end_date_obj
+            )
+        else:
+            expenses = FirebaseExpense.get_filtered_expenses(
+                user_id=user_id,
+                category=category,
+                expense_type=expense_type,
+                start_date=start_date_obj,
+                end_date=end_date_obj,
+                is_admin=current_user.is_admin
+            )
         
         # Create CSV data
         output = io.StringIO()
         writer = csv.writer(output)
         
-        # Write headers
-        if current_user.is_admin:
-            writer.writerow([
-                'User ID', 'Expense ID', 'Amount', 'Category', 
-                'Description', 'Type', 'Date', 'Created At'
-            ])
-        else:
-            writer.writerow([
-                'Expense ID', 'Amount', 'Category', 'Description', 
-                'Type', 'Date', 'Created At'
-            ])
-        
-        # Write expense data
-        for expense in expenses:
-            if current_user.is_admin:
-                writer.writerow([
-                    expense.user_id,
-                    expense.id,
-                    expense.amount,
-                    expense.category,
-                    expense.description or '',
-                    expense.expense_type,
-                    datetime.fromisoformat(expense.date.replace('Z', '+00:00')).strftime('%Y-%m-%d'),
-                    datetime.fromisoformat(expense.created_at.replace('Z', '+00:00')).strftime('%Y-%m-%d %H:%M:%S')
-                ])
-            else:
-                writer.writerow([
-                    expense.id,
-                    expense.amount,
-                    expense.category,
-                    expense.description or '',
-                    expense.expense_type,
-                    datetime.fromisoformat(expense.date.replace('Z', '+00:00')).strftime('%Y-%m-%d'),
-                    datetime.fromisoformat(expense.created_at.replace('Z', '+00:00')).strftime('%Y-%m-%d %H:%M:%S')
-                ])
+        # Write headers and expense data (admins get a User ID column)
+        write_expenses_csv(writer, expenses, include_user=current_user.is_admin)
         
         # Create response
         output.seek(0)
@@ -772,20 +840,93 @@ def export_user_data_json():
 @app.route('/clear_user_data', methods=['POST'])
 @login_required
 def clear_user_data():
-    """Clear all user's expense data"""
+    """Clear all user's expense data in a background job"""
     try:
-        # Delete user's expenses
-        FirebaseExpense.delete_by_user_id(current_user.get_id())
-        
-        # Delete user's savings goals
-        FirebaseSavingsGoal.delete_by_user_id(current_user.get_id())
-        
-        flash('All your data has been successfully deleted.', 'success')
-        return redirect(url_for('dashboard'))
+        user_id = current_user.get_id()
+        job, created = job_runner.enqueue('clear_user_data', user_id, {'user_id': user_id},
+                                          key=f'clear_user_data:{user_id}')
+        return job_accepted(job, 'Deleting your data...')
         
+    except JobQueueFull as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
-        flash(f'Failed to clear data: {str(e)}', 'error')
-        return redirect(url_for('settings'))
+        return jsonify({'error': f'Failed to clear data: {str(e)}'}), 500
+
+@app.route('/admin/export_data', methods=['POST'])
+@login_required
+def export_system_data():
+    """Start a full CSV export of every user's expenses"""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    # Retries of the same click share a job, even once it has finished;
+    # a new click (or no key at all) starts a fresh export
+    idempotency_key = request.headers.get('Idempotency-Key')
+    key = f'export_all_expenses:{current_user.get_id()}:{idempotency_key}' if idempotency_key else None
+    try:
+        job, created = job_runner.enqueue('export_all_expenses', current_user.get_id(), key=key,
+                                          reuse_finished=bool(idempotency_key))
+        return job_accepted(job, 'Preparing export...')
+    except JobQueueFull as e:
+        return jsonify({'error': str(e)}), 503
+
+@app.route('/admin/archive_expenses', methods=['POST'])
+@login_required
+def archive_old_expenses():
+    """Start moving expenses past the archive horizon into monthly blocks"""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    try:
+        job, created = job_runner.enqueue('archive_expenses', current_user.get_id(), key='archive_expenses')
+        return job_accepted(job, 'Archiving old expenses...')
+    except JobQueueFull as e:
+        return jsonify({'error': str(e)}), 503
+
+def job_accepted(job, message):
+    """202 response pointing the browser at the job's status endpoint"""
+    return jsonify({
+        'success': True,
+        'job_id': job['id'],
+        'status': job['status'],
+        'status_url': url_for('job_status', job_id=job['id']),
+        'message': message
+    }), 202
+
+def get_visible_job(job_id):
+    """The job record if the current user started it (admins see all jobs)"""
+    job = job_runner.get(job_id)
+    if not job or not (current_user.is_admin or job.get('owner_id') == current_user.get_id()):
+        return None
+    return job
+
+@app.route('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    job = get_visible_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(public_view(job))
+
+@app.route('/jobs/<job_id>/download')
+@login_required
+def job_download(job_id):
+    job = get_visible_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    path = result_path(job)
+    if job['status'] != 'succeeded' or not path or not os.path.exists(path):
+        return jsonify({'error': 'No file available for this job'}), 404
+    return send_file(os.path.abspath(path), mimetype='text/csv', as_attachment=True,
+                     download_name=job['result'].get('filename', os.path.basename(path)))
+
+# Optionally serve the heavy views from the async data layer
+if os.environ.get('ASYNC_IO', '0') == '1':
+    from async_views import register_async_views
+    register_async_views(app)
 
 if __name__ == '__main__':
+    # Under the reloader only the child serves requests
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        job_runner.start()
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Hot/cold tiering for expenses.
+
+Expenses dated before the last ``ARCHIVE_AFTER_MONTHS`` whole months are
+moved out of the ``expenses`` node into one compressed block per user and
+month, ``expense_archive/<user_id>/<YYYY-MM>``, next to a small plain
+summary (count, total, totals per category and type, first and last date)
+under ``expense_archive_summaries/<user_id>/<YYYY-MM>``. Both live on the
+user's shard.
+
+Blocks are only written with conditional PUTs on their ETag, so archiving,
+edits and deletes of the same month never undo each other. Archiving re-reads
+each hot record before it goes into the block and removes it from the hot
+tier only if it is still unchanged; a record edited in between stays hot. The
+summary is written after its block, by whichever writer last changed it.
+
+FirebaseExpense reads a user's summaries first and then only the blocks
+whose month falls in the requested date range (and, for category or type
+filters, whose summary shows a match). Dashboard totals and the category
+and type charts come from the summaries alone. An archived expense edited
+within its month is changed in place; one moved to another month goes back
+to the hot tier, and a deleted one is taken out of its block.
+
+Archiving runs as the ``archive_expenses`` background job (see jobs.py) or
+from the command line, and is safe to repeat:
+
+    python archive.py --months 12
+    python archive.py --user <user_id> --dry-run
+"""
+
+import os
+import sys
+import json
+import zlib
+import base64
+import argparse
+import calendar
+from urllib.parse import quote, unquote
+from datetime import datetime, date
+from sharding import shard_map, ShardMoving
+
+ARCHIVE_AFTER_MONTHS = int(os.environ.get('ARCHIVE_AFTER_MONTHS', 12))
+ARCHIVE_NODE = 'expense_archive'
+SUMMARY_NODE = 'expense_archive_summaries'
+CODEC = 'zlib+json'
+MAX_BLOCK_RETRIES = 5
+
+def month_of(date_string):
+    """'YYYY-MM' of a stored ISO date"""
+    return (date_string or '')[:7]
+
+def horizon(now=None, months=ARCHIVE_AFTER_MONTHS):
+    """First month kept hot; expenses dated before it are archived"""
+    now = now or datetime.now()
+    index = now.year * 12 + now.month - 1 - months
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+def month_span(month):
+    """(first day, last day) of a 'YYYY-MM' month"""
+    year, mon = int(month[:4]), int(month[5:7])
+    return date(year, mon, 1), date(year, mon, calendar.monthrange(year, mon)[1])
+
+# Blocks and summaries
+
+def encode_block(records):
+    raw = json.dumps(records, separators=(',', ':'), sort_keys=True).encode('utf-8')
+    return {'codec': CODEC, 'count': len(records), 'data': base64.b64encode(zlib.compress(raw, 9)).decode('ascii')}
+
+def decode_block(block):
+    """{expense_id: record} stored in a block"""
+    if not isinstance(block, dict) or not block.get('data'):
+        return {}
+    if block.get('codec') != CODEC:
+        raise ValueError(f"Unknown archive codec {block.get('codec')!r}")
+    return json.loads(zlib.decompress(base64.b64decode(block['data'])))
+
+def _key(name):
+    # Category names are user input; database keys cannot hold . $ # [ ] /
+    return quote(name, safe=' ').replace('.', '%2E')
+
+def _totals(summary, field):
+    return {unquote(key): total for key, total in (summary.get(field) or {}).items()}
+
+def summarize(records, block):
+    by_category, by_type = {}, {}
+    for record in records.values():
+        amount = float(record.get('amount', 0.0))
+        by_category[record.get('category', '')] = by_category.get(record.get('category', ''), 0.0) + amount
+        by_type[record.get('expense_type', 'wanted')] = by_type.get(record.get('expense_type', 'wanted'), 0.0) + amount
+    dates = [record.get('date', '') for record in records.values()]
+    return {
+        'count': len(records),
+        'total': sum(by_category.values()),
+        'by_category': {_key(name): total for name, total in by_category.items()},
+        'by_type': {_key(name): total for name, total in by_type.items()},
+        'first': min(dates),
+        'last': max(dates),
+        'bytes': len(block['data']),
+        'archived_at': datetime.utcnow().isoformat(),
+    }
+
+def category_totals(summaries):
+    """{month: {category: total}} from one user's summaries"""
+    return {month: _totals(summary, 'by_category') for month, summary in (summaries or {}).items()}
+
+def select_months(summaries, start_date=None, end_date=None, category=None, expense_type=None):
+    """Months (newest first) whose block can hold a match"""
+    months = []
+    for month, summary in (summaries or {}).items():
+        first, last = month_span(month)
+        if (start_date and last < start_date) or (end_date and first > end_date):
+            continue
+        if category and category not in _totals(summary, 'by_category'):
+            continue
+        if expense_type and expense_type not in _totals(summary, 'by_type'):
+            continue
+        months.append(month)
+    return sorted(months, reverse=True)
+
+def combine(summaries):
+    """Totals over (month, summary) pairs, shaped for the dashboard and charts"""
+    combined = {'count': 0, 'total': 0.0, 'by_category': {}, 'by_type': {}, 'by_month': {}}
+    for month, summary in summaries:
+        combined['count'] += summary.get('count', 0)
+        combined['total'] += summary.get('total', 0.0)
+        combined['by_month'][month] = combined['by_month'].get(month, 0.0) + summary.get('total', 0.0)
+        for key in ('by_category', 'by_type'):
+            for name, total in _totals(summary, key).items():
+                combined[key][name] = combined[key].get(name, 0.0) + total
+    return combined
+
+# Reads and writes on one shard's database
+
+def read_summaries(db, user_id=None):
+    """{month: summary} for one user, or {user_id: {month: summary}} for everyone on ``db``"""
+    ref = db.child(SUMMARY_NODE)
+    if user_id:
+        ref = ref.child(user_id)
+    return ref.get().val() or {}
+
+def read_blocks(db, user_id, months=None):
+    """{month: {expense_id: record}}; ``months=None`` reads the user's whole archive in one request"""
+    ref = db.child(ARCHIVE_NODE).child(user_id)
+    if months is None:
+        return {month: decode_block(block) for month, block in (ref.get().val() or {}).items()}
+    return {month: decode_block(ref.child(month).get().val()) for month in months}
+
+def _write_summary(db, user_id, month, records, block, etag):
+    """Store the summary of the block written with ``etag``; if the block changed
+    meanwhile, the summary is redone from what it holds now"""
+    block_ref = db.child(ARCHIVE_NODE).child(user_id).child(month)
+    summary_ref = db.child(SUMMARY_NODE).child(user_id).child(month)
+    for attempt in range(MAX_BLOCK_RETRIES):
+        written = summary_ref.set(summarize(records, block)) if records else summary_ref.delete()
+        if not written:
+            raise RuntimeError(f"writing archive summary {user_id}/{month} failed")
+        snapshot, current = block_ref.get_with_etag()
+        if current == etag:
+            return
+        block, etag = snapshot.val(), current
+        records = decode_block(block)
+    raise RuntimeError(f"archive block {user_id}/{month} kept changing")
+
+def update_block(db, user_id, month, change):
+    """Apply ``change(records)`` to the month's block with a conditional write,
+    redone on the current block when another writer got there first.
+
+    ``change`` edits the records in place and returns whether it changed
+    anything; the records are returned, or None when nothing changed.
+    """
+    ref = db.child(ARCHIVE_NODE).child(user_id).child(month)
+    snapshot, etag = ref.get_with_etag()
+    for attempt in range(MAX_BLOCK_RETRIES):
+        records = decode_block(snapshot.val())
+        if not change(records):
+            return None
+        block = encode_block(records) if records else None
+        ok, current, new_etag = ref.set_if_unchanged(etag, block)
+        if ok:
+            _write_summary(db, user_id, month, records, block, new_etag)
+            return records
+        if current is None:
+            raise RuntimeError(f"writing archive block {user_id}/{month} failed")
+        snapshot, etag = current, new_etag
+    raise RuntimeError(f"archive block {user_id}/{month} kept changing")
+
+def _still_hot(db, records):
+    """{expense_id: etag} of the records the hot tier still holds exactly as given"""
+    etags = {}
+    for expense_id, record in records.items():
+        snapshot, etag = db.child("expenses").child(expense_id).get_with_etag()
+        if snapshot.val() == record:
+            etags[expense_id] = etag
+    return etags
+
+def archive_records(db, user_id, records):
+    """Move ``records`` ({expense_id: record}) from the hot tier into their monthly blocks; returns how many moved"""
+    by_month = {}
+    for expense_id, record in records.items():
+        by_month.setdefault(month_of(record['date']), {})[expense_id] = record
+    moved = 0
+    for month, new in sorted(by_month.items()):
+        # Records edited or deleted since they were read are left alone
+        etags = _still_hot(db, new)
+        new = {expense_id: new[expense_id] for expense_id in etags}
+        if not new:
+            continue
+        def add(block):
+            block.update(new)
+            return True
+        update_block(db, user_id, month, add)
+        edited = []
+        for expense_id, etag in etags.items():
+            ok, current, _ = db.child("expenses").child(expense_id).set_if_unchanged(etag, None)
+            if ok:
+                moved += 1
+            elif current is None:
+                raise RuntimeError(f"archiving {user_id}/{month} failed")
+            else:
+                edited.append(expense_id)
+        if edited:
+            # Edited while the block was written: the hot copy is the current one
+            update_block(db, user_id, month, lambda block: _drop(block, {eid: new[eid] for eid in edited}))
+    return moved
+
+def _drop(block, records):
+    """Remove ``records`` from ``block``, where it still holds them as given"""
+    stale = [expense_id for expense_id, record in records.items() if block.get(expense_id) == record]
+    for expense_id in stale:
+        del block[expense_id]
+    return bool(stale)
+
+def thaw(db, user_id, month, expense_id, data):
+    """Write an archived expense: ``data`` (None deletes it) replaces it in its
+    block, or goes to the hot tier when its date left the month. False if the
+    block no longer holds the expense."""
+    found = []
+    def take(block):
+        found.clear()
+        if expense_id not in block:
+            return False
+        found.append(block.pop(expense_id))
+        if data is not None and month_of(data.get('date')) == month:
+            block[expense_id] = data
+        return True
+    update_block(db, user_id, month, take)
+    if not found:
+        return False
+    if data is not None and month_of(data.get('date')) != month:
+        if not db.child("expenses").child(expense_id).set(data):
+            raise RuntimeError(f"updating archived expense {expense_id} failed")
+    return True
+
+def delete_user(db, user_id):
+    db.update({f"{ARCHIVE_NODE}/{user_id}": None, f"{SUMMARY_NODE}/{user_id}": None})
+
+def archive_expenses(months=ARCHIVE_AFTER_MONTHS, user_id=None, now=None, dry_run=False, progress=None):
+    """Archive every user's (or one user's) expenses older than the horizon; returns counts"""
+    cutoff = horizon(now, months)
+    totals = {'users': 0, 'expenses': 0, 'skipped_users': 0, 'horizon': cutoff}
+    shards = [shard_map.shard_for(user_id)] if user_id else shard_map.all()
+    for shard in shards:
+        pending = set()
+        if shard.write_buffer.enabled:
+            # Journaled writes are left for the next run
+            shard.write_buffer.flush_all()
+            pending = set(shard.write_buffer.pending_under('expenses'))
+        expenses = shard.database.child("expenses").get().val() or {}
+        old = {}
+        for expense_id, record in expenses.items():
+            if (isinstance(record, dict) and record.get('user_id') and record.get('date')
+                    and month_of(record['date']) < cutoff and expense_id not in pending
+                    and (user_id is None or record['user_id'] == user_id)):
+                old.setdefault(record['user_id'], {})[expense_id] = record
+        for done, (owner, records) in enumerate(sorted(old.items()), 1):
+            try:
+                # A leftover copy from an interrupted move, or a user being moved now
+                if shard_map.shard_for_write(owner) is not shard:
+                    totals['skipped_users'] += 1
+                    continue
+            except ShardMoving:
+                totals['skipped_users'] += 1
+                continue
+            moved = len(records) if dry_run else archive_records(shard.database, owner, records)
+            totals['users'] += 1
+            totals['expenses'] += moved
+            if progress:
+                progress(done, len(old), shard.name)
+    return totals
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--months', type=int, default=ARCHIVE_AFTER_MONTHS, help='whole months to keep hot')
+    parser.add_argument('--user', help='archive only this user id')
+    parser.add_argument('--dry-run', action='store_true', help='count what would be archived')
+    args = parser.parse_args(argv)
+    if args.months < 0:
+        parser.error('--months must be 0 or more')
+
+    totals = archive_expenses(args.months, args.user, dry_run=args.dry_run)
+    verb = 'Would archive' if args.dry_run else 'Archived'
+    print(f"🧊 {verb} {totals['expenses']} expenses of {totals['users']} users dated before {totals['horizon']}"
+          f" ({totals['skipped_users']} users skipped while moving)")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
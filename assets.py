@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Fingerprinted static assets.
+
+``python assets.py`` minifies ``static/css/style.css`` and
+``static/js/app.js``, copies the icons and the PWA manifest, and writes each
+file to ``static/dist`` under a name carrying a hash of its content
+(``css/style.3f9a1c2b7e.css``), next to gzip (and, when the ``brotli``
+package is installed, brotli) variants. ``static/dist/asset-manifest.json``
+maps every source name to its hashed name. The service worker is generated
+from ``static/sw.js`` into ``static/dist/sw.js`` with a cache name derived
+from the manifest and the hashed files in its precache list.
+
+With a manifest present, ``init_app`` makes ``url_for('static', ...)`` emit
+the hashed names and serves them with one-year immutable cache headers,
+picking a precompressed variant the browser accepts. Without one (a checkout
+that was never built) the plain files are served as before. Rebuild and
+restart after changing anything under ``static``:
+
+    python assets.py
+    python assets.py --check    # exit 1 if the build is missing or stale
+    python assets.py --clean    # also remove files of earlier builds
+"""
+
+import os
+import re
+import sys
+import json
+import gzip
+import shutil
+import hashlib
+import argparse
+import mimetypes
+from flask import request, send_from_directory, abort
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST = 'dist'
+MANIFEST_NAME = 'asset-manifest.json'
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# Built in this order so the PWA manifest can point at the hashed icons
+SOURCES = ['css/style.css', 'js/app.js', 'icons/*.png', 'icons/*.svg', 'manifest.json']
+COMPRESSIBLE = ('.css', '.js', '.json', '.svg')
+# (suffix, Content-Encoding), best first
+ENCODINGS = [('.br', 'br'), ('.gz', 'gzip')]
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Minification, kept conservative: nothing that needs a real parser
+
+def minify_css(text):
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    # Spaces before ':' are kept: '.a :hover' and '.a:hover' are different selectors
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    return text.replace(';}', '}').strip() + '\n'
+
+def minify_js(text):
+    """Drop indentation, blank lines and whole-line // comments outside template literals"""
+    lines, in_template = [], False
+    for line in text.splitlines():
+        if in_template:
+            lines.append(line)
+        else:
+            stripped = line.strip()
+            if stripped and not stripped.startswith('//'):
+                lines.append(stripped)
+        # Line breaks are kept, so automatic semicolon insertion is unaffected
+        if (line.count('`') - line.count('\\`')) % 2:
+            in_template = not in_template
+    return '\n'.join(lines) + '\n'
+
+def fingerprint(data):
+    return hashlib.sha256(data).hexdigest()[:10]
+
+def hashed_name(name, data):
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{fingerprint(data)}{ext}"
+
+def _sources(static_dir):
+    import glob
+    names = []
+    for pattern in SOURCES:
+        matches = sorted(glob.glob(os.path.join(static_dir, pattern)))
+        names.extend(os.path.relpath(path, static_dir).replace(os.sep, '/') for path in matches)
+    return names
+
+def _write(out_dir, name, data):
+    """Write a file and its compressed variants, each replaced in one step"""
+    path = os.path.join(out_dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    variants = [('', data)]
+    if name.endswith(COMPRESSIBLE):
+        # mtime=0 keeps rebuilds of unchanged files byte-identical
+        variants.append(('.gz', gzip.compress(data, 9, mtime=0)))
+        if brotli is not None:
+            variants.append(('.br', brotli.compress(data)))
+    written = []
+    for suffix, content in variants:
+        with open(path + suffix + '.tmp', 'wb') as f:
+            f.write(content)
+        os.replace(path + suffix + '.tmp', path + suffix)
+        written.append(name + suffix)
+    return written
+
+def _rewrite_pwa_manifest(data, assets):
+    manifest = json.loads(data)
+    def rewrite(entry):
+        src = entry.get('src', '')
+        if src.startswith('/static/') and src[len('/static/'):] in assets:
+            entry['src'] = f"/static/{DIST}/{assets[src[len('/static/'):]]}"
+    for icon in manifest.get('icons', []):
+        rewrite(icon)
+    for shortcut in manifest.get('shortcuts', []):
+        for icon in shortcut.get('icons', []):
+            rewrite(icon)
+    return json.dumps(manifest, separators=(',', ':')).encode('utf-8')
+
+def _service_worker(static_dir, assets, version):
+    """static/sw.js with its cache name and the local entries of its precache list replaced"""
+    with open(os.path.join(static_dir, 'sw.js'), encoding='utf-8') as f:
+        source = f.read()
+    match = re.search(r'const urlsToCache = \[(.*?)\];', source, re.S)
+    if match is None:
+        raise ValueError("static/sw.js has no 'const urlsToCache = [...]' list")
+    kept = [url for url in re.findall(r"'([^']*)'", match.group(1)) if not url.startswith('/static/')]
+    # The SVG icons are not referenced by any page, so they are not worth a precache slot
+    built = [f"/static/{DIST}/{hashed}" for name, hashed in assets.items() if not name.endswith('.svg')]
+    urls = kept[:1] + built + kept[1:]
+    listing = ',\n'.join(f"    {json.dumps(url)}" for url in urls)
+    source = source.replace(match.group(0), f"const urlsToCache = [\n{listing}\n];")
+    source, replaced = re.subn(r"const CACHE_NAME = '[^']*';", f"const CACHE_NAME = 'expense-manager-{version}';", source)
+    if not replaced:
+        raise ValueError("static/sw.js has no CACHE_NAME")
+    return source.encode('utf-8')
+
+def build(static_dir=STATIC_DIR, clean=False):
+    """Build into static/dist; returns the manifest
+
+    Hashed files from earlier builds are left in place, so pages rendered by
+    workers still running the previous build keep working; ``clean`` removes
+    them.
+    """
+    out_dir = os.path.join(static_dir, DIST)
+    assets, written = {}, set()
+    for name in _sources(static_dir):
+        with open(os.path.join(static_dir, name), 'rb') as f:
+            data = f.read()
+        if name.endswith('.css'):
+            data = minify_css(data.decode('utf-8')).encode('utf-8')
+        elif name.endswith('.js'):
+            data = minify_js(data.decode('utf-8')).encode('utf-8')
+        elif name == 'manifest.json':
+            data = _rewrite_pwa_manifest(data, assets)
+        assets[name] = hashed_name(name, data)
+        written.update(_write(out_dir, assets[name], data))
+    version = fingerprint(json.dumps(assets, sort_keys=True).encode('utf-8'))
+    written.update(_write(out_dir, 'sw.js', _service_worker(static_dir, assets, version)))
+    manifest = {'version': version, 'assets': assets}
+    # Written last: a build is only picked up once all of its files exist
+    written.update(_write(out_dir, MANIFEST_NAME, json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8')))
+    if clean:
+        for root, _, files in os.walk(out_dir):
+            for filename in files:
+                path = os.path.join(root, filename)
+                if os.path.relpath(path, out_dir).replace(os.sep, '/') not in written:
+                    os.remove(path)
+    return manifest
+
+def load_manifest(static_dir=STATIC_DIR):
+    try:
+        with open(os.path.join(static_dir, DIST, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def is_stale(static_dir=STATIC_DIR):
+    """True if the build is missing or older than any source file"""
+    path = os.path.join(static_dir, DIST, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return True
+    built = os.path.getmtime(path)
+    sources = [os.path.join(static_dir, name) for name in _sources(static_dir) + ['sw.js']]
+    return any(os.path.getmtime(source) > built for source in sources)
+
+def _send(directory, filename, cache_control):
+    """Send a file, or its best precompressed variant the client accepts"""
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    accepted = request.accept_encodings
+    for suffix, encoding in ENCODINGS:
+        if accepted[encoding] and os.path.isfile(os.path.join(directory, filename + suffix)):
+            response = send_from_directory(directory, filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(directory, filename, mimetype=mimetype)
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def init_app(app):
+    """Point url_for('static') at the built assets and serve them"""
+    static_dir = app.static_folder
+    dist_dir = os.path.join(static_dir, DIST)
+    manifest = load_manifest(static_dir)
+    assets = manifest['assets'] if manifest else {}
+    if manifest:
+        print(f"📦 Serving {len(assets)} fingerprinted assets (build {manifest['version']})")
+        if is_stale(static_dir):
+            print("⚠️ Static files changed since the last build; run python assets.py")
+    else:
+        print("ℹ️ No static asset build found; serving unversioned files (run python assets.py)")
+
+    @app.url_defaults
+    def fingerprinted_static(endpoint, values):
+        if endpoint == 'static' and values.get('filename') in assets:
+            values['filename'] = f"{DIST}/{assets[values['filename']]}"
+
+    @app.route(f"/static/{DIST}/<path:filename>")
+    def fingerprinted_asset(filename):
+        # Unhashed build files are not to be cached like the others
+        if filename.startswith((MANIFEST_NAME, 'sw.js')):
+            abort(404)
+        # The content hash is in the name, so a URL never changes meaning
+        return _send(dist_dir, filename, f"public, max-age={IMMUTABLE_MAX_AGE}, immutable")
+
+    # Registered from app.js at this URL; it must stay unversioned and be revalidated
+    @app.route('/static/sw.js')
+    def service_worker():
+        directory = dist_dir if manifest else static_dir
+        return _send(directory, 'sw.js', 'no-cache')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--static-dir', default=STATIC_DIR, help='static folder to build (default: ./static)')
+    parser.add_argument('--check', action='store_true', help='only report whether the build is missing or stale')
+    parser.add_argument('--clean', action='store_true', help='remove files left by earlier builds')
+    args = parser.parse_args(argv)
+
+    if args.check:
+        if is_stale(args.static_dir):
+            print("❌ static/dist is missing or older than the sources; run python assets.py")
+            return 1
+        print("✅ static/dist is up to date")
+        return 0
+
+    manifest = build(args.static_dir, clean=args.clean)
+    compression = 'gzip and brotli' if brotli is not None else 'gzip'
+    print(f"📦 Built {len(manifest['assets'])} assets ({compression}), version {manifest['version']}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+import asyncio
+from functools import wraps
+from datetime import datetime
+from flask import render_template, redirect, url_for, flash, jsonify, request
+from flask_login import login_required, current_user
+from firebase_db import FirebaseUser, FirebaseExpense, FirebaseSavingsGoal
+from analytics import dashboard_summary, chart_payload, calculate_total_expenses
+from suggestions import suggestion_engine
+from report_index import get_index, range_report, parse_report_args, monthly_chart
+from spending_stats import spending_insights
+from fragment_cache import fragment_cache, ALL_USERS
+from admission import BackendUnavailable
+from firebase_config import async_session
+
+# Async versions of the I/O-heavy views. Independent Firebase reads within a
+# request are issued concurrently instead of one after another.
+
+async def dashboard():
+    user_id = current_user.get_id()
+    fragments = fragment_cache.scope(ALL_USERS if current_user.is_admin else user_id,
+                                     user_id, datetime.now().strftime('%Y-%m'))
+    insights = [] if current_user.is_admin else await asyncio.to_thread(spending_insights, user_id)
+    if fragments.has('dashboard.summary', 'dashboard.recent'):
+        return render_template('dashboard.html', fragments=fragments, insights=insights)
+
+    if current_user.is_admin:
+        expenses, archived, total_users, savings_goal = await asyncio.gather(
+            FirebaseExpense.get_all_expenses_async(include_archived=False),
+            FirebaseExpense.archived_summary_async(),
+            FirebaseUser.count_async(),
+            FirebaseSavingsGoal.get_by_user_id_async(user_id),
+        )
+    else:
+        expenses, archived, savings_goal = await asyncio.gather(
+            FirebaseExpense.get_by_user_id_async(user_id, include_archived=False),
+            FirebaseExpense.archived_summary_async(user_id),
+            FirebaseSavingsGoal.get_by_user_id_async(user_id),
+        )
+        total_users = None
+
+    recent_expenses = expenses[:5]
+    if len(recent_expenses) < 5 and archived['count']:
+        recent_expenses = await (FirebaseExpense.get_all_expenses_async(limit=5) if current_user.is_admin
+                                 else FirebaseExpense.get_by_user_id_async(user_id, limit=5))
+
+    if not savings_goal:
+        savings_goal = await FirebaseSavingsGoal.create_goal_async(user_id)
+
+    return render_template('dashboard.html',
+                         fragments=fragments,
+                         insights=insights,
+                         recent_expenses=recent_expenses,
+                         total_users=total_users,
+                         savings_goal=savings_goal,
+                         **dashboard_summary(expenses, current_user.monthly_income, archived=archived))
+
+async def chart_data():
+    chart_type = request.args.get('type', 'category')
+
+    try:
+        if chart_type == 'monthly':
+            index = await asyncio.to_thread(get_index, current_user.get_id(), current_user.is_admin)
+            return jsonify(monthly_chart(index, datetime.now().year))
+
+        user_id = None if current_user.is_admin else current_user.get_id()
+        if current_user.is_admin:
+            expenses_read = FirebaseExpense.get_all_expenses_async(include_archived=False)
+        else:
+            expenses_read = FirebaseExpense.get_by_user_id_async(user_id, include_archived=False)
+        expenses, archived = await asyncio.gather(expenses_read, FirebaseExpense.archived_summary_async(user_id))
+
+        payload = chart_payload(expenses, chart_type, archived=archived)
+        if payload is None:
+            return jsonify({'error': 'Invalid chart type'}), 400
+        return jsonify(payload)
+
+    except BackendUnavailable:
+        raise
+    except Exception as e:
+        print(f"Chart data error: {str(e)}")
+        return jsonify({
+            'labels': ['Error loading data'],
+            'data': [0],
+            'error': str(e)
+        }), 500
+
+async def reports_data():
+    try:
+        options = parse_report_args(request.args)
+        # Building a cold index reads through the sync data layer
+        index = await asyncio.to_thread(get_index, current_user.get_id(), current_user.is_admin)
+        return jsonify(range_report(index, **options))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+async def admin():
+    if not current_user.is_admin:
+        flash('Access denied. Admin only.')
+        return redirect(url_for('dashboard'))
+
+    fragments = fragment_cache.scope(ALL_USERS, current_user.get_id())
+    if fragments.has('admin.stats', 'admin.users', 'admin.user_scripts'):
+        return render_template('admin.html', fragments=fragments)
+
+    users, all_expenses, archived = await asyncio.gather(
+        FirebaseUser.get_all_users_async(),
+        FirebaseExpense.get_all_expenses_async(include_archived=False),
+        FirebaseExpense.archived_summary_async(),
+    )
+
+    return render_template('admin.html', fragments=fragments, users=users,
+                           total_expenses=calculate_total_expenses(all_expenses) + archived['total'],
+                           total_users=len(users))
+
+async def savings_suggestions():
+    # A cache hit is a dict lookup, but a cold user waits for the engine's pool
+    suggestions = await asyncio.to_thread(suggestion_engine.get, current_user.get_id())
+    return jsonify({'suggestions': suggestions})
+
+async def user_expenses(user_id):
+    # Only admin can access other users' data
+    if not current_user.is_admin and user_id != current_user.get_id():
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    user_expenses_list, archived = await asyncio.gather(
+        FirebaseExpense.get_by_user_id_async(user_id, include_archived=False),
+        FirebaseExpense.archived_summary_async(user_id),
+    )
+    return jsonify({'total_expenses': calculate_total_expenses(user_expenses_list) + archived['total']})
+
+ASYNC_VIEWS = {
+    'dashboard': dashboard,
+    'chart_data': chart_data,
+    'reports_data': reports_data,
+    'admin': admin,
+    'savings_suggestions': savings_suggestions,
+    'user_expenses': user_expenses,
+}
+
+def register_async_views(app):
+    """Swap the sync implementations of the heavy endpoints for the async ones.
+
+    Requires ``flask[async]`` (asgiref) and httpx.
+    """
+    for endpoint, view in ASYNC_VIEWS.items():
+        app.view_functions[endpoint] = login_required(in_session(view))
+
+def in_session(view):
+    """Run the view inside one Firebase client session, closed when it returns"""
+    @wraps(view)
+    async def wrapper(*args, **kwargs):
+        async with async_session():
+            return await view(*args, **kwargs)
+    return wrapper
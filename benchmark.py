@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Data-layer micro-benchmarks for Expense Manager.
+
+Generates a seeded synthetic dataset, loads it into the selected backend and
+times the hot data-layer paths: expense queries, chart aggregation, savings
+suggestions and the export views. Reports throughput, latency percentiles and
+peak memory per operation, and can save or compare against a baseline file.
+
+    python benchmark.py --profile small
+    python benchmark.py --profile medium --save-baseline
+    python benchmark.py --profile medium --compare
+    python benchmark.py --backend rest --database-url http://127.0.0.1:9000
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import contextlib
+from datetime import date
+
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+def measure(fn, iterations, warmup):
+    """Time ``fn`` and return a result dict (latencies in milliseconds)"""
+    quiet = io.StringIO()
+    with contextlib.redirect_stdout(quiet):
+        for _ in range(warmup):
+            fn()
+
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(iterations):
+            t0 = time.perf_counter()
+            fn()
+            latencies.append((time.perf_counter() - t0) * 1000.0)
+        elapsed = time.perf_counter() - started
+
+        # Peak memory is measured on a separate call; tracemalloc slows everything down
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'ops_per_sec': iterations / elapsed if elapsed > 0 else 0.0,
+        'mean_ms': sum(latencies) / len(latencies),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': latencies[-1],
+        'peak_mem_mb': peak / (1024 * 1024),
+    }
+
+def build_operations(user_id, admin_id):
+    """Return (name, callable) pairs for every benchmarked operation"""
+    from app import app
+    from firebase_db import FirebaseExpense, FirebaseSavingsGoal, FirebaseUser
+    from analytics import chart_payload, savings_suggestions
+
+    user = FirebaseUser.get_by_id(user_id)
+    cached_expenses = FirebaseExpense.get_by_user_id(user_id)
+    # Filter on the most recent year with data
+    latest_year = int(cached_expenses[0].date[:4]) if cached_expenses else date.today().year
+    year_start = date(latest_year, 1, 1)
+    year_end = date(latest_year, 12, 31)
+
+    def client_for(uid):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['_user_id'] = uid
+            sess['_fresh'] = True
+        return client
+
+    user_client = client_for(user_id)
+    admin_client = client_for(admin_id)
+
+    def get(client, url):
+        def call():
+            response = client.get(url)
+            assert response.status_code == 200, f"{url} returned {response.status_code}"
+            return response
+        return call
+
+    return [
+        ('get_by_user_id', lambda: FirebaseExpense.get_by_user_id(user_id)),
+        ('get_by_user_id[limit=5]', lambda: FirebaseExpense.get_by_user_id(user_id, limit=5)),
+        ('get_all_expenses', lambda: FirebaseExpense.get_all_expenses()),
+        ('get_filtered_expenses[category+year]', lambda: FirebaseExpense.get_filtered_expenses(
+            user_id=user_id, category='Food', start_date=year_start, end_date=year_end)),
+        ('get_filtered_expenses[admin,type]', lambda: FirebaseExpense.get_filtered_expenses(
+            expense_type='unwanted', is_admin=True)),
+        ('savings_goal.get_by_user_id', lambda: FirebaseSavingsGoal.get_by_user_id(user_id)),
+        ('aggregate[category]', lambda: chart_payload(cached_expenses, 'category')),
+        ('aggregate[monthly]', lambda: chart_payload(cached_expenses, 'monthly')),
+        ('aggregate[expense_type]', lambda: chart_payload(cached_expenses, 'expense_type')),
+        ('aggregate[savings_suggestions]', lambda: savings_suggestions(cached_expenses, user.monthly_income, None)),
+        ('GET /api/chart_data?type=monthly', get(user_client, '/api/chart_data?type=monthly')),
+        ('GET /api/reports[all,week,category]', get(user_client, '/api/reports?granularity=week&split=category')),
+        ('GET /api/reports[admin,all,month,type]', get(admin_client, '/api/reports?granularity=month&split=type')),
+        ('GET /api/savings_suggestions', get(user_client, '/api/savings_suggestions')),
+        ('GET /dashboard', get(user_client, '/dashboard')),
+        ('GET /export_expenses', get(user_client, '/export_expenses')),
+        ('GET /export_user_data_csv', get(user_client, '/export_user_data_csv')),
+        ('GET /export_user_data_json', get(user_client, '/export_user_data_json')),
+        ('GET /export_expenses[admin]', get(admin_client, '/export_expenses')),
+    ]
+
+def compare(results, baseline, tolerance):
+    """Print a comparison against ``baseline``; return the names that regressed"""
+    regressions = []
+    print(f"\n{'operation':<40} {'base p50':>10} {'now p50':>10} {'change':>9}")
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            print(f"{name:<40} {'-':>10} {result['p50_ms']:>10.2f} {'new':>9}")
+            continue
+        change = (result['p50_ms'] - base['p50_ms']) / base['p50_ms'] if base['p50_ms'] else 0.0
+        marker = ''
+        if change > tolerance:
+            marker = ' ⚠️'
+            regressions.append(name)
+        print(f"{name:<40} {base['p50_ms']:>10.2f} {result['p50_ms']:>10.2f} {change:>+8.1%}{marker}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profile', choices=['small', 'medium', 'large'], default='small',
+                        help='dataset size preset (large = 1k users / 1M expenses)')
+    parser.add_argument('--users', type=int, help='override number of users')
+    parser.add_argument('--expenses', type=int, help='override number of expenses')
+    parser.add_argument('--years', type=int, default=3, help='years of history to generate')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--backend', choices=['mock', 'rest'], default='mock')
+    parser.add_argument('--database-url', help='REST backend URL, e.g. a local emulator')
+    parser.add_argument('--skip-load', action='store_true', help='benchmark the data already in the backend')
+    parser.add_argument('--ops', help='comma-separated substrings selecting operations to run')
+    parser.add_argument('--save-baseline', nargs='?', const=DEFAULT_BASELINE, help='write results as the new baseline')
+    parser.add_argument('--compare', nargs='?', const=DEFAULT_BASELINE, help='compare against a baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='allowed p50 slowdown before flagging (0.10 = 10%%)')
+    parser.add_argument('--json', help='also write raw results to this file')
+    args = parser.parse_args(argv)
+
+    # Backend selection must happen before the database is first used
+    os.environ['FIREBASE_BACKEND'] = args.backend
+    os.environ.setdefault('PASSWORD_HASH_WORKERS', '0')
+    import firebase_config
+    if args.database_url:
+        firebase_config.FIREBASE_CONFIG['databaseURL'] = args.database_url
+    from synthetic_data import PROFILES, generate_dataset, load_dataset
+
+    sizes = dict(PROFILES[args.profile])
+    if args.users:
+        sizes['users'] = args.users
+    if args.expenses:
+        sizes['expenses'] = args.expenses
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        db = firebase_config.database.resolve()
+    if args.skip_load:
+        users = (db.child('users').get().val() or {})
+        expenses = (db.child('expenses').get().val() or {})
+        print(f"📦 Using existing data: {len(users)} users, {len(expenses)} expenses")
+    else:
+        print(f"🧪 Generating {sizes['users']} users / {sizes['expenses']} expenses over {args.years} years (seed {args.seed})...")
+        t0 = time.perf_counter()
+        dataset = generate_dataset(sizes['users'], sizes['expenses'], args.years, args.seed)
+        print(f"   generated in {time.perf_counter() - t0:.1f}s")
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            load_dataset(db, dataset)
+        print(f"   loaded in {time.perf_counter() - t0:.1f}s")
+        users = dataset['users']
+        expenses = dataset['expenses']
+
+    if not users:
+        print("❌ No users in the backend")
+        return 1
+
+    # Benchmark the busiest user, which is the worst case for per-user paths
+    counts = {}
+    for record in expenses.values():
+        counts[record.get('user_id')] = counts.get(record.get('user_id'), 0) + 1
+    user_id = max(users, key=lambda uid: counts.get(uid, 0))
+    admin_id = next((uid for uid, u in users.items() if u.get('is_admin')), user_id)
+    print(f"👤 Benchmark user has {counts.get(user_id, 0)} expenses\n")
+
+    selected = [s.strip() for s in args.ops.split(',')] if args.ops else None
+    results = {}
+    print(f"{'operation':<40} {'ops/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak MB':>8}")
+    for name, fn in build_operations(user_id, admin_id):
+        if selected and not any(s in name for s in selected):
+            continue
+        result = measure(fn, args.iterations, args.warmup)
+        results[name] = result
+        print(f"{name:<40} {result['ops_per_sec']:>9.1f} {result['p50_ms']:>9.2f} "
+              f"{result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f} {result['peak_mem_mb']:>8.1f}")
+
+    report = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'backend': args.backend,
+        'dataset': {**sizes, 'years': args.years, 'seed': args.seed},
+        'results': results,
+    }
+
+    exit_code = 0
+    if args.compare:
+        if not os.path.exists(args.compare):
+            print(f"\n❌ Baseline {args.compare} not found; run with --save-baseline first")
+            exit_code = 1
+        else:
+            with open(args.compare) as f:
+                baseline = json.load(f)
+            if baseline.get('dataset') != report['dataset']:
+                print("\n⚠️  Baseline was recorded with a different dataset; comparison is approximate")
+            regressions = compare(results, baseline, args.tolerance)
+            if regressions:
+                print(f"\n❌ {len(regressions)} operation(s) regressed beyond {args.tolerance:.0%}")
+                exit_code = 1
+            else:
+                print("\n✅ No regressions")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\n💾 Baseline saved to {args.save_baseline}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return exit_code
+
+if __name__ == '__main__':
+    sys.exit(main())
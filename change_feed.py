@@ -0,0 +1,204 @@
+"""
+Per-user change log, for delta sync.
+
+Every write reported by firebase_db's change hook is appended to
+``change_log/<user_id>/entries/<seq>`` on the user's shard, with ``seq``
+counting up from 1 per user. An expense entry carries the record as written
+(or null when it was deleted); profile and savings goal entries only say that
+the record changed. Bulk writes append a ``reset`` entry: the client should
+refetch that collection.
+
+A slot is claimed with a conditional PUT that only succeeds while the slot is
+empty, so two workers appending for the same user never share a number and
+the log has no holes. ``head/seq`` is a hint where to start looking for the
+next free slot. Appends run on one background thread per worker, in the
+order the writes happened, so they add no latency to the request. Queued
+appends still run when a worker shuts down normally; a worker killed outright
+loses them, so clients should still fetch everything now and then.
+
+Once a user's log is longer than ``CHANGE_LOG_KEEP`` entries by
+``CHANGE_LOG_COMPACT_EVERY``, the oldest entries are deleted and
+``head/floor`` records the last one removed; a client whose token is older
+than the floor is told to refetch everything. If an append fails, the next
+append for that user writes a full reset first.
+
+``changes_since`` turns a client's token into the entries written since and a
+new token; /api/v1/sync (api_v1.py) serves them.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from sharding import shard_map
+from firebase_db import on_user_data_change
+
+CHANGE_FEED = os.environ.get('CHANGE_FEED', '1') == '1'
+CHANGE_LOG_KEEP = int(os.environ.get('CHANGE_LOG_KEEP', 1000))
+CHANGE_LOG_COMPACT_EVERY = int(os.environ.get('CHANGE_LOG_COMPACT_EVERY', 100))
+LOG_NODE = 'change_log'
+# Collections a client keeps, by the firebase_db change kind they follow
+COLLECTIONS = {'expenses': 'expenses', 'savings_goal': 'goal', 'profile': 'profile'}
+ALL = '*'
+
+def _key(seq):
+    # Zero-padded so the database lists entries in order
+    return f"{seq:012d}"
+
+def _log(database, user_id):
+    return database.child(LOG_NODE).child(user_id)
+
+def entry_for(kind, change):
+    if kind != 'expenses':
+        # One record per user; the client reads it again
+        return {'kind': kind}
+    if change is None:
+        return {'kind': kind, 'reset': True}
+    # Copied: the caller may go on changing its dict after the hook returns
+    return {'kind': kind, 'id': change['id'], 'data': dict(change['data']) if change['data'] else None}
+
+class ChangeFeed:
+    """Appends write notifications to the users' change logs, off the request path"""
+
+    def __init__(self, enabled=CHANGE_FEED, keep=CHANGE_LOG_KEEP, compact_every=CHANGE_LOG_COMPACT_EVERY):
+        self.enabled = enabled
+        self.keep = keep
+        self.compact_every = compact_every
+        self._null_etag = None   # ETag of an empty slot, learned from the first one read
+        self._dirty = set()      # users whose last append failed
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                # One thread, so entries are appended in the order the writes happened
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='change-feed')
+            return self._executor
+
+    def record(self, user_id, kind, change=None):
+        """Write hook: queue an entry for the user's log"""
+        if not self.enabled or kind not in COLLECTIONS:
+            return
+        self._pool().submit(self._append_safely, user_id, entry_for(kind, change))
+
+    def flush(self):
+        """Wait until every queued entry has been appended"""
+        if self._executor is not None:
+            self._pool().submit(lambda: None).result()
+
+    def _append_safely(self, user_id, entry):
+        try:
+            with self._lock:
+                dirty = user_id in self._dirty
+            if dirty:
+                self.append(user_id, {'kind': ALL, 'reset': True})
+                with self._lock:
+                    self._dirty.discard(user_id)
+            self.append(user_id, entry)
+            metrics.CHANGE_FEED_APPENDS.inc(outcome='appended')
+        except Exception as e:
+            with self._lock:
+                self._dirty.add(user_id)
+            metrics.CHANGE_FEED_APPENDS.inc(outcome='failed')
+            print(f"⚠️ Change log append for {user_id} failed: {e}")
+
+    def _claim(self, slot, entry):
+        """Write ``entry`` into ``slot`` if it is empty; False if it was taken"""
+        for attempt in range(2):
+            etag = self._null_etag
+            if etag is None:
+                current, etag = slot.get_with_etag()
+                if current.val() is not None:
+                    return False
+                self._null_etag = etag
+            ok, current, _ = slot.set_if_unchanged(etag, entry)
+            if ok:
+                return True
+            if current is None:
+                raise RuntimeError(f"writing {slot.path} failed")
+            if current.val() is not None:
+                return False
+            # The slot is empty but its ETag is not the one we remembered
+            self._null_etag = None
+        raise RuntimeError(f"cannot claim empty slot {slot.path}")
+
+    def append(self, user_id, entry):
+        """Append one entry; returns its sequence number"""
+        log = _log(shard_map.shard_for_write(user_id).database, user_id)
+        head = log.child('head').get().val() or {}
+        seq = max(head.get('seq', 0), head.get('floor', 0)) + 1
+        entries = log.child('entries')
+        while not self._claim(entries.child(_key(seq)), entry):
+            seq += 1
+        log.child('head').child('seq').set(seq)
+        if seq % self.compact_every == 0 and seq - head.get('floor', 0) > self.keep + self.compact_every:
+            self.compact(log, seq, head.get('floor', 0))
+        return seq
+
+    def compact(self, log, seq, floor):
+        """Drop the entries older than the newest ``keep``, in one update"""
+        new_floor = seq - self.keep
+        paths = {f"entries/{_key(n)}": None for n in range(floor + 1, new_floor + 1)}
+        paths['head/floor'] = new_floor
+        if log.update(paths):
+            print(f"🧹 Compacted change log {log.path}: entries up to {new_floor} removed")
+
+    def delete_user(self, user_id):
+        self.flush()
+        _log(shard_map.shard_for_write(user_id).database, user_id).delete()
+
+    def _after_fork(self):
+        # The thread and anything queued on it stay with the parent
+        self._lock = threading.Lock()
+        self._executor = None
+
+def _read_after(entries, seq):
+    """(last seq, [entries]) of the run of claimed slots after ``seq``, read in one key-range query"""
+    batch = entries.get_from_key(_key(seq + 1)).val() or {}
+    found = []
+    # Slots are claimed in order, so the first missing one is the end
+    while _key(seq + 1) in batch:
+        seq += 1
+        found.append(batch[_key(seq)])
+    return seq, found
+
+def changes_since(user_id, since):
+    """(new token, [entries after ``since`` in order], reset) for a client holding token ``since``.
+
+    ``reset`` is a set of collections the client must refetch in full, or
+    None when the log no longer reaches back to ``since`` and it must refetch
+    everything. ``since`` None asks for the current token only.
+
+    Only ``head`` and the entries after the token are read, so a client that
+    is up to date costs two small reads.
+    """
+    log = _log(shard_map.shard_for(user_id).database, user_id)
+    head = log.child('head').get().val() or {}
+    floor = head.get('floor', 0)
+    known = max(head.get('seq', 0), floor)
+    entries = log.child('entries')
+    if since is not None and since >= floor:
+        # head/seq can trail the last claimed slot; then the token's own entry shows it was written
+        after = since if since <= known else since - 1
+        seq, found = _read_after(entries, after)
+        if after == since or found:
+            return _delta(seq, found if after == since else found[1:])
+    # No token yet, compacted past it, or the log was lost (a user moved without it)
+    metrics.SYNC_REQUESTS.inc(result='reset')
+    return _read_after(entries, known)[0], [], None
+
+def _delta(seq, found):
+    reset = set()
+    for entry in found:
+        if entry.get('reset'):
+            if entry['kind'] == ALL:
+                metrics.SYNC_REQUESTS.inc(result='reset')
+                return seq, [], None
+            reset.add(COLLECTIONS.get(entry['kind'], entry['kind']))
+    metrics.SYNC_REQUESTS.inc(result='delta')
+    return seq, found, reset
+
+change_feed = ChangeFeed()
+on_user_data_change(change_feed.record)
+os.register_at_fork(after_in_child=change_feed._after_fork)
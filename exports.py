@@ -0,0 +1,29 @@
+from datetime import datetime
+
+EXPENSE_HEADERS = ['Expense ID', 'Amount', 'Category', 'Description', 'Type', 'Date', 'Created At']
+
+def expense_csv_headers(include_user=False):
+    return (['User ID'] if include_user else []) + EXPENSE_HEADERS
+
+def expense_csv_row(expense, include_user=False):
+    row = [
+        expense.id,
+        expense.amount,
+        expense.category,
+        expense.description or '',
+        expense.expense_type,
+        datetime.fromisoformat(expense.date.replace('Z', '+00:00')).strftime('%Y-%m-%d'),
+        datetime.fromisoformat(expense.created_at.replace('Z', '+00:00')).strftime('%Y-%m-%d %H:%M:%S')
+    ]
+    return [expense.user_id] + row if include_user else row
+
+def write_expenses_csv(writer, expenses, include_user=False, progress=None, every=1000):
+    """Write the expense export (header + rows); ``progress(done, total)`` is
+    called every ``every`` rows and at the end"""
+    writer.writerow(expense_csv_headers(include_user))
+    total = len(expenses)
+    for done, expense in enumerate(expenses, 1):
+        writer.writerow(expense_csv_row(expense, include_user))
+        if progress and (done % every == 0 or done == total):
+            progress(done, total)
+    return total
@@ -1,8 +1,18 @@
 import os
+import asyncio
+import hashlib
+import contextlib
+import contextvars
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 import json
-import firebase_admin
-from firebase_admin import credentials, db
+import time
+import metrics
+import profiling
+import admission
+import retries
+from admission import BackendUnavailable
 
 # Firebase configuration using your app config
 FIREBASE_CONFIG = {
@@ -15,6 +25,61 @@ FIREBASE_CONFIG = {
     "appId": "1:976505529382:web:8595b4ed5a588c334932e7"
 }
 
+# Point the app at another database, e.g. the local emulator (firebase_emulator.py)
+if os.environ.get('FIREBASE_DATABASE_URL'):
+    FIREBASE_CONFIG['databaseURL'] = os.environ['FIREBASE_DATABASE_URL']
+
+# Pooled HTTP session, one per process
+HTTP_POOL_SIZE = int(os.environ.get('FIREBASE_HTTP_POOL_SIZE', 10))
+# Seconds to wait for a response; connecting gets a shorter limit
+FIREBASE_TIMEOUT = float(os.environ.get('FIREBASE_TIMEOUT', 10))
+FIREBASE_CONNECT_TIMEOUT = min(3.05, FIREBASE_TIMEOUT)
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """Get this process's pooled requests session, creating it on first use"""
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _http_session = session
+    return _http_session
+
+def reset_http_session():
+    """Forget the session inherited from a parent process.
+
+    The parent still owns those sockets, so they are dropped rather than closed.
+    """
+    global _http_session, _http_session_lock
+    _http_session = None
+    _http_session_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=reset_http_session)
+
+def _observe(backend, op, path, started, **kwargs):
+    """Report a finished database operation to metrics and the active trace"""
+    seconds = time.perf_counter() - started
+    metrics.observe_db_operation(backend, op, path, seconds, **kwargs)
+    profiling.record_span(f"db.{op}", seconds, backend=backend, path=path)
+
+def _read_failed(error, fallback):
+    """What a failed read returns: ``fallback`` for a 4xx answer, BackendUnavailable otherwise.
+
+    An empty snapshot would read as "no data", so an unreachable or failing
+    backend is reported instead.
+    """
+    if isinstance(error, BackendUnavailable):
+        raise error
+    status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status is not None and 400 <= status < 500:
+        return fallback
+    raise BackendUnavailable(f"Database read failed: {error}") from error
+
 # Firebase REST API Database class
 class FirebaseRESTDatabase:
     """Firebase Realtime Database using REST API - no auth required for public databases"""
@@ -27,38 +92,129 @@ class FirebaseRESTDatabase:
         new_path = f"{self.path}/{path}" if self.path else path
         return FirebaseRESTDatabase(self.base_url, new_path)
     
+    def _url(self):
+        return f"{self.base_url}/{self.path}.json" if self.path else f"{self.base_url}/.json"
+    
+    def _send(self, method, **kwargs):
+        """One HTTP request, admitted by this database's gate (see admission.py)"""
+        return admission.gate(self.base_url).call(lambda: get_http_session().request(
+            method, self._url(), timeout=(FIREBASE_CONNECT_TIMEOUT, FIREBASE_TIMEOUT), **kwargs))
+    
+    def _read(self, **kwargs):
+        """A GET, retried and hedged (see retries.py)"""
+        return retries.policy(self.base_url).read(lambda: self._send('GET', **kwargs))
+    
     def get(self):
+        started = time.perf_counter()
+        received = 0
         try:
-            url = f"{self.base_url}/{self.path}.json" if self.path else f"{self.base_url}/.json"
-            response = requests.get(url, timeout=10)
+            response = self._read()
+            received = len(response.content)
             response.raise_for_status()
             data = response.json()
+            _observe('rest', 'get', self.path, started, received=received)
             return FirebaseSnapshot(data)
         except Exception as e:
+            _observe('rest', 'get', self.path, started, received=received, error=True)
+            print(f"Firebase GET error: {e}")
+            return _read_failed(e, FirebaseSnapshot(None))
+    
+    def get_from_key(self, start_key):
+        """The children whose key sorts at or after ``start_key``, in one key-range query"""
+        started = time.perf_counter()
+        received = 0
+        try:
+            response = self._read(params={'orderBy': '"$key"', 'startAt': json.dumps(start_key)})
+            received = len(response.content)
+            response.raise_for_status()
+            _observe('rest', 'get', self.path, started, received=received)
+            return FirebaseSnapshot(response.json())
+        except Exception as e:
+            _observe('rest', 'get', self.path, started, received=received, error=True)
             print(f"Firebase GET error: {e}")
-            return FirebaseSnapshot(None)
+            return _read_failed(e, FirebaseSnapshot(None))
     
     def set(self, data):
+        started = time.perf_counter()
+        body = json.dumps(data).encode()
         try:
-            url = f"{self.base_url}/{self.path}.json" if self.path else f"{self.base_url}/.json"
-            response = requests.put(url, json=data, timeout=10)
+            response = self._send('PUT', data=body, headers={'Content-Type': 'application/json'})
             response.raise_for_status()
-            print(f"Firebase SET success at {self.path}")
+            _observe('rest', 'set', self.path, started, sent=len(body), received=len(response.content))
             return True
         except Exception as e:
+            _observe('rest', 'set', self.path, started, sent=len(body), error=True)
+            if isinstance(e, BackendUnavailable):
+                raise
             print(f"Firebase SET error at {self.path}: {e}")
             return False
     
     def delete(self):
+        started = time.perf_counter()
         try:
-            url = f"{self.base_url}/{self.path}.json" if self.path else f"{self.base_url}/.json"
-            response = requests.delete(url, timeout=10)
+            response = self._send('DELETE')
             response.raise_for_status()
-            print(f"Firebase DELETE success at {self.path}")
+            _observe('rest', 'delete', self.path, started)
             return True
         except Exception as e:
+            _observe('rest', 'delete', self.path, started, error=True)
+            if isinstance(e, BackendUnavailable):
+                raise
             print(f"Firebase DELETE error at {self.path}: {e}")
             return False
+    
+    def update(self, data):
+        """Multi-path PATCH: keys are paths relative to this node, None deletes"""
+        started = time.perf_counter()
+        body = json.dumps(data).encode()
+        try:
+            response = self._send('PATCH', data=body, headers={'Content-Type': 'application/json'})
+            response.raise_for_status()
+            _observe('rest', 'update', self.path, started, sent=len(body), received=len(response.content))
+            return True
+        except Exception as e:
+            _observe('rest', 'update', self.path, started, sent=len(body), error=True)
+            if isinstance(e, BackendUnavailable):
+                raise
+            print(f"Firebase UPDATE error at {self.path or '/'}: {e}")
+            return False
+    
+    def get_with_etag(self):
+        """(snapshot, etag) of this node, for a later set_if_unchanged"""
+        started = time.perf_counter()
+        received = 0
+        try:
+            response = self._read(headers={'X-Firebase-ETag': 'true'})
+            received = len(response.content)
+            response.raise_for_status()
+            _observe('rest', 'get', self.path, started, received=received)
+            return FirebaseSnapshot(response.json()), response.headers.get('ETag')
+        except Exception as e:
+            _observe('rest', 'get', self.path, started, received=received, error=True)
+            print(f"Firebase GET error: {e}")
+            return _read_failed(e, (FirebaseSnapshot(None), None))
+    
+    def set_if_unchanged(self, expected_etag, data):
+        """Conditional PUT. Returns (True, snapshot, new etag), or on a
+        conflict (False, current snapshot, current etag); (False, None, None)
+        if the request itself failed."""
+        started = time.perf_counter()
+        body = json.dumps(data).encode()
+        try:
+            headers = {'Content-Type': 'application/json', 'if-match': expected_etag, 'X-Firebase-ETag': 'true'}
+            response = self._send('PUT', data=body, headers=headers)
+            if response.status_code == 412:
+                _observe('rest', 'set', self.path, started, sent=len(body), received=len(response.content))
+                return False, FirebaseSnapshot(response.json()), response.headers.get('ETag')
+            response.raise_for_status()
+            _observe('rest', 'set', self.path, started, sent=len(body), received=len(response.content))
+            return True, FirebaseSnapshot(data), response.headers.get('ETag')
+        except Exception as e:
+            _observe('rest', 'set', self.path, started, sent=len(body), error=True)
+            if isinstance(e, BackendUnavailable):
+                raise
+            print(f"Firebase conditional SET error at {self.path}: {e}")
+            return False, None, None
 
 class FirebaseSnapshot:
     def __init__(self, data):
@@ -67,14 +223,193 @@ class FirebaseSnapshot:
     def val(self):
         return self._data
 
+# The httpx client of the current async_session. A client and its pool are
+# bound to the event loop that made them, and asgiref runs every async view on
+# a fresh loop, so clients live for one view call rather than one process.
+_async_client = contextvars.ContextVar('firebase_async_client', default=None)
+
+def _new_async_client():
+    import httpx
+    return httpx.AsyncClient(timeout=httpx.Timeout(FIREBASE_TIMEOUT, connect=FIREBASE_CONNECT_TIMEOUT))
+
+@contextlib.asynccontextmanager
+async def async_session():
+    """Share one pooled client between the async reads inside the block, and close it at the end"""
+    if _async_client.get() is not None:
+        yield
+        return
+    async with _new_async_client() as client:
+        token = _async_client.set(client)
+        try:
+            yield
+        finally:
+            _async_client.reset(token)
+
+class AsyncFirebaseRESTDatabase:
+    """Async variant of FirebaseRESTDatabase built on httpx"""
+    
+    def __init__(self, base_url, path=""):
+        self.base_url = base_url.rstrip('/')
+        self.path = path.strip('/')
+    
+    def child(self, path):
+        new_path = f"{self.path}/{path}" if self.path else path
+        return AsyncFirebaseRESTDatabase(self.base_url, new_path)
+    
+    def _url(self):
+        return f"{self.base_url}/{self.path}.json" if self.path else f"{self.base_url}/.json"
+    
+    async def _request(self, method, **kwargs):
+        client = _async_client.get()
+        if client is not None:
+            return await client.request(method, self._url(), **kwargs)
+        # Outside a session: a client for this request alone, so nothing is left open
+        async with _new_async_client() as client:
+            return await client.request(method, self._url(), **kwargs)
+    
+    async def _send(self, method, **kwargs):
+        """One HTTP request, admitted by this database's gate (see admission.py)"""
+        return await admission.gate(self.base_url).call_async(lambda: self._request(method, **kwargs))
+    
+    async def _read(self, **kwargs):
+        """A GET, retried and hedged (see retries.py)"""
+        return await retries.policy(self.base_url).read_async(lambda: self._send('GET', **kwargs))
+    
+    async def get(self):
+        started = time.perf_counter()
+        received = 0
+        try:
+            response = await self._read()
+            received = len(response.content)
+            response.raise_for_status()
+            data = response.json()
+            _observe('rest_async', 'get', self.path, started, received=received)
+            return FirebaseSnapshot(data)
+        except Exception as e:
+            _observe('rest_async', 'get', self.path, started, received=received, error=True)
+            print(f"Firebase async GET error: {e}")
+            return _read_failed(e, FirebaseSnapshot(None))
+    
+    async def set(self, data):
+        started = time.perf_counter()
+        body = json.dumps(data).encode()
+        try:
+            response = await self._send('PUT', content=body, headers={'Content-Type': 'application/json'})
+            response.raise_for_status()
+            _observe('rest_async', 'set', self.path, started, sent=len(body), received=len(response.content))
+            return True
+        except Exception as e:
+            _observe('rest_async', 'set', self.path, started, sent=len(body), error=True)
+            if isinstance(e, BackendUnavailable):
+                raise
+            print(f"Firebase async SET error at {self.path}: {e}")
+            return False
+    
+    async def delete(self):
+        started = time.perf_counter()
+        try:
+            response = await self._send('DELETE')
+            response.raise_for_status()
+            _observe('rest_async', 'delete', self.path, started)
+            return True
+        except Exception as e:
+            _observe('rest_async', 'delete', self.path, started, error=True)
+            if isinstance(e, BackendUnavailable):
+                raise
+            print(f"Firebase async DELETE error at {self.path}: {e}")
+            return False
+    
+    async def update(self, data):
+        started = time.perf_counter()
+        body = json.dumps(data).encode()
+        try:
+            response = await self._send('PATCH', content=body, headers={'Content-Type': 'application/json'})
+            response.raise_for_status()
+            _observe('rest_async', 'update', self.path, started, sent=len(body), received=len(response.content))
+            return True
+        except Exception as e:
+            _observe('rest_async', 'update', self.path, started, sent=len(body), error=True)
+            if isinstance(e, BackendUnavailable):
+                raise
+            print(f"Firebase async UPDATE error at {self.path or '/'}: {e}")
+            return False
+    
+    async def get_with_etag(self):
+        started = time.perf_counter()
+        received = 0
+        try:
+            response = await self._read(headers={'X-Firebase-ETag': 'true'})
+            received = len(response.content)
+            response.raise_for_status()
+            _observe('rest_async', 'get', self.path, started, received=received)
+            return FirebaseSnapshot(response.json()), response.headers.get('ETag')
+        except Exception as e:
+            _observe('rest_async', 'get', self.path, started, received=received, error=True)
+            print(f"Firebase async GET error: {e}")
+            return _read_failed(e, (FirebaseSnapshot(None), None))
+    
+    async def set_if_unchanged(self, expected_etag, data):
+        started = time.perf_counter()
+        body = json.dumps(data).encode()
+        try:
+            headers = {'Content-Type': 'application/json', 'if-match': expected_etag, 'X-Firebase-ETag': 'true'}
+            response = await self._send('PUT', content=body, headers=headers)
+            if response.status_code == 412:
+                _observe('rest_async', 'set', self.path, started, sent=len(body), received=len(response.content))
+                return False, FirebaseSnapshot(response.json()), response.headers.get('ETag')
+            response.raise_for_status()
+            _observe('rest_async', 'set', self.path, started, sent=len(body), received=len(response.content))
+            return True, FirebaseSnapshot(data), response.headers.get('ETag')
+        except Exception as e:
+            _observe('rest_async', 'set', self.path, started, sent=len(body), error=True)
+            if isinstance(e, BackendUnavailable):
+                raise
+            print(f"Firebase async conditional SET error at {self.path}: {e}")
+            return False, None, None
+
+class AsyncDatabaseAdapter:
+    """Async facade over a blocking database reference, run in a worker thread"""
+    
+    def __init__(self, ref):
+        self._ref = ref
+    
+    def child(self, path):
+        return AsyncDatabaseAdapter(self._ref.child(path))
+    
+    async def get(self):
+        return await asyncio.to_thread(self._ref.get)
+    
+    async def set(self, data):
+        return await asyncio.to_thread(self._ref.set, data)
+    
+    async def delete(self):
+        return await asyncio.to_thread(self._ref.delete)
+    
+    async def update(self, data):
+        return await asyncio.to_thread(self._ref.update, data)
+    
+    async def get_with_etag(self):
+        return await asyncio.to_thread(self._ref.get_with_etag)
+    
+    async def set_if_unchanged(self, expected_etag, data):
+        return await asyncio.to_thread(self._ref.set_if_unchanged, expected_etag, data)
+
 # Initialize Firebase connection
+def _service_account_path():
+    return os.environ.get('FIREBASE_SERVICE_ACCOUNT_PATH', 'serviceAccountKey.json')
+
 def initialize_firebase():
-    """Initialize Firebase connection"""
+    """Initialize Firebase connection.
+
+    No network access happens here; use check_connection() to probe the backend.
+    firebase_admin is only imported when a service account is configured.
+    """
     try:
-        # Try Firebase Admin SDK first (for service account)
-        service_account_path = os.environ.get('FIREBASE_SERVICE_ACCOUNT_PATH', 'serviceAccountKey.json')
+        service_account_path = _service_account_path()
         
         if os.path.exists(service_account_path):
+            import firebase_admin
+            from firebase_admin import credentials
             try:
                 firebase_admin.get_app()
                 return True
@@ -88,31 +423,18 @@ def initialize_firebase():
         else:
             # Use REST API for public database access
             print("🔄 Using Firebase REST API (no auth required)")
-            print("📊 Testing Firebase connection...")
-            
-            # Test connection
-            test_db = FirebaseRESTDatabase(FIREBASE_CONFIG['databaseURL'])
-            test_result = test_db.child('test').get()
-            
-            if test_result is not None:
-                print("✅ Firebase REST API connection successful!")
-                return True
-            else:
-                print("❌ Firebase connection failed")
-                return False
+            return True
                 
     except Exception as e:
         print(f"Firebase initialization error: {e}")
         return False
 
-# Initialize Firebase when module is imported
-firebase_initialized = initialize_firebase()
-
 # Admin database reference
 def get_admin_db():
     """Get Firebase Admin database reference"""
     try:
-        if firebase_initialized:
+        if os.path.exists(_service_account_path()) and initialize_firebase():
+            from firebase_admin import db
             return db.reference()
         else:
             print("Firebase not initialized")
@@ -125,6 +447,7 @@ def get_admin_db():
 class MockDatabase:
     """Mock database for when Firebase is not available"""
     _data = {}  # In-memory storage for development
+    _lock = threading.RLock()
     
     def __init__(self, path=""):
         self.path = path
@@ -134,19 +457,81 @@ class MockDatabase:
         return MockDatabase(new_path)
     
     def get(self):
-        data = self._get_data_at_path(self.path)
+        started = time.perf_counter()
+        with MockDatabase._lock:
+            data = self._get_data_at_path(self.path)
+            # Hand out a snapshot like the real backends do, so readers never
+            # iterate a node while another request thread writes into it
+            if isinstance(data, dict):
+                data = dict(data)
+        _observe('mock', 'get', self.path, started)
+        return MockSnapshot(data)
+    
+    def get_from_key(self, start_key):
+        started = time.perf_counter()
+        with MockDatabase._lock:
+            data = self._get_data_at_path(self.path)
+            if isinstance(data, dict):
+                data = {key: value for key, value in data.items() if key >= start_key} or None
+        _observe('mock', 'get', self.path, started)
         return MockSnapshot(data)
     
     def set(self, data):
-        print(f"Mock set at {self.path}: {data}")
-        self._set_data_at_path(self.path, data)
+        started = time.perf_counter()
+        with MockDatabase._lock:
+            self._set_data_at_path(self.path, data)
+        _observe('mock', 'set', self.path, started)
         return True
     
     def delete(self):
-        print(f"Mock delete at {self.path}")
-        self._delete_data_at_path(self.path)
+        started = time.perf_counter()
+        with MockDatabase._lock:
+            self._delete_data_at_path(self.path)
+        _observe('mock', 'delete', self.path, started)
+        return True
+    
+    def update(self, data):
+        started = time.perf_counter()
+        with MockDatabase._lock:
+            for key, value in data.items():
+                path = f"{self.path}/{key}" if self.path else key
+                if value is None:
+                    self._delete_data_at_path(path)
+                else:
+                    self._set_data_at_path(path, value)
+        _observe('mock', 'update', self.path, started)
         return True
     
+    @staticmethod
+    def _etag(value):
+        # Same scheme as the local emulator: a hash of the canonical JSON
+        return hashlib.sha1(json.dumps(value, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+    
+    def get_with_etag(self):
+        started = time.perf_counter()
+        with MockDatabase._lock:
+            data = self._get_data_at_path(self.path)
+            etag = self._etag(data)
+            if isinstance(data, dict):
+                data = dict(data)
+        _observe('mock', 'get', self.path, started)
+        return MockSnapshot(data), etag
+    
+    def set_if_unchanged(self, expected_etag, data):
+        started = time.perf_counter()
+        with MockDatabase._lock:
+            current = self._get_data_at_path(self.path)
+            if self._etag(current) != expected_etag:
+                _observe('mock', 'set', self.path, started)
+                return False, MockSnapshot(dict(current) if isinstance(current, dict) else current), self._etag(current)
+            if data is None:
+                # Like Firebase, writing null deletes the node
+                self._delete_data_at_path(self.path)
+            else:
+                self._set_data_at_path(self.path, data)
+        _observe('mock', 'set', self.path, started)
+        return True, MockSnapshot(data), self._etag(data)
+    
     def _get_data_at_path(self, path):
         if not path:
             return MockDatabase._data
@@ -203,10 +588,21 @@ class MockSnapshot:
 
 # Create database instance
 def get_database():
-    """Get database reference, falling back to mock if Firebase not available"""
-    if firebase_initialized:
+    """Get database reference, falling back to mock if Firebase not available.
+
+    FIREBASE_BACKEND=mock|rest|auto forces a backend (default auto).
+    """
+    backend = os.environ.get('FIREBASE_BACKEND', 'auto')
+    if backend == 'mock':
+        print("Using mock database (FIREBASE_BACKEND=mock)")
+        return MockDatabase()
+    if backend == 'rest' or not os.path.exists(_service_account_path()):
+        print("🔄 Using Firebase REST API (no auth required)")
+        return FirebaseRESTDatabase(FIREBASE_CONFIG['databaseURL'])
+    if initialize_firebase():
         try:
             # Try Admin SDK first
+            from firebase_admin import db
             return db.reference()
         except Exception as admin_error:
             try:
@@ -220,5 +616,64 @@ def get_database():
         print("Firebase not initialized, using mock database for development")
         return MockDatabase()
 
-# Create database instance
-database = get_database()
+def get_async_database(sync_database):
+    """Get an async database matching the backend chosen for ``sync_database``"""
+    if isinstance(sync_database, FirebaseRESTDatabase):
+        return AsyncFirebaseRESTDatabase(sync_database.base_url, sync_database.path)
+    return AsyncDatabaseAdapter(sync_database)
+
+class LazyDatabase:
+    """Database reference that chooses and initializes its backend on first use"""
+    
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+        self._lock = threading.Lock()
+    
+    def resolve(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = self._factory()
+        return self._target
+    
+    def reset(self):
+        with self._lock:
+            self._target = None
+    
+    def child(self, path):
+        return self.resolve().child(path)
+    
+    def get(self):
+        return self.resolve().get()
+    
+    def set(self, data):
+        return self.resolve().set(data)
+    
+    def delete(self):
+        return self.resolve().delete()
+    
+    def update(self, data):
+        return self.resolve().update(data)
+
+def check_connection(timeout=5):
+    """Readiness probe: one round trip to the configured backend.
+
+    Returns (ok, detail).
+    """
+    target = database.resolve()
+    if isinstance(target, MockDatabase):
+        return True, 'mock database'
+    try:
+        if isinstance(target, FirebaseRESTDatabase):
+            url = f"{target.base_url}/test.json?shallow=true"
+            get_http_session().get(url, timeout=timeout).raise_for_status()
+        else:
+            target.child('test').get()
+        return True, 'ok'
+    except Exception as e:
+        return False, str(e)
+
+# Database instances are created lazily, so importing this module is network-free
+database = LazyDatabase(get_database)
+async_database = LazyDatabase(lambda: get_async_database(database.resolve()))
@@ -1,9 +1,164 @@
+import os
 from datetime import datetime
 import uuid
-from firebase_config import database, get_admin_db
-from werkzeug.security import generate_password_hash, check_password_hash
+import heapq
+import asyncio
+import metrics
+import archive
+from firebase_config import database, async_database, get_admin_db
+from admission import BackendUnavailable
+from sharding import shard_map
+from session_cache import user_cache
+from profiling import span
+from password_hashing import hash_password, verify_password, needs_rehash
 
-class FirebaseUser:
+# Caches derived from a user's data subscribe here; listeners are called as
+# listener(user_id, kind, change) after a write, with kind one of 'profile',
+# 'expenses' or 'savings_goal'. For single-record writes change is
+# {'id': record_id, 'data': new record dict, or None when deleted}; bulk
+# writes pass None, meaning "anything may have changed".
+_change_listeners = []
+
+def on_user_data_change(listener):
+    _change_listeners.append(listener)
+    return listener
+
+def notify_user_data_change(user_id, kind, change=None):
+    for listener in _change_listeners:
+        try:
+            listener(user_id, kind, change)
+        except Exception as e:
+            # The write itself succeeded; a broken cache must not fail the request
+            print(f"Change listener error for {kind} of {user_id}: {e}")
+
+MAX_CONFLICT_RETRIES = int(os.environ.get('MAX_CONFLICT_RETRIES', 5))
+
+def check_written(result, path):
+    # REST and mock writes return False when the request failed; the Admin SDK returns None and raises
+    if result is False:
+        raise BackendUnavailable(f"Saving {path} failed")
+
+class WriteConflict(Exception):
+    """A conditional save found fields it changed were also changed elsewhere"""
+    
+    def __init__(self, fields):
+        super().__init__(f"Changed elsewhere: {', '.join(sorted(fields))}")
+        self.fields = fields
+
+class TrackedRecord:
+    """Base for models that remember their stored state.
+    
+    ``save()`` PATCHes only the fields that changed since the record was
+    loaded or last saved; a record never stored is written whole. A record
+    that carries an ETag (loaded with ``with_etag=True``) is written with a
+    conditional PUT instead: if someone else changed it meanwhile, their
+    changes to other fields are merged in and the write retried, while a
+    change to one of our fields raises WriteConflict.
+    """
+    NODE = None
+    
+    def _record_id(self):
+        return self.id
+    
+    def _database(self):
+        return database
+    
+    async def _async_database(self):
+        return async_database
+    
+    def _reload(self, data):
+        self.__init__(data, self._record_id())
+    
+    def _mark_clean(self, etag=None):
+        self._stored = self.to_dict()
+        self.etag = etag
+    
+    def changed_fields(self):
+        data = self.to_dict()
+        stored = getattr(self, '_stored', None)
+        if stored is None:
+            return data
+        return {field: value for field, value in data.items() if stored.get(field) != value}
+    
+    def _rebase(self, changes, current):
+        """Our changes applied over the record as it is now stored"""
+        current = current if isinstance(current, dict) else {}
+        clashes = {field for field, value in changes.items()
+                   if current.get(field) != self._stored.get(field) and current.get(field) != value}
+        if clashes:
+            raise WriteConflict(clashes)
+        return {**current, **changes}
+    
+    def _plan_save(self):
+        """('set', data), ('update', changes), ('conditional', changes) or (None, None)"""
+        if getattr(self, '_stored', None) is None:
+            return 'set', self.to_dict()
+        changes = self.changed_fields()
+        if not changes:
+            return None, None
+        return ('conditional' if getattr(self, 'etag', None) else 'update'), changes
+    
+    def _check_written(self, result):
+        check_written(result, f"{self.NODE}/{self._record_id()}")
+    
+    def _save_changes(self):
+        """Write pending changes; returns the full stored record, or None if unchanged"""
+        ref = self._database().child(self.NODE).child(self._record_id())
+        mode, payload = self._plan_save()
+        if mode is None:
+            return None
+        if mode == 'set':
+            self._check_written(ref.set(payload))
+        elif mode == 'update':
+            self._check_written(ref.update(payload))
+        else:
+            data, etag = {**self._stored, **payload}, self.etag
+            for attempt in range(MAX_CONFLICT_RETRIES):
+                ok, current, new_etag = ref.set_if_unchanged(etag, data)
+                if ok:
+                    break
+                if current is None:
+                    self._check_written(False)
+                metrics.DB_WRITE_CONFLICTS.inc(node=self.NODE)
+                data, etag = self._rebase(payload, current.val()), new_etag
+            else:
+                raise WriteConflict(set(payload))
+            self._reload(data)
+            self._mark_clean(new_etag)
+            return data
+        self._mark_clean()
+        return self._stored
+    
+    async def _save_changes_async(self):
+        ref = (await self._async_database()).child(self.NODE).child(self._record_id())
+        mode, payload = self._plan_save()
+        if mode is None:
+            return None
+        if mode == 'set':
+            self._check_written(await ref.set(payload))
+        elif mode == 'update':
+            self._check_written(await ref.update(payload))
+        else:
+            data, etag = {**self._stored, **payload}, self.etag
+            for attempt in range(MAX_CONFLICT_RETRIES):
+                ok, current, new_etag = await ref.set_if_unchanged(etag, data)
+                if ok:
+                    break
+                if current is None:
+                    self._check_written(False)
+                metrics.DB_WRITE_CONFLICTS.inc(node=self.NODE)
+                data, etag = self._rebase(payload, current.val()), new_etag
+            else:
+                raise WriteConflict(set(payload))
+            self._reload(data)
+            self._mark_clean(new_etag)
+            return data
+        self._mark_clean()
+        return self._stored
+
+class FirebaseUser(TrackedRecord):
+    NODE = "users"
+    
     def __init__(self, user_data=None, uid=None):
         if user_data:
             self.id = user_data.get('id', uid)
@@ -23,6 +178,15 @@ class FirebaseUser:
             self.is_admin = False
             self.monthly_income = 0.0
             self.created_at = datetime.utcnow().isoformat()
+        # What the database holds, for dirty tracking (None: never stored)
+        self._stored = self.to_dict() if user_data else None
+        self.etag = None
+    
+    def _record_id(self):
+        return self.get_id()
+    
+    def _reload(self, data):
+        self.__init__(data, self.uid)
     
     def is_authenticated(self):
         return True
@@ -37,10 +201,13 @@ class FirebaseUser:
         return str(self.uid) if self.uid else str(self.id)
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return verify_password(self.password_hash, password)
+    
+    def password_needs_rehash(self):
+        return needs_rehash(self.password_hash)
     
     def to_dict(self):
         return {
@@ -67,9 +234,21 @@ class FirebaseUser:
         user.created_at = datetime.utcnow().isoformat()
         
         # Save to Firebase
-        database.child("users").child(user_id).set(user.to_dict())
+        user._check_written(database.child("users").child(user_id).set(user.to_dict()))
+        user._mark_clean()
+        shard_map.assign(user_id)
+        notify_user_data_change(user_id, 'profile')
         return user
     
+    @staticmethod
+    def _users_from_snapshot(users):
+        user_list = []
+        with span('decode.users'):
+            if users.val():
+                for uid, user_data in users.val().items():
+                    user_list.append(FirebaseUser(user_data, uid))
+        return user_list
+    
     @staticmethod
     def get_by_username(username):
         users = database.child("users").get()
@@ -89,33 +268,50 @@ class FirebaseUser:
         return None
     
     @staticmethod
-    def get_by_id(user_id):
-        user_data = database.child("users").child(user_id).get()
+    def get_by_id(user_id, with_etag=False):
+        ref = database.child("users").child(user_id)
+        user_data, etag = ref.get_with_etag() if with_etag else (ref.get(), None)
         if user_data.val():
-            return FirebaseUser(user_data.val(), user_id)
+            user = FirebaseUser(user_data.val(), user_id)
+            user.etag = etag
+            return user
         return None
     
     @staticmethod
     def get_all_users():
         users = database.child("users").get()
-        user_list = []
-        if users.val():
-            for uid, user_data in users.val().items():
-                user_list.append(FirebaseUser(user_data, uid))
-        return user_list
+        return FirebaseUser._users_from_snapshot(users)
+    
+    @staticmethod
+    async def get_all_users_async():
+        users = await async_database.child("users").get()
+        return FirebaseUser._users_from_snapshot(users)
     
     @staticmethod
     def count():
         users = database.child("users").get()
         return len(users.val()) if users.val() else 0
     
+    @staticmethod
+    async def count_async():
+        users = await async_database.child("users").get()
+        return len(users.val()) if users.val() else 0
+    
     def save(self):
-        database.child("users").child(self.get_id()).set(self.to_dict())
+        if self._save_changes() is None:
+            return
+        user_cache.invalidate(self.get_id())
+        notify_user_data_change(self.get_id(), 'profile')
     
     def delete(self):
-        database.child("users").child(self.get_id()).delete()
+        self._check_written(database.child("users").child(self.get_id()).delete())
+        shard_map.forget(self.get_id())
+        user_cache.invalidate(self.get_id())
+        notify_user_data_change(self.get_id(), 'profile')
 
-class FirebaseExpense:
+class FirebaseExpense(TrackedRecord):
+    NODE = "expenses"
+    
     def __init__(self, expense_data=None, expense_id=None):
         if expense_data:
             self.id = expense_data.get('id', expense_id)
@@ -135,6 +331,10 @@ class FirebaseExpense:
             self.expense_type = 'wanted'
             self.date = datetime.utcnow().isoformat()
             self.created_at = datetime.utcnow().isoformat()
+        self._stored = self.to_dict() if expense_data else None
+        self.etag = None
+        # 'YYYY-MM' of the archive block holding this expense, None in the hot tier
+        self.archived_month = None
     
     @property
     def user(self):
@@ -157,10 +357,9 @@ class FirebaseExpense:
         }
     
     @staticmethod
-    def create_expense(user_id, amount, category, description='', expense_type='wanted', date=None):
-        expense_id = str(uuid.uuid4())
+    def _new_expense(user_id, amount, category, description, expense_type, date):
         expense = FirebaseExpense()
-        expense.id = expense_id
+        expense.id = str(uuid.uuid4())
         expense.user_id = user_id
         expense.amount = amount
         expense.category = category
@@ -168,29 +367,148 @@ class FirebaseExpense:
         expense.expense_type = expense_type
         expense.date = date.isoformat() if date else datetime.utcnow().isoformat()
         expense.created_at = datetime.utcnow().isoformat()
+        return expense
+    
+    @staticmethod
+    def create_expense(user_id, amount, category, description='', expense_type='wanted', date=None):
+        expense = FirebaseExpense._new_expense(user_id, amount, category, description, expense_type, date)
         
         # Save to Firebase
-        database.child("expenses").child(expense_id).set(expense.to_dict())
+        data = expense.to_dict()
+        FirebaseExpense._write(user_id, expense.id, data)
+        expense._mark_clean()
+        notify_user_data_change(user_id, 'expenses', {'id': expense.id, 'data': data})
+        return expense
+    
+    @staticmethod
+    async def create_expense_async(user_id, amount, category, description='', expense_type='wanted', date=None):
+        expense = FirebaseExpense._new_expense(user_id, amount, category, description, expense_type, date)
+        data = expense.to_dict()
+        await FirebaseExpense._write_async(user_id, expense.id, data)
+        expense._mark_clean()
+        notify_user_data_change(user_id, 'expenses', {'id': expense.id, 'data': data})
         return expense
     
     @staticmethod
-    def get_by_id(expense_id):
-        expense_data = database.child("expenses").child(expense_id).get()
+    def _write(user_id, expense_id, data):
+        """Store one expense (None deletes it) on the user's shard, via its write-behind buffer when enabled"""
+        shard = shard_map.shard_for_write(user_id)
+        if shard.write_buffer.enabled:
+            shard.write_buffer.put(f"expenses/{expense_id}", data)
+        elif data is None:
+            check_written(shard.database.child("expenses").child(expense_id).delete(), f"expenses/{expense_id}")
+        else:
+            check_written(shard.database.child("expenses").child(expense_id).set(data), f"expenses/{expense_id}")
+    
+    @staticmethod
+    async def _write_async(user_id, expense_id, data):
+        shard = await shard_map.shard_for_write_async(user_id)
+        if shard.write_buffer.enabled:
+            await asyncio.to_thread(shard.write_buffer.put, f"expenses/{expense_id}", data)
+        elif data is None:
+            check_written(await shard.async_database.child("expenses").child(expense_id).delete(),
+                          f"expenses/{expense_id}")
+        else:
+            check_written(await shard.async_database.child("expenses").child(expense_id).set(data),
+                          f"expenses/{expense_id}")
+    
+    @staticmethod
+    def _snapshot(shard, path="expenses"):
+        """Read ``path`` on ``shard``, including buffered writes not yet flushed"""
+        ref = shard.database
+        for part in path.split('/'):
+            ref = ref.child(part)
+        return shard.write_buffer.read_through(path, ref.get())
+    
+    @staticmethod
+    async def _snapshot_async(shard, path="expenses"):
+        ref = shard.async_database
+        for part in path.split('/'):
+            ref = ref.child(part)
+        return shard.write_buffer.read_through(path, await ref.get())
+    
+    @staticmethod
+    def _from_shard(shard, expense_id, with_etag):
+        # Buffered writes are not conditional, so there is no ETag to hand out
+        if with_etag and not shard.write_buffer.enabled:
+            expense_data, etag = shard.database.child("expenses").child(expense_id).get_with_etag()
+        else:
+            expense_data, etag = FirebaseExpense._snapshot(shard, f"expenses/{expense_id}"), None
         if expense_data.val():
-            return FirebaseExpense(expense_data.val(), expense_id)
+            expense = FirebaseExpense(expense_data.val(), expense_id)
+            expense.etag = etag
+            return expense
         return None
     
     @staticmethod
-    def get_by_user_id(user_id, limit=None, order_by='created_at'):
-        expenses = database.child("expenses").get()
-        expense_list = []
-        if expenses.val():
-            for expense_id, expense_data in expenses.val().items():
-                if expense_data.get('user_id') == user_id:
-                    expense_list.append(FirebaseExpense(expense_data, expense_id))
-        
-        # Sort by date (newest first)
+    async def _from_shard_async(shard, expense_id, with_etag):
+        if with_etag and not shard.write_buffer.enabled:
+            expense_data, etag = await shard.async_database.child("expenses").child(expense_id).get_with_etag()
+        else:
+            expense_data, etag = await FirebaseExpense._snapshot_async(shard, f"expenses/{expense_id}"), None
+        if expense_data.val():
+            expense = FirebaseExpense(expense_data.val(), expense_id)
+            expense.etag = etag
+            return expense
+        return None
+    
+    @staticmethod
+    def _find_archived(shard, user_id, expense_id):
+        for month, records in archive.read_blocks(shard.database, user_id).items():
+            if expense_id in records:
+                expense = FirebaseExpense(records[expense_id], expense_id)
+                expense.archived_month = month
+                return expense
+        return None
+    
+    @staticmethod
+    def get_by_id(expense_id, with_etag=False, user_id=None):
+        """Look the expense up on ``user_id``'s shard first, when given (archive included), then on every shard"""
+        shards = shard_map.all()
+        if user_id:
+            first = shard_map.shard_for(user_id)
+            expense = (FirebaseExpense._from_shard(first, expense_id, with_etag) or
+                       FirebaseExpense._find_archived(first, user_id, expense_id))
+            if expense or not shard_map.sharded:
+                return expense
+            shards = [shard for shard in shards if shard is not first]
+        found = shard_map.scatter(lambda shard: FirebaseExpense._from_shard(shard, expense_id, with_etag), shards)
+        return next((expense for expense in found if expense), None)
+    
+    @staticmethod
+    async def get_by_id_async(expense_id, with_etag=False, user_id=None):
+        shards = shard_map.all()
+        if user_id:
+            first = await shard_map.shard_for_async(user_id)
+            expense = (await FirebaseExpense._from_shard_async(first, expense_id, with_etag) or
+                       await asyncio.to_thread(FirebaseExpense._find_archived, first, user_id, expense_id))
+            if expense or not shard_map.sharded:
+                return expense
+            shards = [shard for shard in shards if shard is not first]
+        found = await shard_map.scatter_async(
+            lambda shard: FirebaseExpense._from_shard_async(shard, expense_id, with_etag), shards)
+        return next((expense for expense in found if expense), None)
+    
+    @staticmethod
+    def _merge(expense_lists, limit=None):
+        """Combine per-shard results, newest first"""
+        if len(expense_lists) == 1:
+            return expense_lists[0]
+        expense_list = [expense for expenses in expense_lists for expense in expenses]
         expense_list.sort(key=lambda x: x.date, reverse=True)
+        return expense_list[:limit] if limit else expense_list
+    
+    @staticmethod
+    def _expenses_from_snapshot(expenses, user_id=None, limit=None):
+        expense_list = []
+        with span('decode.expenses'):
+            if expenses.val():
+                for expense_id, expense_data in expenses.val().items():
+                    if user_id is None or expense_data.get('user_id') == user_id:
+                        expense_list.append(FirebaseExpense(expense_data, expense_id))
+            
+            # Sort by date (newest first)
+            expense_list.sort(key=lambda x: x.date, reverse=True)
         
         if limit:
             expense_list = expense_list[:limit]
@@ -198,71 +516,243 @@ class FirebaseExpense:
         return expense_list
     
     @staticmethod
-    def get_all_expenses(limit=None):
-        expenses = database.child("expenses").get()
-        expense_list = []
-        if expenses.val():
-            for expense_id, expense_data in expenses.val().items():
-                expense_list.append(FirebaseExpense(expense_data, expense_id))
-        
-        # Sort by date (newest first)
-        expense_list.sort(key=lambda x: x.date, reverse=True)
+    def _cold(shard, user_id=None, start_date=None, end_date=None, category=None, expense_type=None, hot=(), limit=None):
+        """Archived expenses on ``shard`` (one user's, or everyone's), reading only blocks that can match.
         
-        if limit:
-            expense_list = expense_list[:limit]
+        With ``limit``, blocks are read newest first and reading stops once no
+        older month can make the top ``limit`` together with ``hot``.
+        """
+        summaries = archive.read_summaries(shard.database, user_id)
+        per_user = {user_id: summaries} if user_id else summaries
+        candidates = sorted(((month, owner) for owner, months in per_user.items()
+                             for month in archive.select_months(months, start_date, end_date, category, expense_type)),
+                            reverse=True)
+        # A user's whole archive is one request
+        blocks = None
+        if user_id and not limit and len(candidates) == len(summaries) > 1:
+            blocks = archive.read_blocks(shard.database, user_id)
         
+        expense_list = []
+        dates = [expense.date for expense in hot]
+        for month, owner in candidates:
+            if limit and len(dates) >= limit and archive.month_span(month)[1].isoformat() < heapq.nlargest(limit, dates)[-1][:10]:
+                break
+            records = blocks[month] if blocks is not None else archive.read_blocks(shard.database, owner, [month])[month]
+            with span('decode.archive', month=month):
+                for expense_id, record in records.items():
+                    expense = FirebaseExpense(record, expense_id)
+                    expense.archived_month = month
+                    if FirebaseExpense.matches_filters(expense, category, expense_type, start_date, end_date):
+                        expense_list.append(expense)
+                        dates.append(expense.date)
         return expense_list
     
+    @staticmethod
+    def _in_range(expenses, start_date, end_date):
+        if not (start_date or end_date):
+            return expenses
+        return [e for e in expenses if FirebaseExpense.matches_filters(e, start_date=start_date, end_date=end_date)]
+    
+    @staticmethod
+    def get_by_user_id(user_id, limit=None, order_by='created_at', start_date=None, end_date=None, include_archived=True):
+        """The user's expenses, newest first, from both tiers; archive blocks are read only for the months needed"""
+        shard = shard_map.shard_for(user_id)
+        expenses = FirebaseExpense._snapshot(shard)
+        hot = FirebaseExpense._in_range(FirebaseExpense._expenses_from_snapshot(expenses, user_id), start_date, end_date)
+        if not include_archived:
+            return hot[:limit] if limit else hot
+        cold = FirebaseExpense._cold(shard, user_id, start_date, end_date, hot=hot, limit=limit)
+        return FirebaseExpense._merge([hot, cold], limit)
+    
+    @staticmethod
+    async def get_by_user_id_async(user_id, limit=None, order_by='created_at', start_date=None, end_date=None, include_archived=True):
+        shard = await shard_map.shard_for_async(user_id)
+        expenses = await FirebaseExpense._snapshot_async(shard)
+        hot = FirebaseExpense._in_range(FirebaseExpense._expenses_from_snapshot(expenses, user_id), start_date, end_date)
+        if not include_archived:
+            return hot[:limit] if limit else hot
+        cold = await asyncio.to_thread(FirebaseExpense._cold, shard, user_id, start_date, end_date, hot=hot, limit=limit)
+        return FirebaseExpense._merge([hot, cold], limit)
+    
+    @staticmethod
+    def get_all_expenses(limit=None, include_archived=True):
+        def from_shard(shard):
+            hot = FirebaseExpense._expenses_from_snapshot(FirebaseExpense._snapshot(shard), limit=limit)
+            if not include_archived:
+                return hot
+            return FirebaseExpense._merge([hot, FirebaseExpense._cold(shard, hot=hot, limit=limit)], limit)
+        # Scatter-gather: every shard in parallel
+        return FirebaseExpense._merge(shard_map.scatter(from_shard), limit)
+    
+    @staticmethod
+    async def get_all_expenses_async(limit=None, include_archived=True):
+        async def from_shard(shard):
+            hot = FirebaseExpense._expenses_from_snapshot(await FirebaseExpense._snapshot_async(shard), limit=limit)
+            if not include_archived:
+                return hot
+            cold = await asyncio.to_thread(FirebaseExpense._cold, shard, hot=hot, limit=limit)
+            return FirebaseExpense._merge([hot, cold], limit)
+        return FirebaseExpense._merge(await shard_map.scatter_async(from_shard), limit)
+    
     @staticmethod
     def get_filtered_expenses(user_id=None, category=None, expense_type=None, start_date=None, end_date=None, is_admin=False):
-        expenses = database.child("expenses").get()
-        expense_list = []
+        owner = user_id if user_id and not is_admin else None
+        def from_shard(shard):
+            expenses = FirebaseExpense._snapshot(shard)
+            hot = FirebaseExpense._filter_snapshot(expenses, user_id, category, expense_type, start_date, end_date, is_admin)
+            return FirebaseExpense._merge([hot, FirebaseExpense._cold(shard, owner, start_date, end_date, category, expense_type)])
+        if owner is None:
+            return FirebaseExpense._merge(shard_map.scatter(from_shard))
+        return from_shard(shard_map.shard_for(owner))
+    
+    @staticmethod
+    async def get_filtered_expenses_async(user_id=None, category=None, expense_type=None, start_date=None, end_date=None, is_admin=False):
+        owner = user_id if user_id and not is_admin else None
+        async def from_shard(shard):
+            expenses = await FirebaseExpense._snapshot_async(shard)
+            hot = FirebaseExpense._filter_snapshot(expenses, user_id, category, expense_type, start_date, end_date, is_admin)
+            cold = await asyncio.to_thread(FirebaseExpense._cold, shard, owner, start_date, end_date, category, expense_type)
+            return FirebaseExpense._merge([hot, cold])
+        if owner is None:
+            return FirebaseExpense._merge(await shard_map.scatter_async(from_shard))
+        return await from_shard(await shard_map.shard_for_async(owner))
+    
+    @staticmethod
+    def archived_summary(user_id=None):
+        """Totals over the user's (or everyone's) archived months, from the summaries alone"""
+        if user_id:
+            summaries = archive.read_summaries(shard_map.shard_for(user_id).database, user_id)
+            return archive.combine(summaries.items())
+        per_shard = shard_map.scatter(lambda shard: archive.read_summaries(shard.database))
+        return archive.combine((month, summary) for summaries in per_shard
+                               for months in summaries.values() for month, summary in months.items())
+    
+    @staticmethod
+    async def archived_summary_async(user_id=None):
+        return await asyncio.to_thread(FirebaseExpense.archived_summary, user_id)
+    
+    @staticmethod
+    def archived_category_totals(user_id):
+        """{month: {category: total}} over the user's archived months, from the summaries alone"""
+        return archive.category_totals(archive.read_summaries(shard_map.shard_for(user_id).database, user_id))
+    
+    @staticmethod
+    def matches_filters(expense, category=None, expense_type=None, start_date=None, end_date=None):
+        """The /expenses filters, shared by the snapshot scan and text search"""
+        if category and expense.category != category:
+            return False
         
-        if expenses.val():
-            for expense_id, expense_data in expenses.val().items():
-                expense = FirebaseExpense(expense_data, expense_id)
-                
-                # Apply filters
-                if not is_admin and user_id and expense.user_id != user_id:
-                    continue
-                
-                if category and expense.category != category:
-                    continue
-                
-                if expense_type and expense.expense_type != expense_type:
-                    continue
-                
-                if start_date:
-                    expense_date = datetime.fromisoformat(expense.date.replace('Z', '+00:00'))
-                    if expense_date.date() < start_date:
+        if expense_type and expense.expense_type != expense_type:
+            return False
+        
+        if start_date or end_date:
+            expense_date = datetime.fromisoformat(expense.date.replace('Z', '+00:00')).date()
+            if start_date and expense_date < start_date:
+                return False
+            if end_date and expense_date > end_date:
+                return False
+        
+        return True
+    
+    @staticmethod
+    def _filter_snapshot(expenses, user_id, category, expense_type, start_date, end_date, is_admin):
+        expense_list = []
+        with span('decode.expenses', filtered=True):
+            
+            if expenses.val():
+                for expense_id, expense_data in expenses.val().items():
+                    expense = FirebaseExpense(expense_data, expense_id)
+                    
+                    # Apply filters
+                    if not is_admin and user_id and expense.user_id != user_id:
                         continue
-                
-                if end_date:
-                    expense_date = datetime.fromisoformat(expense.date.replace('Z', '+00:00'))
-                    if expense_date.date() > end_date:
+                    
+                    if not FirebaseExpense.matches_filters(expense, category, expense_type, start_date, end_date):
                         continue
-                
-                expense_list.append(expense)
-        
-        # Sort by date (newest first)
-        expense_list.sort(key=lambda x: x.date, reverse=True)
+                    
+                    expense_list.append(expense)
+            
+            # Sort by date (newest first)
+            expense_list.sort(key=lambda x: x.date, reverse=True)
         return expense_list
     
+    def _database(self):
+        return shard_map.shard_for_write(self.user_id).database
+    
+    async def _async_database(self):
+        return (await shard_map.shard_for_write_async(self.user_id)).async_database
+    
+    def _thaw(self, data):
+        """Write an archived expense (None deletes it) into its block, or back to the hot tier"""
+        month = self.archived_month
+        if not archive.thaw(shard_map.shard_for_write(self.user_id).database, self.user_id, month, self.id, data):
+            if data is not None:
+                # Deleted meanwhile; saving must not bring it back
+                raise WriteConflict(set(self.changed_fields()) or {'id'})
+        self.archived_month = month if data is not None and archive.month_of(data.get('date')) == month else None
+        if data is not None:
+            self._mark_clean()
+    
     def save(self):
-        database.child("expenses").child(self.id).set(self.to_dict())
+        if self.archived_month:
+            data = self.to_dict()
+            self._thaw(data)
+        elif shard_map.shard_for_write(self.user_id).write_buffer.enabled:
+            # The journal holds whole records; last writer wins
+            data = self.to_dict()
+            FirebaseExpense._write(self.user_id, self.id, data)
+            self._mark_clean()
+        else:
+            data = self._save_changes()
+            if data is None:
+                return
+        notify_user_data_change(self.user_id, 'expenses', {'id': self.id, 'data': data})
+    
+    async def save_async(self):
+        if self.archived_month:
+            data = self.to_dict()
+            await asyncio.to_thread(self._thaw, data)
+        elif (await shard_map.shard_for_write_async(self.user_id)).write_buffer.enabled:
+            data = self.to_dict()
+            await FirebaseExpense._write_async(self.user_id, self.id, data)
+            self._mark_clean()
+        else:
+            data = await self._save_changes_async()
+            if data is None:
+                return
+        notify_user_data_change(self.user_id, 'expenses', {'id': self.id, 'data': data})
     
     def delete(self):
-        database.child("expenses").child(self.id).delete()
+        if self.archived_month:
+            self._thaw(None)
+        else:
+            FirebaseExpense._write(self.user_id, self.id, None)
+        notify_user_data_change(self.user_id, 'expenses', {'id': self.id, 'data': None})
+    
+    async def delete_async(self):
+        if self.archived_month:
+            await asyncio.to_thread(self._thaw, None)
+        else:
+            await FirebaseExpense._write_async(self.user_id, self.id, None)
+        notify_user_data_change(self.user_id, 'expenses', {'id': self.id, 'data': None})
     
     @staticmethod
-    def delete_by_user_id(user_id):
-        expenses = database.child("expenses").get()
+    def delete_by_user_id(user_id, progress=None):
+        """Delete all of a user's expenses, calling progress(done, total) as it goes"""
+        expenses = FirebaseExpense._snapshot(shard_map.shard_for(user_id))
         if expenses.val():
-            for expense_id, expense_data in expenses.val().items():
-                if expense_data.get('user_id') == user_id:
-                    database.child("expenses").child(expense_id).delete()
+            expense_ids = [expense_id for expense_id, expense_data in expenses.val().items()
+                           if expense_data.get('user_id') == user_id]
+            for done, expense_id in enumerate(expense_ids, 1):
+                FirebaseExpense._write(user_id, expense_id, None)
+                if progress:
+                    progress(done, len(expense_ids))
+        archive.delete_user(shard_map.shard_for_write(user_id).database, user_id)
+        notify_user_data_change(user_id, 'expenses')
 
-class FirebaseSavingsGoal:
+class FirebaseSavingsGoal(TrackedRecord):
+    NODE = "savings_goals"
+    
     def __init__(self, goal_data=None, goal_id=None):
         if goal_data:
             self.id = goal_data.get('id', goal_id)
@@ -278,6 +768,8 @@ class FirebaseSavingsGoal:
             self.target_months = 3
             self.current_savings = 0.0
             self.created_at = datetime.utcnow().isoformat()
+        self._stored = self.to_dict() if goal_data else None
+        self.etag = None
     
     def to_dict(self):
         return {
@@ -290,32 +782,58 @@ class FirebaseSavingsGoal:
         }
     
     @staticmethod
-    def create_goal(user_id, target_amount=100000.0, target_months=3, current_savings=0.0):
-        goal_id = str(uuid.uuid4())
+    def _new_goal(user_id, target_amount, target_months, current_savings):
         goal = FirebaseSavingsGoal()
-        goal.id = goal_id
+        goal.id = str(uuid.uuid4())
         goal.user_id = user_id
         goal.target_amount = target_amount
         goal.target_months = target_months
         goal.current_savings = current_savings
         goal.created_at = datetime.utcnow().isoformat()
+        return goal
+    
+    @staticmethod
+    def create_goal(user_id, target_amount=100000.0, target_months=3, current_savings=0.0):
+        goal = FirebaseSavingsGoal._new_goal(user_id, target_amount, target_months, current_savings)
         
         # Save to Firebase
-        database.child("savings_goals").child(goal_id).set(goal.to_dict())
+        goal._check_written(
+            shard_map.shard_for_write(user_id).database.child("savings_goals").child(goal.id).set(goal.to_dict()))
+        goal._mark_clean()
+        notify_user_data_change(user_id, 'savings_goal')
         return goal
     
     @staticmethod
-    def get_by_user_id(user_id):
-        goals = database.child("savings_goals").get()
+    async def create_goal_async(user_id, target_amount=100000.0, target_months=3, current_savings=0.0):
+        goal = FirebaseSavingsGoal._new_goal(user_id, target_amount, target_months, current_savings)
+        shard = await shard_map.shard_for_write_async(user_id)
+        goal._check_written(await shard.async_database.child("savings_goals").child(goal.id).set(goal.to_dict()))
+        goal._mark_clean()
+        notify_user_data_change(user_id, 'savings_goal')
+        return goal
+    
+    @staticmethod
+    def _goal_from_snapshot(goals, user_id):
         if goals.val():
             for goal_id, goal_data in goals.val().items():
                 if goal_data.get('user_id') == user_id:
                     return FirebaseSavingsGoal(goal_data, goal_id)
         return None
     
+    @staticmethod
+    def get_by_user_id(user_id):
+        goals = shard_map.shard_for(user_id).database.child("savings_goals").get()
+        return FirebaseSavingsGoal._goal_from_snapshot(goals, user_id)
+    
+    @staticmethod
+    async def get_by_user_id_async(user_id):
+        shard = await shard_map.shard_for_async(user_id)
+        goals = await shard.async_database.child("savings_goals").get()
+        return FirebaseSavingsGoal._goal_from_snapshot(goals, user_id)
+    
     @staticmethod
     def get_all_by_user_id(user_id):
-        goals = database.child("savings_goals").get()
+        goals = shard_map.shard_for(user_id).database.child("savings_goals").get()
         goal_list = []
         if goals.val():
             for goal_id, goal_data in goals.val().items():
@@ -323,16 +841,27 @@ class FirebaseSavingsGoal:
                     goal_list.append(FirebaseSavingsGoal(goal_data, goal_id))
         return goal_list
     
+    def _database(self):
+        return shard_map.shard_for_write(self.user_id).database
+    
+    async def _async_database(self):
+        return (await shard_map.shard_for_write_async(self.user_id)).async_database
+    
     def save(self):
-        database.child("savings_goals").child(self.id).set(self.to_dict())
+        if self._save_changes() is None:
+            return
+        notify_user_data_change(self.user_id, 'savings_goal')
     
     def delete(self):
-        database.child("savings_goals").child(self.id).delete()
+        self._check_written(self._database().child("savings_goals").child(self.id).delete())
+        notify_user_data_change(self.user_id, 'savings_goal')
     
     @staticmethod
     def delete_by_user_id(user_id):
-        goals = database.child("savings_goals").get()
+        db = shard_map.shard_for_write(user_id).database
+        goals = db.child("savings_goals").get()
         if goals.val():
             for goal_id, goal_data in goals.val().items():
                 if goal_data.get('user_id') == user_id:
-                    database.child("savings_goals").child(goal_id).delete()
+                    check_written(db.child("savings_goals").child(goal_id).delete(), f"savings_goals/{goal_id}")
+        notify_user_data_change(user_id, 'savings_goal')
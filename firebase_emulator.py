@@ -0,0 +1,532 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Firebase Realtime Database REST API.
+
+Implements the part of the protocol the app uses or should use:
+GET/PUT/PATCH/POST/DELETE on ``/<path>.json``, ``shallow``, ``orderBy`` with
+``equalTo``/``startAt``/``endAt``/``limitToFirst``/``limitToLast``,
+multi-path PATCH updates, ETag conditional writes (``X-Firebase-ETag`` /
+``if-match``) and ``text/event-stream`` streaming. Latency and failures can
+be injected to benchmark caching, pooling and retry behaviour offline.
+
+    python firebase_emulator.py --port 9000 --latency-ms 40 --error-rate 0.01
+    FIREBASE_DATABASE_URL=http://127.0.0.1:9000 python app.py
+
+``--instances N`` starts N independent databases on consecutive ports, for
+trying out sharding (see sharding.py) on one machine.
+
+``/.emulator/stats`` reports request counters and ``/.emulator/reset``
+(POST) clears data and counters.
+"""
+
+import copy
+import json
+import time
+import queue
+import random
+import hashlib
+import argparse
+import threading
+from urllib.parse import urlsplit, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+class QueryError(Exception):
+    """Invalid query parameters; reported as HTTP 400"""
+    pass
+
+def _split(path):
+    return [p for p in path.strip('/').split('/') if p]
+
+def _prune(value):
+    """Drop nulls and empty objects the way Firebase does"""
+    if isinstance(value, dict):
+        pruned = {}
+        for k, v in value.items():
+            v = _prune(v)
+            if v is not None:
+                pruned[str(k)] = v
+        return pruned or None
+    if isinstance(value, list):
+        return _prune({str(i): v for i, v in enumerate(value)})
+    return value
+
+def _etag(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+def _value_rank(value):
+    """Firebase ordering: null, false, true, numbers, strings, objects"""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, int(value))
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    return (4, 0)
+
+def _key_rank(key):
+    """Integer-like keys sort numerically before other keys"""
+    try:
+        n = int(key)
+        if -2 ** 31 <= n < 2 ** 31 and str(n) == key:
+            return (0, n, '')
+    except ValueError:
+        pass
+    return (1, 0, key)
+
+class EmulatorStore:
+    """Thread-safe JSON tree with change notification"""
+
+    def __init__(self):
+        self.root = None
+        self.lock = threading.RLock()
+        self.listeners = []  # (path parts, queue)
+
+    def _get(self, parts):
+        node = self.root
+        for part in parts:
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def get(self, parts):
+        with self.lock:
+            return copy.deepcopy(self._get(parts))
+
+    def _set(self, parts, value):
+        value = _prune(value)
+        if not parts:
+            self.root = value
+            return
+        if not isinstance(self.root, dict):
+            self.root = {}
+        node = self.root
+        trail = []
+        for part in parts[:-1]:
+            child = node.get(part)
+            if not isinstance(child, dict):
+                child = node[part] = {}
+            trail.append((node, part))
+            node = child
+        if value is None:
+            node.pop(parts[-1], None)
+            # Remove parents left empty
+            while trail and not node:
+                parent, key = trail.pop()
+                del parent[key]
+                node = parent
+            if not self.root:
+                self.root = None
+        else:
+            node[parts[-1]] = value
+
+    def set(self, parts, value):
+        with self.lock:
+            self._set(parts, value)
+            self._notify(parts, 'put', _prune(value))
+
+    def update(self, parts, updates):
+        """Multi-path update: keys may themselves contain '/'"""
+        if not isinstance(updates, dict):
+            raise QueryError("PATCH body must be an object")
+        with self.lock:
+            for key, value in updates.items():
+                self._set(parts + _split(key), value)
+            self._notify(parts, 'patch', updates)
+
+    def _notify(self, parts, event, data):
+        for listen_parts, q in list(self.listeners):
+            if parts[:len(listen_parts)] == listen_parts:
+                rel = '/' + '/'.join(parts[len(listen_parts):])
+                q.put((event, {'path': rel, 'data': data}))
+            elif listen_parts[:len(parts)] == parts:
+                q.put(('put', {'path': '/', 'data': copy.deepcopy(self._get(listen_parts))}))
+
+    def subscribe(self, parts):
+        q = queue.Queue()
+        with self.lock:
+            self.listeners.append((parts, q))
+            q.put(('put', {'path': '/', 'data': copy.deepcopy(self._get(parts))}))
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.listeners = [(p, lq) for p, lq in self.listeners if lq is not q]
+
+def apply_query(value, params):
+    """Apply shallow/orderBy/filter/limit query parameters to ``value``"""
+    def param(name):
+        if name not in params:
+            return None
+        try:
+            return json.loads(params[name][0])
+        except ValueError:
+            raise QueryError(f"{name} must be a valid JSON value")
+
+    shallow = params.get('shallow', ['false'])[0] == 'true'
+    order_by = param('orderBy')
+    filters = [n for n in ('equalTo', 'startAt', 'endAt', 'limitToFirst', 'limitToLast') if n in params]
+
+    if shallow:
+        if order_by is not None or filters:
+            raise QueryError("Mixing 'shallow' and querying parameters is not supported")
+        if isinstance(value, dict):
+            return {k: (True if isinstance(v, dict) else v) for k, v in value.items()}
+        return value
+
+    if order_by is None:
+        if filters:
+            raise QueryError("orderBy must be defined when other query parameters are defined")
+        return value
+    if not isinstance(value, dict):
+        return value
+
+    if order_by == '$key':
+        sort_key = lambda item: _key_rank(item[0])
+        order_value = lambda item: item[0]
+    elif order_by == '$value':
+        sort_key = lambda item: (_value_rank(item[1]), _key_rank(item[0]))
+        order_value = lambda item: item[1]
+    elif order_by == '$priority':
+        raise QueryError("orderBy=\"$priority\" is not supported by the emulator")
+    else:
+        child = _split(order_by)
+
+        def order_value(item):
+            node = item[1]
+            for part in child:
+                if not isinstance(node, dict):
+                    return None
+                node = node.get(part)
+            return node
+        sort_key = lambda item: (_value_rank(order_value(item)), _key_rank(item[0]))
+
+    rank = (lambda v: _key_rank(str(v))) if order_by == '$key' else _value_rank
+    items = sorted(value.items(), key=sort_key)
+    equal_to, start_at, end_at = param('equalTo'), param('startAt'), param('endAt')
+    if 'equalTo' in params:
+        items = [i for i in items if order_value(i) == equal_to]
+    if 'startAt' in params:
+        items = [i for i in items if rank(order_value(i)) >= rank(start_at)]
+    if 'endAt' in params:
+        items = [i for i in items if rank(order_value(i)) <= rank(end_at)]
+    first, last = param('limitToFirst'), param('limitToLast')
+    if first is not None and last is not None:
+        raise QueryError("Only one of limitToFirst and limitToLast may be given")
+    if first is not None:
+        items = items[:int(first)]
+    if last is not None:
+        items = items[-int(last):] if int(last) else []
+    return dict(items)
+
+class EmulatorStats:
+    """Request counters exposed at /.emulator/stats"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.errors_injected = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.errors_injected = 0
+            self.bytes_in = 0
+            self.bytes_out = 0
+
+    def record(self, method, bytes_in, bytes_out):
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'requests': dict(self.requests),
+                'total_requests': sum(self.requests.values()),
+                'errors_injected': self.errors_injected,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+            }
+
+class EmulatorRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FirebaseEmulator/1.0'
+    # Headers and body go out in separate writes; don't let Nagle delay the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.emulator.verbose:
+            super().log_message(format, *args)
+
+    # Plumbing
+
+    def _parts_and_params(self):
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        if path.endswith('.json'):
+            path = path[:-5]
+        return _split(path), parse_qs(url.query)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        self._bytes_in = len(raw)
+        if not raw:
+            return None
+        return json.loads(raw)
+
+    def _send(self, status, payload=None, headers=None):
+        body = b'' if status == 204 else json.dumps(payload, separators=(',', ':')).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+        self.server.emulator.stats.record(self.command, getattr(self, '_bytes_in', 0), len(body))
+
+    def _inject_faults(self):
+        """Apply configured latency/failures; True if the request was failed"""
+        emulator = self.server.emulator
+        delay = emulator.latency_ms + (emulator.rng.uniform(0, emulator.jitter_ms) if emulator.jitter_ms else 0)
+        if emulator.stall_rate and emulator.rng.random() < emulator.stall_rate:
+            delay += emulator.stall_ms
+        if delay:
+            time.sleep(delay / 1000.0)
+        if emulator.error_rate and emulator.rng.random() < emulator.error_rate:
+            with emulator.stats.lock:
+                emulator.stats.errors_injected += 1
+            self._send(503, {'error': 'Injected failure'})
+            return True
+        return False
+
+    def _handle(self, method):
+        emulator = self.server.emulator
+        parts, params = self._parts_and_params()
+
+        if parts[:1] == ['.emulator']:
+            return self._handle_control(method, parts[1:])
+
+        try:
+            body = self._read_body() if method in ('PUT', 'PATCH', 'POST') else None
+        except ValueError:
+            return self._send(400, {'error': 'Invalid data; couldn\'t parse JSON object'})
+
+        if method == 'GET' and 'text/event-stream' in (self.headers.get('Accept') or ''):
+            return self._stream(parts)
+
+        if self._inject_faults():
+            return
+
+        store = emulator.store
+        want_etag = (self.headers.get('X-Firebase-ETag') or '').lower() == 'true'
+        silent = params.get('print', [''])[0] == 'silent'
+        try:
+            with store.lock:
+                current = store._get(parts)
+                headers = {'ETag': _etag(current)} if want_etag else {}
+                if_match = self.headers.get('if-match')
+                if if_match is not None and method != 'GET' and if_match != _etag(current):
+                    return self._send(412, copy.deepcopy(current), {'ETag': _etag(current)})
+
+                if method == 'GET':
+                    return self._send(200, apply_query(copy.deepcopy(current), params), headers)
+                if method == 'PUT':
+                    store.set(parts, body)
+                    result = store._get(parts)
+                elif method == 'PATCH':
+                    store.update(parts, body)
+                    result = body
+                elif method == 'POST':
+                    name = emulator.push_id()
+                    store.set(parts + [name], body)
+                    result = {'name': name}
+                elif method == 'DELETE':
+                    store.set(parts, None)
+                    result = None
+                if want_etag:
+                    headers['ETag'] = _etag(store._get(parts))
+            if silent:
+                return self._send(204, None, headers)
+            return self._send(200, copy.deepcopy(result), headers)
+        except QueryError as e:
+            return self._send(400, {'error': str(e)})
+
+    def _handle_control(self, method, parts):
+        emulator = self.server.emulator
+        if parts == ['stats'] and method == 'GET':
+            return self._send(200, emulator.stats.snapshot())
+        if parts == ['stats'] and method == 'DELETE':
+            emulator.stats.reset()
+            return self._send(200, None)
+        if parts == ['reset'] and method == 'POST':
+            emulator.reset()
+            return self._send(200, None)
+        return self._send(404, {'error': 'Unknown emulator endpoint'})
+
+    def _stream(self, parts):
+        store = self.server.emulator.store
+        q = store.subscribe(parts)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            while not self.server.emulator.stopping:
+                try:
+                    event, data = q.get(timeout=self.server.emulator.keepalive)
+                    payload = json.dumps(data, separators=(',', ':'))
+                except queue.Empty:
+                    event, payload = 'keep-alive', 'null'
+                self.wfile.write(f"event: {event}\ndata: {payload}\n\n".encode())
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            store.unsubscribe(q)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_PATCH(self):
+        self._handle('PATCH')
+
+    def do_POST(self):
+        # Firebase also accepts method overrides on POST
+        override = self.headers.get('X-HTTP-Method-Override')
+        self._handle(override.upper() if override else 'POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+class FirebaseEmulator:
+    """In-process emulator server; use several for multi-instance setups"""
+
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0, jitter_ms=0, error_rate=0.0,
+                 stall_rate=0.0, stall_ms=2000, seed=None, keepalive=30, verbose=False):
+        self.host = host
+        self.port = port
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall_ms = stall_ms
+        self.keepalive = keepalive
+        self.verbose = verbose
+        self.rng = random.Random(seed)
+        self.store = EmulatorStore()
+        self.stats = EmulatorStats()
+        self.stopping = False
+        self._server = None
+        self._thread = None
+        self._push_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def push_id(self):
+        """Chronologically sortable ids, like Firebase push keys"""
+        with self._push_lock:
+            now = int(time.time() * 1000)
+            ts = ''.join(PUSH_CHARS[(now >> (6 * i)) & 63] for i in reversed(range(8)))
+            tail = ''.join(self.rng.choice(PUSH_CHARS) for _ in range(12))
+            return ts + tail
+
+    def load(self, data):
+        self.store.set([], data)
+
+    def reset(self):
+        self.store.set([], None)
+        self.stats.reset()
+
+    def start(self):
+        self.stopping = False
+        self._server = ThreadingHTTPServer((self.host, self.port), EmulatorRequestHandler)
+        self._server.daemon_threads = True
+        self._server.emulator = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='firebase-emulator', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.stopping = True
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--latency-ms', type=float, default=0, help='fixed delay added to every request')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='extra uniform random delay')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='fraction of requests delayed by --stall-ms')
+    parser.add_argument('--stall-ms', type=float, default=2000)
+    parser.add_argument('--seed', type=int, help='random seed for injected faults')
+    parser.add_argument('--data', help='JSON file to load at startup')
+    parser.add_argument('--synthetic', choices=['small', 'medium', 'large'],
+                        help='load a generated dataset (see synthetic_data.py)')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    parser.add_argument('--instances', type=int, default=1,
+                        help='independent databases on consecutive ports; --data/--synthetic load into the first')
+    args = parser.parse_args(argv)
+
+    emulator = FirebaseEmulator(args.host, args.port, args.latency_ms, args.jitter_ms, args.error_rate,
+                                args.stall_rate, args.stall_ms, args.seed, verbose=args.verbose)
+    if args.data:
+        with open(args.data) as f:
+            emulator.load(json.load(f))
+    if args.synthetic:
+        from synthetic_data import PROFILES, generate_dataset
+        emulator.load(generate_dataset(**PROFILES[args.synthetic]))
+
+    if args.instances == 1:
+        print(f"🔥 Firebase emulator listening on http://{args.host}:{args.port}")
+        print(f"   Point the app at it with FIREBASE_DATABASE_URL=http://{args.host}:{args.port}")
+        emulator.serve_forever()
+        return
+
+    others = [FirebaseEmulator(args.host, args.port + i, args.latency_ms, args.jitter_ms, args.error_rate,
+                               args.stall_rate, args.stall_ms, args.seed, verbose=args.verbose).start()
+              for i in range(1, args.instances)]
+    shards = ','.join(f"shard{i}={e.url}" for i, e in enumerate([emulator] + others))
+    print(f"🔥 {args.instances} Firebase emulators listening on ports {args.port}-{args.port + args.instances - 1}")
+    print(f"   Point the app at them with FIREBASE_DATABASE_URL={emulator.url} FIREBASE_SHARDS={shards}")
+    try:
+        emulator.serve_forever()
+    finally:
+        for other in others:
+            other.stop()
+
+if __name__ == '__main__':
+    main()
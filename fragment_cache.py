@@ -0,0 +1,139 @@
+"""
+Cached rendering of template fragments.
+
+A view opens a ``FragmentScope`` for the data a page shows (one user, or
+everyone for admin pages) before it reads anything, and hands it to the
+template, which wraps sections in
+
+    {% cache 'dashboard.recent', fragments %} ... {% endcache %}
+
+A section is rendered once and then served as stored HTML until
+firebase_db reports a write to the scope's data. Like the other caches, a
+fragment rendered from data read before a write is never kept, and
+``FRAGMENT_CACHE_TTL`` bounds how long a worker serves a fragment that
+another gunicorn worker's writes may have made stale.
+
+When every fragment on a page is cached, ``FragmentScope.has`` lets the
+view skip the database reads behind them altogether. It pins the HTML it
+found, and the render serves that copy even if a write or the TTL retires
+the entries in between, since the template has no data to render them again.
+"""
+
+import os
+import time
+import threading
+from markupsafe import Markup
+from jinja2 import nodes
+from jinja2.ext import Extension
+import metrics
+from firebase_db import on_user_data_change
+
+FRAGMENT_CACHE_TTL = float(os.environ.get('FRAGMENT_CACHE_TTL', 60))
+FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', 5000))
+ALL_USERS = '*'
+
+class FragmentScope:
+    """The cache key of one page render: scope, the data version it started from, and extra key parts"""
+
+    def __init__(self, cache, scope, key):
+        self.cache = cache
+        self.scope = scope
+        self.key = key
+        self.version = cache.version(scope)
+        self.pinned = {}  # name -> HTML this render is committed to serving
+
+    def has(self, *names):
+        """The stored HTML of every named fragment, pinned for this render, or
+        None (and nothing pinned) if any of them has to be rendered"""
+        found = {}
+        for name in names:
+            html = self.cache.peek(self, name)
+            if html is None:
+                return None
+            found[name] = html
+        self.pinned.update(found)
+        return found
+
+class FragmentCache:
+    """Rendered HTML per (fragment, scope, key), versioned like ReportIndexCache"""
+
+    def __init__(self, ttl=None, max_entries=FRAGMENT_CACHE_SIZE):
+        self.ttl = FRAGMENT_CACHE_TTL if ttl is None else ttl
+        self.max_entries = max_entries
+        self._entries = {}  # (name, scope, key) -> (html, version, expires_at)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def version(self, scope):
+        with self._lock:
+            return self._versions.get(scope, 0)
+
+    def scope(self, scope, *key):
+        """Start a page render for ``scope``; ``key`` holds whatever else the fragments depend on"""
+        return FragmentScope(self, scope, key)
+
+    def peek(self, fragments, name):
+        entry = self._entries.get((name, fragments.scope, fragments.key))
+        if entry is None:
+            return None
+        html, version, expires_at = entry
+        if version != self._versions.get(fragments.scope, 0) or expires_at < time.monotonic():
+            return None
+        return html
+
+    def render(self, name, fragments, caller):
+        """Stored HTML for the fragment, or ``caller()`` rendered and stored"""
+        html = fragments.pinned.get(name)
+        if html is None:
+            html = self.peek(fragments, name)
+        metrics.record_cache_lookup('fragment', html is not None)
+        if html is not None:
+            return html
+        html = Markup(caller())
+        if self.ttl > 0:
+            with self._lock:
+                if fragments.version == self._versions.get(fragments.scope, 0):
+                    if len(self._entries) >= self.max_entries:
+                        # Oldest insert first; dicts keep insertion order
+                        del self._entries[next(iter(self._entries))]
+                    self._entries[(name, fragments.scope, fragments.key)] = (html, fragments.version,
+                                                                             time.monotonic() + self.ttl)
+        return html
+
+    def invalidate(self, user_id, kind=None, change=None):
+        with self._lock:
+            # Entries of older versions are ignored by peek and overwritten on the next render
+            for scope in (user_id, ALL_USERS):
+                self._versions[scope] = self._versions.get(scope, 0) + 1
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            for scope in {k[1] for k in self._entries}:
+                self._versions[scope] = self._versions.get(scope, 0) + 1
+            self._entries.clear()
+
+# Shared cache, kept current by firebase_db writes
+fragment_cache = FragmentCache()
+on_user_data_change(fragment_cache.invalidate)
+os.register_at_fork(after_in_child=fragment_cache._after_fork)
+
+class FragmentCacheExtension(Extension):
+    """``{% cache 'name', fragments %}...{% endcache %}``"""
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        name = parser.parse_expression()
+        parser.stream.expect('comma')
+        fragments = parser.parse_expression()
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [name, fragments]), [], [], body).set_lineno(lineno)
+
+    def _render(self, name, fragments, caller):
+        if not isinstance(fragments, FragmentScope):
+            # Rendered without a scope (e.g. an error page): no caching
+            return caller()
+        return fragments.cache.render(name, fragments, caller)
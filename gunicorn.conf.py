@@ -0,0 +1,41 @@
+"""
+Gunicorn configuration for Expense Manager, driven by environment variables.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+
+import os
+import multiprocessing
+
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', '8000')}")
+
+# Worker model
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread' if threads > 1 else 'sync')
+
+# Timeouts
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# Recycle workers now and then to bound memory growth
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+# Import the app once in the master; workers inherit warmed caches
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+errorlog = os.environ.get('GUNICORN_ERROR_LOG', '-')
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+def post_fork(server, worker):
+    # Connection pools and worker pools reset themselves via os.register_at_fork;
+    # create this worker's HTTP session up front so the first request doesn't pay for it
+    from firebase_config import get_http_session
+    get_http_session()
+    # Pick up jobs a previous worker left queued or running, without waiting for a new one
+    from jobs import job_runner
+    job_runner.start()
+    server.log.info(f"Worker {worker.pid} ready")
@@ -0,0 +1,409 @@
+"""
+In-process background jobs for operations too slow for a request.
+
+Jobs are records under the ``jobs`` node of the database, so any gunicorn
+worker can answer a status poll and a job survives a restart. Each worker
+runs a small thread pool (``JOB_WORKERS``) fed by a bounded queue
+(``JOB_QUEUE``); when the queue is full ``enqueue`` raises ``JobQueueFull``
+and the route answers 503.
+
+A failed attempt is retried with exponential backoff up to
+``JOB_MAX_ATTEMPTS`` times. Enqueueing is idempotent: a job with the same
+key that is still queued or running (or, for jobs that may reuse results,
+finished recently) is returned instead of a new one. Handlers must
+therefore be safe to run again, which also lets a worker pick up jobs
+left queued or running by a process that died (see ``resume_stale``).
+
+A worker claims a job with a conditional write on its record, so a job
+queued in more than one worker still runs once at a time; while it runs,
+the worker refreshes ``updated_at`` every ``HEARTBEAT_INTERVAL`` seconds, so
+only a job whose worker has gone quiet for ``JOB_STALE_SECONDS`` looks
+abandoned. Every worker looks for abandoned jobs when it starts (see
+``JobRunner.start``, called from gunicorn's ``post_fork``) and every
+``SWEEP_INTERVAL`` seconds after that.
+"""
+
+import os
+import csv
+import time
+import queue
+import hashlib
+import threading
+from datetime import datetime, timedelta
+import metrics
+from firebase_config import database
+from firebase_db import FirebaseUser, FirebaseExpense, FirebaseSavingsGoal
+from exports import write_expenses_csv
+from archive import archive_expenses
+from change_feed import change_feed
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_QUEUE = int(os.environ.get('JOB_QUEUE', 50))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+JOB_RESULT_DIR = os.environ.get('JOB_RESULT_DIR', 'job_results')
+JOB_STALE_SECONDS = float(os.environ.get('JOB_STALE_SECONDS', 120))
+REUSE_WINDOW = timedelta(minutes=10)
+RETENTION = timedelta(days=7)
+PROGRESS_INTERVAL = 0.5
+HEARTBEAT_INTERVAL = JOB_STALE_SECONDS / 4
+SWEEP_INTERVAL = JOB_STALE_SECONDS / 2
+CLAIM_RETRY_SECONDS = 5
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = 'queued', 'running', 'succeeded', 'failed'
+ACTIVE = (QUEUED, RUNNING)
+
+class JobQueueFull(Exception):
+    """Raised when the worker's job queue has no room left"""
+
+_handlers = {}
+
+def job_handler(kind):
+    """Register ``fn(job, **params)`` as the handler for jobs of ``kind``"""
+    def decorator(fn):
+        _handlers[kind] = fn
+        return fn
+    return decorator
+
+def _now():
+    return datetime.utcnow()
+
+def _updated(record):
+    return datetime.fromisoformat(record.get('updated_at') or record['created_at'])
+
+def _stale(record, now):
+    return (now - _updated(record)).total_seconds() > JOB_STALE_SECONDS
+
+def _key_id(key):
+    # Database keys cannot contain '.', '/', '#', '$', '[' or ']'
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+class JobContext:
+    """What a handler sees: its parameters and a throttled progress reporter"""
+
+    def __init__(self, runner, record):
+        self.runner = runner
+        self.record = record
+        self.id = record['id']
+        self._last_save = 0.0
+
+    def progress(self, done, total, message=None):
+        fraction = done / total if total else 1.0
+        self.record['progress'] = round(min(fraction, 1.0), 4)
+        if message is not None:
+            self.record['message'] = message
+        now = time.monotonic()
+        if now - self._last_save >= PROGRESS_INTERVAL or done >= total:
+            self._last_save = now
+            self.runner._save(self.record)
+
+class JobRunner:
+    def __init__(self, workers=JOB_WORKERS, queue_depth=JOB_QUEUE, max_attempts=JOB_MAX_ATTEMPTS):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.max_attempts = max_attempts
+        self._after_fork()
+
+    def _after_fork(self):
+        # Threads do not survive a fork; start fresh ones on first use
+        self._queue = queue.Queue(maxsize=self.queue_depth)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._local = set()  # jobs waiting in this worker's queue or retry timers
+
+    def _table(self):
+        return database.child("jobs")
+
+    def _save(self, record):
+        record['updated_at'] = _now().isoformat()
+        self._table().child(record['id']).set(record)
+
+    def get(self, job_id):
+        record = self._table().child(job_id).get().val()
+        if not isinstance(record, dict):
+            return None
+        # Firebase drops empty objects, so a job without parameters comes back without the key
+        record.setdefault('params', {})
+        return record
+
+    def start(self):
+        """Start this worker's job threads and the sweeper that resumes abandoned jobs"""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            sweeper = threading.Thread(target=self._sweep, name='job-sweeper', daemon=True)
+            sweeper.start()
+            self._threads.append(sweeper)
+
+    def _sweep(self):
+        while True:
+            try:
+                self.resume_stale()
+            except Exception as e:
+                print(f"⚠️ Looking for abandoned jobs failed: {e}")
+            time.sleep(SWEEP_INTERVAL)
+
+    def _put(self, job_id, attempts):
+        """Queue the job here; raises queue.Full"""
+        with self._lock:
+            self._local.add(job_id)
+        try:
+            self._queue.put_nowait((job_id, attempts))
+        except queue.Full:
+            with self._lock:
+                self._local.discard(job_id)
+            raise
+
+    def enqueue(self, kind, owner_id, params=None, key=None, reuse_finished=False):
+        """Queue a job and return (record, created). ``key`` identifies
+        duplicate requests; it defaults to the kind, owner and parameters."""
+        if kind not in _handlers:
+            raise ValueError(f"Unknown job kind '{kind}'")
+        params = params or {}
+        key = key or f"{kind}:{owner_id}:{sorted(params.items())}"
+        key_ref = database.child("job_keys").child(_key_id(key))
+
+        existing_id = key_ref.get().val()
+        existing = self.get(existing_id) if existing_id else None
+        if existing:
+            if existing['status'] in ACTIVE:
+                return existing, False
+            finished = existing.get('finished_at')
+            if (reuse_finished and existing['status'] == SUCCEEDED and finished and
+                    _now() - datetime.fromisoformat(finished) < REUSE_WINDOW):
+                return existing, False
+
+        self.start()
+        now = _now().isoformat()
+        record = {
+            'id': f"{int(time.time() * 1000):013d}-{os.urandom(4).hex()}",
+            'kind': kind,
+            'owner_id': owner_id,
+            'params': params,
+            'key': key,
+            'status': QUEUED,
+            'progress': 0.0,
+            'message': 'Waiting to start',
+            'attempts': 0,
+            'max_attempts': self.max_attempts,
+            'error': None,
+            'result': None,
+            'created_at': now,
+            'finished_at': None,
+        }
+        self._save(record)
+        key_ref.set(record['id'])
+        try:
+            self._put(record['id'], 0)
+        except queue.Full:
+            key_ref.delete()
+            self._table().child(record['id']).delete()
+            raise JobQueueFull(f"Job queue is full ({self.queue_depth} waiting)")
+        return record, True
+
+    def _work(self):
+        while True:
+            job_id, attempts = self._queue.get()
+            with self._lock:
+                self._local.discard(job_id)
+            try:
+                self._run(job_id, attempts)
+            except Exception as e:
+                print(f"❌ Job {job_id} crashed the runner: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _later(self, delay, job_id, attempts):
+        with self._lock:
+            self._local.add(job_id)
+        timer = threading.Timer(delay, self._queue.put, ((job_id, attempts),))
+        timer.daemon = True
+        timer.start()
+
+    def _claim(self, job_id, attempts):
+        """Mark the job running, if it is still queued after ``attempts``
+        attempts; its record, or None when it is not this worker's to run"""
+        ref = self._table().child(job_id)
+        snapshot, etag = ref.get_with_etag()
+        record = snapshot.val()
+        if not isinstance(record, dict) or record['status'] != QUEUED or record['attempts'] != attempts:
+            # Finished, deleted, or already taken up by another worker
+            return None
+        record.setdefault('params', {})
+        record.update(status=RUNNING, attempts=attempts + 1, error=None, message='Running',
+                      updated_at=_now().isoformat())
+        ok, current, _ = ref.set_if_unchanged(etag, record)
+        if not ok and current is None:
+            raise RuntimeError('the database did not take the write')
+        return record if ok else None
+
+    def _heartbeat(self, job_id, stop):
+        """Keep a running job's updated_at fresh, so resume_stale leaves it alone.
+
+        Each beat is a conditional write of the record as read, so it never
+        undoes a progress save or brings back a deleted record; it stops when
+        the record is gone or no longer running.
+        """
+        ref = self._table().child(job_id)
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                snapshot, etag = ref.get_with_etag()
+                record = snapshot.val()
+                if not isinstance(record, dict) or record.get('status') != RUNNING:
+                    return
+                record['updated_at'] = _now().isoformat()
+                # A conflict means the record was just saved, which is a beat of its own
+                ref.set_if_unchanged(etag, record)
+            except Exception as e:
+                print(f"⚠️ Heartbeat for job {job_id} failed: {e}")
+
+    def _run(self, job_id, attempts):
+        try:
+            record = self._claim(job_id, attempts)
+        except Exception as e:
+            print(f"⚠️ Could not claim job {job_id}, trying again in {CLAIM_RETRY_SECONDS}s: {e}")
+            self._later(CLAIM_RETRY_SECONDS, job_id, attempts)
+            return
+        if record is None:
+            return
+        handler = _handlers[record['kind']]
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job_id, stop), name=f'job-heartbeat-{job_id}', daemon=True)
+        heartbeat.start()
+        try:
+            self._execute(job_id, record, handler)
+        finally:
+            stop.set()
+            heartbeat.join()
+
+    def _execute(self, job_id, record, handler):
+        started = time.perf_counter()
+        try:
+            result = handler(JobContext(self, record), **record['params'])
+        except Exception as e:
+            metrics.JOB_DURATION.observe(time.perf_counter() - started, kind=record['kind'])
+            if record['attempts'] < record['max_attempts']:
+                delay = min(60, 2 ** record['attempts'])
+                record.update(status=QUEUED, error=str(e), message=f"Attempt {record['attempts']} failed; retrying in {delay}s")
+                self._save(record)
+                metrics.JOBS_FINISHED.inc(kind=record['kind'], outcome='retried')
+                self._later(delay, job_id, record['attempts'])
+            else:
+                record.update(status=FAILED, error=str(e), message='Failed', finished_at=_now().isoformat())
+                self._save(record)
+                metrics.JOBS_FINISHED.inc(kind=record['kind'], outcome='failed')
+            print(f"⚠️ Job {job_id} ({record['kind']}) attempt {record['attempts']} failed: {e}")
+            return
+
+        metrics.JOB_DURATION.observe(time.perf_counter() - started, kind=record['kind'])
+        metrics.JOBS_FINISHED.inc(kind=record['kind'], outcome='succeeded')
+        record.update(status=SUCCEEDED, progress=1.0, result=result or {}, message='Done',
+                      finished_at=_now().isoformat())
+        self._save(record)
+
+    def resume_stale(self):
+        """Pick up jobs whose worker went quiet, and drop old finished ones"""
+        jobs = self._table().get().val() or {}
+        now = _now()
+        for job_id, record in jobs.items():
+            if not isinstance(record, dict):
+                continue
+            status = record.get('status')
+            with self._lock:
+                here = job_id in self._local
+            if status in ACTIVE and _stale(record, now) and not here:
+                # A queued job may still be waiting in another worker; whichever claims it first runs it
+                if status == RUNNING:
+                    record = self._requeue_abandoned(job_id)
+                    if record is None:
+                        continue
+                try:
+                    self._put(job_id, record.get('attempts', 0))
+                except queue.Full:
+                    return
+            elif status not in ACTIVE and now - _updated(record) > RETENTION:
+                self._table().child(job_id).delete()
+                if record.get('kind') == 'export_all_expenses':
+                    _remove_result_file(record)
+
+    def _requeue_abandoned(self, job_id):
+        """Put a running job without a heartbeat back in the queue; its record, or None if it came back to life"""
+        ref = self._table().child(job_id)
+        snapshot, etag = ref.get_with_etag()
+        record = snapshot.val()
+        if not isinstance(record, dict) or record.get('status') != RUNNING or not _stale(record, _now()):
+            return None
+        record.update(status=QUEUED, message='Resumed after a restart', updated_at=_now().isoformat())
+        ok, _, _ = ref.set_if_unchanged(etag, record)
+        return record if ok else None
+
+def public_view(record):
+    """The job fields exposed to the browser"""
+    view = {k: record.get(k) for k in ('id', 'kind', 'status', 'progress', 'message', 'error',
+                                       'attempts', 'created_at', 'finished_at')}
+    result = dict(record.get('result') or {})
+    if result.pop('file', None):
+        view['download_url'] = f"/jobs/{record['id']}/download"
+    view['result'] = result
+    return view
+
+def result_path(record):
+    file = (record.get('result') or {}).get('file')
+    return os.path.join(JOB_RESULT_DIR, file) if file else None
+
+def _remove_result_file(record):
+    path = result_path(record)
+    if path and os.path.exists(path):
+        os.remove(path)
+
+# Job handlers; each must be safe to run more than once
+
+@job_handler('delete_user')
+def delete_user_job(job, user_id):
+    user = FirebaseUser.get_by_id(user_id)
+    username = user.username if user else user_id
+    FirebaseExpense.delete_by_user_id(
+        user_id, progress=lambda done, total: job.progress(done, total + 1, f"Deleting expenses ({done}/{total})"))
+    FirebaseSavingsGoal.delete_by_user_id(user_id)
+    if user:
+        user.delete()
+    # Nobody is left to sync
+    change_feed.delete_user(user_id)
+    return {'message': f'User {username} deleted successfully'}
+
+@job_handler('clear_user_data')
+def clear_user_data_job(job, user_id):
+    FirebaseExpense.delete_by_user_id(
+        user_id, progress=lambda done, total: job.progress(done, total + 1, f"Deleting expenses ({done}/{total})"))
+    FirebaseSavingsGoal.delete_by_user_id(user_id)
+    return {'message': 'All your data has been successfully deleted.'}
+
+@job_handler('export_all_expenses')
+def export_all_expenses_job(job):
+    job.progress(0, 1, 'Reading expenses')
+    expenses = FirebaseExpense.get_all_expenses()
+    os.makedirs(JOB_RESULT_DIR, exist_ok=True)
+    file = f"{job.id}.csv"
+    partial = os.path.join(JOB_RESULT_DIR, file + '.part')
+    with open(partial, 'w', newline='') as f:
+        rows = write_expenses_csv(csv.writer(f), expenses, include_user=True,
+                                  progress=lambda done, total: job.progress(done, total, f"Writing rows ({done}/{total})"))
+    # Only a complete file ever appears under its final name
+    os.replace(partial, os.path.join(JOB_RESULT_DIR, file))
+    return {
+        'file': file,
+        'filename': f"all_expenses_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+        'rows': rows,
+    }
+
+@job_handler('archive_expenses')
+def archive_expenses_job(job):
+    return archive_expenses(
+        progress=lambda done, total, shard: job.progress(done, total, f"Archiving users on {shard} ({done}/{total})"))
+
+# Shared runner; worker threads start on the first enqueue
+job_runner = JobRunner()
+os.register_at_fork(after_in_child=job_runner._after_fork)
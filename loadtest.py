@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+"""
+End-to-end HTTP load generator for Expense Manager.
+
+Virtual users log in and run weighted, scripted journeys against the real
+routes (dashboard and chart APIs, filtered /expenses pages, add/edit/delete
+expense, exports, admin views, logout/login) at a fixed concurrency. The
+report gives requests per second and p50/p95/p99 latency per route, plus the
+number of backend calls each page made, taken from the server's /metrics.
+
+By default the app is started in-process on a free port, backed by the mock
+database or a local emulator seeded with a synthetic dataset:
+
+    python loadtest.py --backend mock --concurrency 10 --duration 30
+    python loadtest.py --backend emulator --latency-ms 20 --profile medium
+    python loadtest.py --mix browse=1,add=1 --json loadtest.json
+    python loadtest.py --backend emulator --shards 3 --latency-ms 20
+
+or pointed at a running server (e.g. gunicorn), registering its own users:
+
+    python loadtest.py --target http://127.0.0.1:8000 --concurrency 50
+
+The in-process server shares the interpreter with the load generator, so use
+--target against gunicorn for absolute numbers; in-process runs are for
+comparing changes and counting backend calls.
+"""
+
+import io
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import argparse
+import threading
+import contextlib
+from datetime import date, datetime, timedelta
+
+import requests
+
+from benchmark import percentile
+
+LOADTEST_PASSWORD = 'loadtest-password'
+CATEGORIES = ['Food', 'Transport', 'Shopping', 'Entertainment', 'Bills', 'Healthcare', 'Education', 'Other']
+SEARCH_TERMS = ['electricity bill', 'groc', 'coffee', 'cab', 'movie tickets', 'pharm', 'rent', 'book']
+
+_MARKER_ROW = re.compile(r'expense-title">\s*(loadtest [0-9a-f]+)\s*</h6>.*?/edit_expense/([^"\s]+)"', re.S)
+_USER_EXPENSES = re.compile(r'/api/user_expenses/([0-9A-Za-z_-]+)')
+
+class LoadStats:
+    """Latency samples and failures per route, shared by all virtual users"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.latencies = {}
+        self.errors = {}
+        self.journeys = {}
+
+    def record(self, key, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(key, []).append(seconds * 1000.0)
+            if not ok:
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+    def journey(self, name):
+        with self.lock:
+            self.journeys[name] = self.journeys.get(name, 0) + 1
+
+class VirtualUser:
+    """One logged-in browser session running journeys in a loop"""
+
+    def __init__(self, base_url, stats, username, password, is_admin=False, seed=None):
+        self.base_url = base_url.rstrip('/')
+        self.stats = stats
+        self.username = username
+        self.password = password
+        self.is_admin = is_admin
+        self.rng = random.Random(seed)
+        self.session = requests.Session()
+        self.created = []
+
+    def request(self, method, path, route=None, ok_statuses=(200, 302), **kwargs):
+        """Issue one request without following redirects and record it under ``route``"""
+        key = f"{method} {route or path.split('?', 1)[0]}"
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, allow_redirects=False,
+                                            timeout=60, **kwargs)
+        except requests.RequestException:
+            self.stats.record(key, time.perf_counter() - started, False)
+            return None
+        self.stats.record(key, time.perf_counter() - started, response.status_code in ok_statuses)
+        return response
+
+    def login(self):
+        self.request('GET', '/login')
+        response = self.request('POST', '/login', data={'username': self.username, 'password': self.password},
+                                ok_statuses=(302,))
+        return response.status_code if response is not None else None
+
+    def register(self, monthly_income):
+        response = self.request('POST', '/register', ok_statuses=(302,), data={
+            'username': self.username,
+            'email': f"{self.username}@loadtest.example",
+            'password': self.password,
+            'monthly_income': monthly_income,
+        })
+        return response is not None and response.status_code == 302
+
+    def expense_form(self):
+        return {
+            'amount': f"{self.rng.lognormvariate(6, 1):.2f}",
+            'category': self.rng.choice(CATEGORIES),
+            'description': f"loadtest {uuid.uuid4().hex[:12]}",
+            'expense_type': self.rng.choice(['wanted', 'unwanted']),
+            'date': date.today().isoformat(),
+        }
+
+# Journeys: each is one scripted visit to a part of the app
+
+def journey_browse(vu):
+    vu.request('GET', '/dashboard')
+    vu.request('GET', '/api/chart_data?type=category')
+    vu.request('GET', '/api/chart_data?type=expense_type')
+    vu.request('GET', '/api/savings_suggestions')
+
+def journey_reports(vu):
+    vu.request('GET', '/reports')
+    vu.request('GET', '/api/chart_data?type=monthly')
+    vu.request('GET', '/api/chart_data?type=category')
+    vu.request('GET', f"/api/reports?granularity={vu.rng.choice(['week', 'month', 'year'])}"
+                      f"&split={vu.rng.choice(['none', 'category', 'type'])}")
+
+def journey_filter(vu):
+    today = date.today()
+    vu.request('GET', '/expenses')
+    vu.request('GET', f"/expenses?category={vu.rng.choice(CATEGORIES)}")
+    vu.request('GET', f"/expenses?type=unwanted&start_date={(today - timedelta(days=365)).isoformat()}"
+                      f"&end_date={today.isoformat()}")
+    vu.request('GET', '/expenses?page=2')
+    vu.request('GET', f"/expenses?q={vu.rng.choice(SEARCH_TERMS)}")
+
+def journey_add(vu):
+    vu.request('GET', '/add_expense')
+    form = vu.expense_form()
+    vu.request('POST', '/add_expense', data=form, ok_statuses=(302,))
+    response = vu.request('GET', '/expenses')
+    if response is not None and response.status_code == 200:
+        for description, expense_id in _MARKER_ROW.findall(response.text):
+            if description == form['description']:
+                vu.created.append(expense_id)
+
+def journey_edit(vu):
+    # Only touch expenses this virtual user created, so the seed data stays intact
+    if not vu.created:
+        return journey_add(vu)
+    expense_id = vu.rng.choice(vu.created)
+    vu.request('GET', f"/edit_expense/{expense_id}", route='/edit_expense/<expense_id>')
+    vu.request('POST', f"/edit_expense/{expense_id}", route='/edit_expense/<expense_id>',
+               data=vu.expense_form(), ok_statuses=(302,))
+
+def journey_delete(vu):
+    if not vu.created:
+        return journey_add(vu)
+    expense_id = vu.created.pop(vu.rng.randrange(len(vu.created)))
+    vu.request('GET', f"/delete_expense/{expense_id}", route='/delete_expense/<expense_id>', ok_statuses=(302,))
+
+def journey_export(vu):
+    vu.request('GET', '/export_expenses')
+    vu.request('GET', vu.rng.choice(['/export_user_data_csv', '/export_user_data_json']))
+
+def journey_relogin(vu):
+    vu.request('GET', '/logout', ok_statuses=(302,))
+    vu.login()
+
+def journey_admin(vu):
+    response = vu.request('GET', '/admin')
+    user_ids = _USER_EXPENSES.findall(response.text) if response is not None and response.status_code == 200 else []
+    if user_ids:
+        user_id = vu.rng.choice(user_ids)
+        vu.request('GET', f"/api/user_expenses/{user_id}", route='/api/user_expenses/<user_id>')
+    # The full export runs as a background job: start it, poll, download
+    response = vu.request('POST', '/admin/export_data', ok_statuses=(202,))
+    if response is None or response.status_code != 202:
+        return
+    job_id = response.json()['job_id']
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        response = vu.request('GET', f"/jobs/{job_id}", route='/jobs/<job_id>')
+        if response is None or response.status_code != 200:
+            return
+        job = response.json()
+        if job['status'] == 'succeeded':
+            vu.request('GET', job['download_url'], route='/jobs/<job_id>/download')
+            return
+        if job['status'] == 'failed':
+            return
+        time.sleep(0.2)
+
+# name: (default weight, journey, admin only)
+JOURNEYS = {
+    'browse': (40, journey_browse, False),
+    'filter': (15, journey_filter, False),
+    'add': (12, journey_add, False),
+    'edit': (8, journey_edit, False),
+    'delete': (5, journey_delete, False),
+    'reports': (8, journey_reports, False),
+    'export': (5, journey_export, False),
+    'relogin': (2, journey_relogin, False),
+    'admin': (5, journey_admin, True),
+}
+
+def parse_mix(spec):
+    """'browse=5,add=2' -> weights for the named journeys only"""
+    weights = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in JOURNEYS:
+            raise ValueError(f"unknown journey '{name}' (choose from {', '.join(JOURNEYS)})")
+        weights[name] = float(weight or 1)
+    return weights
+
+def run_virtual_user(vu, weights, deadline, think_ms, ready, delay=0):
+    time.sleep(delay)
+    # 503 means the password hashing pool is saturated; back off like a person would
+    for attempt in range(5):
+        status = vu.login()
+        if status != 503:
+            break
+        time.sleep(0.5 * (attempt + 1))
+    if status != 302:
+        print(f"❌ {vu.username} could not log in (status {status})", file=sys.stderr)
+        return
+    ready.append(vu.username)
+    names = [n for n in weights if weights[n] > 0 and (vu.is_admin or not JOURNEYS[n][2])]
+    if not names:
+        return
+    journey_weights = [weights[n] for n in names]
+    while time.monotonic() < deadline:
+        name = vu.rng.choices(names, journey_weights)[0]
+        JOURNEYS[name][1](vu)
+        vu.stats.journey(name)
+        if think_ms:
+            time.sleep(vu.rng.uniform(0, 2 * think_ms) / 1000.0)
+
+def scrape_db_calls(base_url, token=None):
+    """Sum/count of http_request_db_operations per route from /metrics, or None"""
+    headers = {'Authorization': f"Bearer {token}"} if token else {}
+    try:
+        response = requests.get(base_url.rstrip('/') + '/metrics', headers=headers, timeout=10)
+    except requests.RequestException:
+        return None
+    if response.status_code != 200:
+        return None
+    totals = {}
+    pattern = re.compile(r'^http_request_db_operations_(sum|count)\{route="((?:[^"\\]|\\.)*)"\} (\S+)$')
+    for line in response.text.splitlines():
+        match = pattern.match(line)
+        if match:
+            kind, route, value = match.groups()
+            entry = totals.setdefault(route, [0.0, 0.0])
+            entry[0 if kind == 'sum' else 1] += float(value)
+    return totals
+
+def db_calls_per_request(before, after):
+    if before is None or after is None:
+        return {}
+    result = {}
+    for route, (total, count) in after.items():
+        prev_total, prev_count = before.get(route, (0.0, 0.0))
+        if count > prev_count:
+            result[route] = (total - prev_total) / (count - prev_count)
+    return result
+
+def build_report(stats, elapsed, db_calls):
+    routes = {}
+    for key, samples in sorted(stats.latencies.items()):
+        samples = sorted(samples)
+        route = key.split(' ', 1)[1]
+        routes[key] = {
+            'requests': len(samples),
+            'errors': stats.errors.get(key, 0),
+            'rps': len(samples) / elapsed if elapsed else 0.0,
+            'mean_ms': sum(samples) / len(samples),
+            'p50_ms': percentile(samples, 50),
+            'p95_ms': percentile(samples, 95),
+            'p99_ms': percentile(samples, 99),
+            'max_ms': samples[-1],
+            'db_calls': db_calls.get(route),
+        }
+    total = sum(r['requests'] for r in routes.values())
+    errors = sum(r['errors'] for r in routes.values())
+    return {
+        'duration_s': elapsed,
+        'requests': total,
+        'errors': errors,
+        'rps': total / elapsed if elapsed else 0.0,
+        'error_rate': errors / total if total else 0.0,
+        'journeys': dict(stats.journeys),
+        'routes': routes,
+    }
+
+def print_report(report):
+    print(f"\n{'route':<44} {'reqs':>7} {'err':>5} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'db/req':>7}")
+    for key, r in report['routes'].items():
+        db = f"{r['db_calls']:.1f}" if r['db_calls'] is not None else '-'
+        print(f"{key:<44} {r['requests']:>7} {r['errors']:>5} {r['rps']:>8.1f} {r['p50_ms']:>8.1f} "
+              f"{r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} {db:>7}")
+    journeys = ', '.join(f"{name} {n}" for name, n in sorted(report['journeys'].items()))
+    print(f"\n🏁 {report['requests']} requests in {report['duration_s']:.1f}s = {report['rps']:.1f} req/s, "
+          f"{report['errors']} errors ({report['error_rate']:.2%})")
+    print(f"   journeys: {journeys}")
+    if 'backend' in report:
+        print(f"   backend requests: {report['backend']}")
+
+def start_local_server(args):
+    """Start the app (and an emulator, if asked) in-process; return (base_url, accounts, cleanup)"""
+    emulator = None
+    emulators = []
+    if args.backend == 'emulator':
+        from firebase_emulator import FirebaseEmulator
+        emulators = [FirebaseEmulator(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, seed=args.seed).start()
+                     for _ in range(args.shards)]
+        emulator = emulators[0]
+        os.environ['FIREBASE_BACKEND'] = 'rest'
+        os.environ['FIREBASE_DATABASE_URL'] = emulator.url
+        if args.shards > 1:
+            # The first instance is both the primary database and shard0
+            os.environ['FIREBASE_SHARDS'] = ','.join(f"shard{i}={e.url}" for i, e in enumerate(emulators))
+    else:
+        os.environ['FIREBASE_BACKEND'] = 'mock'
+
+    from werkzeug.serving import make_server
+    from synthetic_data import PROFILES, generate_dataset, load_dataset
+    from password_hashing import hash_password
+    import firebase_config
+    with contextlib.redirect_stdout(io.StringIO()):
+        from app import app
+
+    sizes = dict(PROFILES[args.profile])
+    if args.users:
+        sizes['users'] = args.users
+    if args.expenses:
+        sizes['expenses'] = args.expenses
+    print(f"🧪 Seeding {sizes['users']} users / {sizes['expenses']} expenses ({args.backend} backend)...")
+    dataset = generate_dataset(sizes['users'], sizes['expenses'], seed=args.seed, end_date=datetime.now(),
+                               password_hash=hash_password(LOADTEST_PASSWORD))
+    with contextlib.redirect_stdout(io.StringIO()):
+        if len(emulators) > 1:
+            from sharding import split_dataset
+            primary, parts = split_dataset(dataset)
+            for i, e in enumerate(emulators):
+                e.load({**primary, **parts[f"shard{i}"]} if i == 0 else parts[f"shard{i}"])
+        elif emulator:
+            emulator.load(dataset)
+        else:
+            load_dataset(firebase_config.database.resolve(), dataset)
+
+    # Admin first, then regular users
+    accounts = sorted(((u['username'], u['is_admin']) for u in dataset['users'].values()), key=lambda a: not a[1])
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, name='loadtest-server', daemon=True)
+    thread.start()
+
+    def cleanup():
+        server.shutdown()
+        for e in emulators:
+            e.stop()
+
+    def backend_requests():
+        return sum(e.stats.snapshot()['total_requests'] for e in emulators) if emulators else None
+
+    return f"http://127.0.0.1:{server.server_port}", accounts, cleanup, backend_requests
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', help='base URL of a running server (default: start one in-process)')
+    parser.add_argument('--backend', choices=['mock', 'emulator'], default='mock', help='backend for the in-process server')
+    parser.add_argument('--profile', choices=['small', 'medium', 'large'], default='small', help='seed dataset size')
+    parser.add_argument('--users', type=int, help='override number of seeded users')
+    parser.add_argument('--expenses', type=int, help='override number of seeded expenses')
+    parser.add_argument('--latency-ms', type=float, default=0, help='emulator latency per backend request')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='emulator latency jitter')
+    parser.add_argument('--shards', type=int, default=1, help='emulator instances to shard user data across')
+    parser.add_argument('--concurrency', type=int, default=10, help='number of virtual users')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run after ramp-up')
+    parser.add_argument('--ramp-up', type=float, default=0, help='seconds over which virtual users start')
+    parser.add_argument('--think-ms', type=float, default=0, help='mean pause between journeys')
+    parser.add_argument('--mix', help="journey weights, e.g. 'browse=5,add=2' (default: built-in mix)")
+    parser.add_argument('--admin-user', help='admin login for --target runs (admin journeys need one)')
+    parser.add_argument('--admin-password', help='password for --admin-user')
+    parser.add_argument('--metrics-token', default=os.environ.get('METRICS_TOKEN'), help='bearer token for /metrics')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--max-error-rate', type=float, default=0.01, help='exit non-zero above this error rate')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args(argv)
+
+    if args.shards > 1 and (args.target or args.backend != 'emulator'):
+        parser.error('--shards needs the in-process server with --backend emulator')
+
+    try:
+        weights = parse_mix(args.mix) if args.mix else {name: j[0] for name, j in JOURNEYS.items()}
+    except ValueError as e:
+        parser.error(str(e))
+
+    stats = LoadStats()
+    cleanup = backend_requests = None
+    if args.target:
+        base_url = args.target.rstrip('/')
+        run_id = uuid.uuid4().hex[:6]
+        print(f"📝 Registering {args.concurrency} users on {base_url}...")
+        vus = []
+        for i in range(args.concurrency):
+            if i == 0 and args.admin_user:
+                vus.append(VirtualUser(base_url, stats, args.admin_user, args.admin_password, True, args.seed))
+                continue
+            vu = VirtualUser(base_url, stats, f"lt{run_id}_{i}", LOADTEST_PASSWORD, False, args.seed + i)
+            if not vu.register(monthly_income=60000):
+                print(f"❌ Could not register {vu.username}")
+                return 1
+            vus.append(vu)
+    else:
+        base_url, accounts, cleanup, backend_requests = start_local_server(args)
+        vus = [VirtualUser(base_url, stats, accounts[i % len(accounts)][0], LOADTEST_PASSWORD,
+                           accounts[i % len(accounts)][1], args.seed + i) for i in range(args.concurrency)]
+
+    # Setup traffic (registration) is not part of the measurement
+    stats.reset()
+    metrics_before = scrape_db_calls(base_url, args.metrics_token)
+    backend_before = backend_requests() if backend_requests else None
+
+    print(f"🚀 {args.concurrency} virtual users for {args.duration:.0f}s against {base_url}")
+    ready = []
+    deadline = time.monotonic() + args.ramp_up + args.duration
+    quiet = io.StringIO() if cleanup else None
+    step = args.ramp_up / len(vus) if vus else 0
+    threads = [threading.Thread(target=run_virtual_user, args=(vu, weights, deadline, args.think_ms, ready, i * step),
+                                daemon=True) for i, vu in enumerate(vus)]
+    started = time.perf_counter()
+    # The in-process app prints on every database write; keep the console readable
+    with contextlib.redirect_stdout(quiet) if quiet else contextlib.nullcontext():
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started
+
+    report = build_report(stats, elapsed, db_calls_per_request(metrics_before, scrape_db_calls(base_url, args.metrics_token)))
+    report.update({'concurrency': args.concurrency, 'logged_in': len(ready), 'target': args.target or args.backend})
+    if backend_before is not None:
+        report['backend'] = backend_requests() - backend_before
+    if cleanup:
+        cleanup()
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if len(ready) < len(vus) or report['error_rate'] > args.max_error_rate:
+        print(f"❌ Run failed ({len(vus) - len(ready)} login failures, error rate {report['error_rate']:.2%})")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
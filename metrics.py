@@ -0,0 +1,277 @@
+"""
+Minimal Prometheus-style metrics registry and the app's standard metrics.
+
+Metrics live in process memory. Under gunicorn every worker keeps its own
+registry, so each scrape of /metrics reflects the worker that answered it;
+scrape workers individually (or run one worker per container) for totals.
+"""
+
+import threading
+import contextvars
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.extend(f'{n}="{_escape(v)}"' for n, v in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Metric:
+    type_name = 'untyped'
+
+    def __init__(self, name, help, labels=(), registry=None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.label_names)
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield self.name, _format_labels(self.label_names, key), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_name}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {_format_value(value)}")
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def __init__(self, name, help, labels=(), registry=None, callback=None):
+        super().__init__(name, help, labels, registry)
+        self._callback = callback
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self._callback is not None:
+            # callback returns {label values tuple: value}
+            for key, value in self._callback().items():
+                yield self.name, _format_labels(self.label_names, key), value
+            return
+        yield from super().samples()
+
+class Histogram(Metric):
+    type_name = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, help, labels=(), registry=None, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def value(self, **labels):
+        """(count, sum) for the given labels"""
+        state = self._values.get(self._key(labels))
+        return (state[2], state[1]) if state else (0, 0.0)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, (list(s[0]), s[1], s[2])) for key, s in self._values.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield self.name + '_bucket', _format_labels(self.label_names, key, [('le', _format_value(float(bound)))]), cumulative
+            yield self.name + '_sum', _format_labels(self.label_names, key), total
+            yield self.name + '_count', _format_labels(self.label_names, key), count
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        return '\n'.join(m.render() for m in metrics) + '\n'
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# HTTP requests
+HTTP_REQUESTS = Counter('http_requests_total', 'HTTP requests by route, method and status.',
+                        ('route', 'method', 'status'))
+HTTP_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency by route.',
+                         ('route', 'method'))
+HTTP_RESPONSE_BYTES = Counter('http_response_bytes_total', 'HTTP response body bytes by route.', ('route',))
+HTTP_DB_CALLS = Histogram('http_request_db_operations', 'Database operations issued per HTTP request.',
+                          ('route',), buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50))
+
+# Database operations
+DB_OPERATIONS = Counter('db_operations_total', 'Database operations by operation and top-level node.',
+                        ('backend', 'op', 'node'))
+DB_LATENCY = Histogram('db_operation_duration_seconds', 'Database operation latency.',
+                       ('backend', 'op', 'node'))
+DB_ERRORS = Counter('db_errors_total', 'Failed database operations.', ('backend', 'op', 'node'))
+DB_BYTES_SENT = Counter('db_bytes_sent_total', 'Request body bytes sent to the database.', ('backend', 'op', 'node'))
+DB_BYTES_RECEIVED = Counter('db_bytes_received_total', 'Response bytes received from the database.',
+                            ('backend', 'op', 'node'))
+DB_WRITE_CONFLICTS = Counter('db_write_conflicts_total', 'Conditional writes refused because the record had changed.',
+                             ('node',))
+
+# Background jobs
+JOBS_FINISHED = Counter('jobs_finished_total', 'Background job attempts by kind and outcome.', ('kind', 'outcome'))
+JOB_DURATION = Histogram('job_duration_seconds', 'Background job attempt duration.', ('kind',),
+                         buckets=(0.1, 0.5, 1, 5, 15, 60, 300, 900))
+
+# Write-behind buffer (write_behind.py)
+WRITE_BEHIND_WRITES = Counter('write_behind_writes_total', 'Writes acknowledged from the journal, by op and whether they coalesced.',
+                              ('op', 'coalesced'))
+WRITE_BEHIND_FLUSHES = Counter('write_behind_flushes_total', 'Batched multi-path flushes by outcome.', ('outcome',))
+WRITE_BEHIND_BATCH_PATHS = Histogram('write_behind_batch_paths', 'Paths sent per write-behind flush.',
+                                     buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500))
+WRITE_BEHIND_PENDING = Gauge('write_behind_pending', 'Acknowledged writes not yet flushed by this worker.', ('buffer',))
+
+# Outbound admission control (admission.py)
+ADMISSION_REJECTED = Counter('db_admission_rejected_total', 'Database calls refused before they were sent, by reason.',
+                             ('backend', 'reason'))
+DB_IN_FLIGHT = Gauge('db_calls_in_flight', 'Database calls currently being sent.', ('backend',))
+CIRCUIT_STATE = Gauge('db_circuit_state', 'Circuit breaker state per database (0 closed, 1 half-open, 2 open).',
+                      ('backend',))
+
+# Read retries and hedging (retries.py)
+DB_READ_RETRIES = Counter('db_read_retries_total', 'Database reads sent again after a failure, by reason.',
+                          ('backend', 'reason'))
+RETRY_BUDGET_EXHAUSTED = Counter('db_retry_budget_exhausted_total',
+                                 'Retries or hedges not sent because the retry budget was spent.', ('backend', 'kind'))
+HEDGED_READS = Counter('db_hedged_reads_total', 'Hedged database reads by which request answered first.',
+                       ('backend', 'winner'))
+
+def _hedge_win_ratios():
+    totals = {}
+    with HEDGED_READS._lock:
+        for (backend, winner), n in HEDGED_READS._values.items():
+            wins, hedged = totals.get(backend, (0, 0))
+            totals[backend] = (wins + (n if winner == 'hedge' else 0), hedged + n)
+    return {(backend,): wins / hedged for backend, (wins, hedged) in totals.items() if hedged}
+
+HEDGE_WIN_RATIO = Gauge('db_hedge_win_ratio', 'Fraction of hedged reads answered first by the hedge since start.',
+                        ('backend',), callback=_hedge_win_ratios)
+
+# Spending statistics (spending_stats.py)
+SPENDING_STATS_WRITES = Counter('spending_stats_writes_total',
+                                'Expense writes seen by cached spending statistics, by outcome (patched/rebuilt).',
+                                ('outcome',))
+SPENDING_ANOMALIES = Counter('spending_anomalies_total', 'Unusual expenses flagged as they were written.', ())
+
+# Change feed and delta sync (change_feed.py)
+CHANGE_FEED_APPENDS = Counter('change_feed_appends_total', 'Change log appends by outcome.', ('outcome',))
+SYNC_REQUESTS = Counter('sync_requests_total', 'Sync requests answered with a delta or a full reset.', ('result',))
+
+# Caches
+CACHE_LOOKUPS = Counter('cache_lookups_total', 'Cache lookups by cache and result (hit/miss).', ('cache', 'result'))
+
+def _cache_hit_ratios():
+    totals = {}
+    with CACHE_LOOKUPS._lock:
+        for (cache, result), n in CACHE_LOOKUPS._values.items():
+            hits, lookups = totals.get(cache, (0, 0))
+            totals[cache] = (hits + (n if result == 'hit' else 0), lookups + n)
+    return {(cache,): hits / lookups for cache, (hits, lookups) in totals.items() if lookups}
+
+CACHE_HIT_RATIO = Gauge('cache_hit_ratio', 'Fraction of cache lookups that were hits since start.', ('cache',),
+                        callback=_cache_hit_ratios)
+
+# Per-request database call counting (set up by the Flask hooks in app.py).
+# A context variable holding a mutable counter also follows asyncio.to_thread.
+_request_db_calls = contextvars.ContextVar('request_db_calls', default=None)
+
+def start_request_tracking():
+    _request_db_calls.set([0])
+
+def request_db_calls():
+    counter = _request_db_calls.get()
+    return counter[0] if counter else 0
+
+def node_of(path):
+    """Top-level node of a database path, used as a bounded-cardinality label"""
+    path = (path or '').strip('/')
+    return path.split('/', 1)[0] if path else '/'
+
+def observe_db_operation(backend, op, path, seconds, sent=0, received=0, error=False):
+    node = node_of(path)
+    DB_OPERATIONS.inc(backend=backend, op=op, node=node)
+    DB_LATENCY.observe(seconds, backend=backend, op=op, node=node)
+    if sent:
+        DB_BYTES_SENT.inc(sent, backend=backend, op=op, node=node)
+    if received:
+        DB_BYTES_RECEIVED.inc(received, backend=backend, op=op, node=node)
+    if error:
+        DB_ERRORS.inc(backend=backend, op=op, node=node)
+    counter = _request_db_calls.get()
+    if counter is not None:
+        counter[0] += 1
+
+def record_cache_lookup(cache, hit):
+    CACHE_LOOKUPS.inc(cache=cache, result='hit' if hit else 'miss')
+
+def observe_request(route, method, status, seconds, response_bytes):
+    HTTP_REQUESTS.inc(route=route, method=method, status=status)
+    HTTP_LATENCY.observe(seconds, route=route, method=method)
+    if response_bytes:
+        HTTP_RESPONSE_BYTES.inc(response_bytes, route=route)
+    HTTP_DB_CALLS.observe(request_db_calls(), route=route)
+    _request_db_calls.set(None)
+
+def render():
+    return REGISTRY.render()
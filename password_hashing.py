@@ -0,0 +1,103 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Hash cost settings. Changing these upgrades stored hashes on the next login.
+HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH', 16))
+
+# Pool sizing. PASSWORD_HASH_WORKERS=0 hashes inline in the request thread.
+POOL_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+QUEUE_DEPTH = int(os.environ.get('PASSWORD_HASH_QUEUE', POOL_WORKERS * 4))
+HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+
+class HashingBusyError(Exception):
+    """Raised when too many hash operations are already queued"""
+    pass
+
+class PasswordHasher:
+    """Runs password hashing and verification in a bounded process pool.
+
+    At most ``workers + queue_depth`` operations may be in flight; beyond that
+    callers get ``HashingBusyError`` immediately instead of tying up a request
+    thread behind a login storm.
+    """
+
+    def __init__(self, workers=POOL_WORKERS, queue_depth=QUEUE_DEPTH, timeout=HASH_TIMEOUT,
+                 method=HASH_METHOD, salt_length=SALT_LENGTH):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self.method = method
+        self.salt_length = salt_length
+        self._slots = threading.BoundedSemaphore(max(1, workers + queue_depth))
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        # Pools cannot be shared across fork(), so each process builds its own
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _run(self, fn, *args, **kwargs):
+        if self.workers <= 0:
+            return fn(*args, **kwargs)
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusyError("Too many password operations in progress")
+        try:
+            future = self._get_executor().submit(fn, *args, **kwargs)
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise HashingBusyError("Password operation timed out")
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, method=self.method, salt_length=self.salt_length)
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            return False
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """True if ``pwhash`` was made with different cost settings than configured"""
+        parts = (pwhash or '').split('$')
+        if len(parts) != 3:
+            return True
+        method, salt, _ = parts
+        wanted = self.method.split(':')
+        return method.split(':')[:len(wanted)] != wanted or len(salt) != self.salt_length
+
+    def _after_fork(self):
+        # The child must not touch the parent's pool or a lock held mid-fork
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(1, self.workers + self.queue_depth))
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._pid = None
+
+# Shared hasher instance
+hasher = PasswordHasher()
+os.register_at_fork(after_in_child=hasher._after_fork)
+
+def hash_password(password):
+    return hasher.hash(password)
+
+def verify_password(pwhash, password):
+    return hasher.verify(pwhash, password)
+
+def needs_rehash(pwhash):
+    return hasher.needs_rehash(pwhash)
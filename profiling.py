@@ -0,0 +1,232 @@
+"""
+Opt-in per-request tracing and profiling.
+
+A request is traced when it carries ``X-Profile: <PROFILE_TOKEN>`` (any value
+in debug mode) or is picked by ``PROFILE_SAMPLE_RATE``. Traced requests build
+a span tree covering database operations, snapshot decoding, analytics and
+template rendering. The tree is written as JSON to ``PROFILE_DIR`` and
+summarised in a ``Server-Timing`` header. ``X-Profile-Mode: cprofile`` and/or
+``memory`` add a cProfile dump and tracemalloc top allocations.
+
+When a request is not traced, ``span()`` returns a shared no-op object after
+a single context variable lookup, so the hooks cost effectively nothing.
+"""
+
+import os
+import io
+import json
+import time
+import uuid
+import random
+import pstats
+import functools
+import contextvars
+from flask import request, g, template_rendered, before_render_template
+
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+
+_current_span = contextvars.ContextVar('profiling_span', default=None)
+
+class Span:
+    __slots__ = ('name', 'attrs', 'start', 'end', 'children')
+
+    def __init__(self, name, attrs, start=None):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter() if start is None else start
+        self.end = None
+        self.children = []
+
+    @property
+    def duration_ms(self):
+        return ((self.end or time.perf_counter()) - self.start) * 1000.0
+
+    def to_dict(self, origin):
+        return {
+            'name': self.name,
+            'start_ms': round((self.start - origin) * 1000.0, 3),
+            'duration_ms': round(self.duration_ms, 3),
+            'attrs': self.attrs,
+            'children': [c.to_dict(origin) for c in self.children],
+        }
+
+class _NoopSpan:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+_NOOP = _NoopSpan()
+
+class _ActiveSpan:
+    __slots__ = ('parent', 'span', 'token')
+
+    def __init__(self, parent, name, attrs):
+        self.parent = parent
+        self.span = Span(name, attrs)
+        self.token = None
+
+    def __enter__(self):
+        self.parent.children.append(self.span)
+        self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        self.span.end = time.perf_counter()
+        if exc_type is not None:
+            self.span.attrs['error'] = exc_type.__name__
+        _current_span.reset(self.token)
+        return False
+
+def is_active():
+    return _current_span.get() is not None
+
+def span(name, **attrs):
+    """Context manager recording a child span of the current one, if tracing"""
+    parent = _current_span.get()
+    if parent is None:
+        return _NOOP
+    return _ActiveSpan(parent, name, attrs)
+
+def record_span(name, seconds, **attrs):
+    """Record an already finished operation that took ``seconds``"""
+    parent = _current_span.get()
+    if parent is None:
+        return
+    end = time.perf_counter()
+    child = Span(name, attrs, start=end - seconds)
+    child.end = end
+    parent.children.append(child)
+
+def traced(name):
+    """Decorator form of span()"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _current_span.get() is None:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _summarise(root):
+    """Total time per span category (db, decode, render, ...) for Server-Timing"""
+    totals = {}
+
+    def walk(node):
+        for child in node.children:
+            category = child.name.split('.', 1)[0]
+            ms, count = totals.get(category, (0.0, 0))
+            totals[category] = (ms + child.duration_ms, count + 1)
+            if category not in ('db',):
+                walk(child)
+    walk(root)
+    return totals
+
+def _wants_trace(app):
+    header = request.headers.get('X-Profile')
+    if header is not None:
+        if PROFILE_TOKEN:
+            return header == PROFILE_TOKEN
+        return app.debug
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def init_app(app):
+    """Register the request hooks and template signals on ``app``"""
+
+    @app.before_request
+    def start_profiling():
+        if not _wants_trace(app):
+            return
+        root = Span(f"{request.method} {request.path}", {'endpoint': request.endpoint})
+        g.profile = {
+            'id': uuid.uuid4().hex[:12],
+            'root': root,
+            'token': _current_span.set(root),
+            'render_stack': [],
+        }
+        modes = (request.headers.get('X-Profile-Mode') or '').split(',')
+        if 'cprofile' in modes:
+            import cProfile
+            g.profile['cprofile'] = cProfile.Profile()
+            g.profile['cprofile'].enable()
+        if 'memory' in modes:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                g.profile['tracemalloc'] = True
+
+    @app.after_request
+    def finish_profiling(response):
+        state = g.pop('profile', None)
+        if state is None:
+            return response
+        root = state['root']
+        root.end = time.perf_counter()
+        _current_span.reset(state['token'])
+        root.attrs['status'] = response.status_code
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{request.endpoint or 'unmatched'}-{state['id']}")
+
+        if 'cprofile' in state:
+            profiler = state['cprofile']
+            profiler.disable()
+            profiler.dump_stats(base + '.prof')
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(40)
+            with open(base + '.prof.txt', 'w') as f:
+                f.write(out.getvalue())
+        if state.get('tracemalloc'):
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(base + '.memory.txt', 'w') as f:
+                f.write(f"peak: {peak / 1024:.1f} KiB\n\n")
+                for stat in snapshot.statistics('lineno')[:30]:
+                    f.write(f"{stat}\n")
+
+        with open(base + '.json', 'w') as f:
+            json.dump(root.to_dict(root.start), f, indent=2)
+
+        totals = _summarise(root)
+        timings = [f"{name};dur={ms:.1f};desc=\"{count}x\"" for name, (ms, count) in totals.items()]
+        timings.append(f"total;dur={root.duration_ms:.1f}")
+        response.headers['Server-Timing'] = ', '.join(timings)
+        response.headers['X-Profile-Id'] = state['id']
+        parts = ', '.join(f"{name} {ms:.1f}ms x{count}" for name, (ms, count) in totals.items())
+        print(f"🔬 Profiled {root.name} in {root.duration_ms:.1f}ms ({parts}) -> {base}.json")
+        return response
+
+    @app.teardown_request
+    def abandon_profiling(exc):
+        # after_request is skipped on unhandled errors; don't leak the trace
+        state = g.pop('profile', None)
+        if state is not None:
+            _current_span.reset(state['token'])
+            if 'cprofile' in state:
+                state['cprofile'].disable()
+            if state.get('tracemalloc'):
+                import tracemalloc
+                tracemalloc.stop()
+
+    def render_started(sender, template, context, **extra):
+        if _current_span.get() is None:
+            return
+        active = span('render.template', template=template.name)
+        active.__enter__()
+        g.profile['render_stack'].append(active)
+
+    def render_finished(sender, template, context, **extra):
+        state = g.get('profile')
+        if state and state['render_stack']:
+            state['render_stack'].pop().__exit__(None, None, None)
+
+    # Receivers are local functions, so keep strong references to them
+    before_render_template.connect(render_started, app, weak=False)
+    template_rendered.connect(render_finished, app, weak=False)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Inspect and rebalance how users are spread across database shards.
+
+Reads FIREBASE_DATABASE_URL / FIREBASE_SHARDS like the app (see
+sharding.py). ``status`` counts users per shard and how many are not where
+the hash ring places them; ``rebalance`` moves those users (or one user,
+with ``--user``/``--to``) one at a time.
+
+    python rebalance.py status
+    python rebalance.py rebalance --dry-run
+    python rebalance.py rebalance --user <user_id> --to shard2
+
+Each move waits ``--settle`` seconds (default: SHARD_DIRECTORY_TTL + 2)
+twice so that running app workers stop writing to the source shard before
+it is copied and stop reading it before it is deleted. Use ``--settle 0``
+only when no app workers are running.
+"""
+
+import sys
+import argparse
+from collections import Counter
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['status', 'rebalance'])
+    parser.add_argument('--dry-run', action='store_true', help='list the moves without making them')
+    parser.add_argument('--user', help='move only this user id')
+    parser.add_argument('--to', help='target shard for --user (default: where the ring places the user)')
+    parser.add_argument('--settle', type=float, help='seconds to wait for app workers to see each directory change')
+    parser.add_argument('--limit', type=int, help='move at most this many users')
+    args = parser.parse_args(argv)
+
+    from firebase_config import database
+    from sharding import shard_map, plan_rebalance, move_user
+
+    if not shard_map.sharded:
+        print("ℹ️ FIREBASE_SHARDS lists fewer than two shards; nothing to do")
+        return 0
+
+    user_ids = list((database.child("users").get().val() or {}).keys())
+    if args.command == 'status':
+        placement = Counter(shard_map.shard_for(user_id).name for user_id in user_ids)
+        for shard in shard_map.all():
+            print(f"📦 {shard.name}: {placement.get(shard.name, 0)} users")
+        print(f"   {len(plan_rebalance(user_ids))} of {len(user_ids)} users are not on their ring shard")
+        return 0
+
+    if args.to and not args.user:
+        parser.error('--to needs --user')
+    if args.to and args.to not in shard_map.shards:
+        parser.error(f"unknown shard '{args.to}' (have: {', '.join(shard_map.shards)})")
+    if args.user:
+        current = shard_map.shard_for(args.user).name
+        moves = [(args.user, current, args.to or shard_map.ring.lookup(args.user))]
+        moves = [move for move in moves if move[1] != move[2]]
+    else:
+        moves = plan_rebalance(user_ids)
+    if args.limit is not None:
+        moves = moves[:args.limit]
+
+    if not moves:
+        print("✅ Every user is already on the right shard")
+        return 0
+    failed = 0
+    for user_id, current, target in moves:
+        if args.dry_run:
+            print(f"   would move {user_id}: {current} -> {target}")
+            continue
+        try:
+            move_user(user_id, target, settle=args.settle)
+        except Exception as e:
+            failed += 1
+            print(f"❌ Could not move {user_id}: {e}")
+    if not args.dry_run:
+        print(f"✅ Moved {len(moves) - failed} users, {failed} failed")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+"""
+Range-query aggregation for the reports API.
+
+Each scope (one user, or everyone for admins) gets a ``TimeIndex``: the
+distinct expense days in sorted order plus prefix sums of the amounts per
+day, overall and split by category and by type. Summing any date range is
+two binary searches and a subtraction, so a report with k buckets costs
+O(k log d) for d distinct days instead of a scan over every expense.
+
+Indexes are built on first use and dropped when firebase_db reports a write
+to the user's expenses. ``REPORT_INDEX_TTL`` bounds how long a worker keeps
+an index that another gunicorn worker's writes may have made stale.
+"""
+
+import os
+import time
+import bisect
+import threading
+from datetime import date, timedelta
+from collections import defaultdict
+import metrics
+from profiling import traced
+from analytics import MONTH_LABELS, parse_expense_date
+from firebase_db import FirebaseExpense, on_user_data_change
+
+REPORT_INDEX_TTL = float(os.environ.get('REPORT_INDEX_TTL', 60))
+GRANULARITIES = ('day', 'week', 'month', 'year')
+SPLITS = ('category', 'type')
+MAX_BUCKETS = 1000
+ALL_USERS = '*'
+TOTAL = ('total', None)
+
+class TimeIndex:
+    """Per-day expense totals in date order with prefix sums per split key"""
+
+    def __init__(self, expenses):
+        per_day = defaultdict(lambda: defaultdict(float))
+        for expense in expenses:
+            day = parse_expense_date(expense.date).date().toordinal()
+            amounts = per_day[day]
+            amounts[TOTAL] += expense.amount
+            amounts[('category', expense.category)] += expense.amount
+            amounts[('type', expense.expense_type)] += expense.amount
+
+        self.days = sorted(per_day)
+        keys = set()
+        for amounts in per_day.values():
+            keys.update(amounts)
+        self.prefix = {}
+        for key in keys:
+            running = 0.0
+            sums = [0.0]
+            for day in self.days:
+                running += per_day[day].get(key, 0.0)
+                sums.append(running)
+            self.prefix[key] = sums
+
+    def __len__(self):
+        return len(self.days)
+
+    @property
+    def first_date(self):
+        return date.fromordinal(self.days[0]) if self.days else None
+
+    @property
+    def last_date(self):
+        return date.fromordinal(self.days[-1]) if self.days else None
+
+    def keys(self, split):
+        """Values seen for a split ('category' or 'type'), sorted"""
+        return sorted(value for kind, value in self.prefix if kind == split)
+
+    def sum(self, start, end, key=TOTAL):
+        """Total for the inclusive date range [start, end]"""
+        sums = self.prefix.get(key)
+        if sums is None:
+            return 0.0
+        i = bisect.bisect_left(self.days, start.toordinal())
+        j = bisect.bisect_right(self.days, end.toordinal())
+        return sums[j] - sums[i] if j > i else 0.0
+
+def bucket_start(day, granularity):
+    if granularity == 'day':
+        return day
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day.replace(month=1, day=1)
+
+def next_bucket(start, granularity):
+    if granularity == 'day':
+        return start + timedelta(days=1)
+    if granularity == 'week':
+        return start + timedelta(days=7)
+    if granularity == 'month':
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return start.replace(year=start.year + 1)
+
+def bucket_label(start, granularity):
+    if granularity == 'day':
+        return start.isoformat()
+    if granularity == 'week':
+        year, week, _ = start.isocalendar()
+        return f"{year}-W{week:02d}"
+    if granularity == 'month':
+        return start.strftime('%Y-%m')
+    return str(start.year)
+
+def buckets(start, end, granularity):
+    """(label, first day, last day) for each bucket overlapping [start, end]"""
+    result = []
+    current = bucket_start(start, granularity)
+    while current <= end:
+        following = next_bucket(current, granularity)
+        result.append((bucket_label(current, granularity), max(current, start), min(following - timedelta(days=1), end)))
+        if len(result) > MAX_BUCKETS:
+            raise ValueError(f"Range too large for {granularity} granularity (max {MAX_BUCKETS} buckets)")
+        current = following
+    return result
+
+@traced('reports.range_report')
+def range_report(index, start=None, end=None, granularity='month', split=None):
+    """Bucketed totals between ``start`` and ``end`` (inclusive), optionally split"""
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"Invalid granularity '{granularity}'")
+    if split not in (None,) + SPLITS:
+        raise ValueError(f"Invalid split '{split}'")
+    # Default to today, or later if expenses were entered ahead of time
+    end = end or max(date.today(), index.last_date or date.today())
+    start = start or index.first_date or end
+    if start > end:
+        raise ValueError("start must not be after end")
+
+    periods = buckets(start, end, granularity)
+    keys = [(split, value) for value in index.keys(split)] if split else [TOTAL]
+    series = {}
+    for key in keys:
+        values = [round(index.sum(first, last, key), 2) for _, first, last in periods]
+        if split and not any(values):
+            continue
+        series[key[1] if split else 'total'] = values
+
+    return {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'granularity': granularity,
+        'split': split,
+        'labels': [label for label, _, _ in periods],
+        'series': series,
+        'totals': {name: round(sum(values), 2) for name, values in series.items()},
+        'total': round(index.sum(start, end), 2),
+    }
+
+def parse_report_args(args):
+    """range_report() keyword arguments from a request's query string"""
+    try:
+        start = date.fromisoformat(args['start']) if args.get('start') else None
+        end = date.fromisoformat(args['end']) if args.get('end') else None
+    except ValueError:
+        raise ValueError("Dates must be YYYY-MM-DD")
+    split = args.get('split') or None
+    return {
+        'start': start,
+        'end': end,
+        'granularity': args.get('granularity', 'month'),
+        'split': None if split == 'none' else split,
+    }
+
+def monthly_chart(index, year):
+    """The /api/chart_data?type=monthly payload for one calendar year"""
+    data = []
+    for month in range(1, 13):
+        first = date(year, month, 1)
+        data.append(round(index.sum(first, next_bucket(first, 'month') - timedelta(days=1)), 2))
+    return {'labels': MONTH_LABELS, 'data': data}
+
+class ReportIndexCache:
+    """TimeIndex per scope, versioned like UserSessionCache so a build that
+    raced a write is never kept"""
+
+    def __init__(self, ttl=None):
+        self.ttl = REPORT_INDEX_TTL if ttl is None else ttl
+        self._entries = {}  # scope -> (index, version, expires_at)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, scope, load):
+        entry = self._entries.get(scope)
+        if entry is not None:
+            index, version, expires_at = entry
+            if version == self._versions.get(scope, 0) and expires_at >= time.monotonic():
+                metrics.record_cache_lookup('report_index', True)
+                return index
+        metrics.record_cache_lookup('report_index', False)
+
+        with self._lock:
+            version = self._versions.get(scope, 0)
+        index = TimeIndex(load())
+        if self.ttl > 0:
+            with self._lock:
+                if version == self._versions.get(scope, 0):
+                    self._entries[scope] = (index, version, time.monotonic() + self.ttl)
+        return index
+
+    def invalidate(self, user_id, kind=None, change=None):
+        if kind not in (None, 'expenses'):
+            return
+        with self._lock:
+            for scope in (user_id, ALL_USERS):
+                self._versions[scope] = self._versions.get(scope, 0) + 1
+                self._entries.pop(scope, None)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            for scope in self._entries:
+                self._versions[scope] = self._versions.get(scope, 0) + 1
+            self._entries.clear()
+
+# Shared cache, kept current by firebase_db writes
+report_indexes = ReportIndexCache()
+on_user_data_change(report_indexes.invalidate)
+os.register_at_fork(after_in_child=report_indexes._after_fork)
+
+def get_index(user_id, is_admin=False):
+    """The index admins and users see on their reports (admins: everyone's expenses)"""
+    if is_admin:
+        return report_indexes.get(ALL_USERS, FirebaseExpense.get_all_expenses)
+    return report_indexes.get(user_id, lambda: FirebaseExpense.get_by_user_id(user_id))
@@ -0,0 +1,270 @@
+"""
+Retries and hedging for database reads.
+
+Reads are idempotent, so a read that fails on a connection error, timeout or
+5xx answer is sent again, up to ``DB_READ_RETRIES`` times, after a sleep
+drawn uniformly from ``[0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2**n)]``
+("full jitter", so retrying clients spread out instead of arriving
+together). Calls refused by admission control (see admission.py) are not
+retried: the point of refusing them is to shed load.
+
+With ``HEDGE_READS=1`` a read that has not answered within the database's
+recent p95 latency is sent a second time and the first good answer wins.
+Since at most about one read in twenty waits that long, this adds about 5%
+more reads and cuts the tail that slow or dropped responses cause. Until
+``HEDGE_MIN_SAMPLES`` latencies are known, reads are not hedged.
+
+Retries and hedges both draw on a per-database budget: every read earns
+``RETRY_BUDGET_RATIO`` of a token, plus ``RETRY_BUDGET_MIN`` tokens a second,
+and each extra request spends one. When a database is failing outright the
+budget runs dry and reads fail after a single attempt instead of
+multiplying the load.
+"""
+
+import os
+import time
+import random
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import metrics
+from admission import BackendUnavailable, gate
+
+DB_READ_RETRIES = int(os.environ.get('DB_READ_RETRIES', 2))
+RETRY_BACKOFF = float(os.environ.get('RETRY_BACKOFF', 0.05))
+RETRY_BACKOFF_MAX = float(os.environ.get('RETRY_BACKOFF_MAX', 1.0))
+RETRY_BUDGET_RATIO = float(os.environ.get('RETRY_BUDGET_RATIO', 0.1))
+RETRY_BUDGET_MIN = float(os.environ.get('RETRY_BUDGET_MIN', 1))
+HEDGE_READS = os.environ.get('HEDGE_READS', '0') == '1'
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', 95))
+HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', 0.01))
+HEDGE_MIN_SAMPLES = int(os.environ.get('HEDGE_MIN_SAMPLES', 50))
+HEDGE_WORKERS = int(os.environ.get('HEDGE_WORKERS', 32))
+
+class RetryBudget:
+    """Tokens for extra requests: ``ratio`` per read, ``per_second`` over time, at most ``cap``"""
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, per_second=RETRY_BUDGET_MIN, cap=None):
+        self.ratio = ratio
+        self.per_second = per_second
+        self.cap = cap if cap is not None else max(10.0, per_second * 10)
+        self.tokens = self.cap
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.cap, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """True if an extra request may be sent"""
+        now = time.monotonic()
+        with self._lock:
+            self.tokens = min(self.cap, self.tokens + (now - self._updated) * self.per_second)
+            self._updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+class LatencyWindow:
+    """The last ``size`` successful read latencies, for the hedge delay"""
+
+    def __init__(self, size=200):
+        self.size = size
+        self._samples = []
+        self._count = 0
+        self._cached = None
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            if len(self._samples) < self.size:
+                self._samples.append(seconds)
+            else:
+                self._samples[self._count % self.size] = seconds
+            self._count += 1
+            # Re-sorted lazily, at most once every 10 samples
+            if self._count % 10 == 0:
+                self._cached = None
+
+    def hedge_delay(self):
+        """Seconds to wait before hedging, or None while too few latencies are known"""
+        with self._lock:
+            if len(self._samples) < HEDGE_MIN_SAMPLES:
+                return None
+            if self._cached is None:
+                ordered = sorted(self._samples)
+                index = min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE / 100))
+                self._cached = max(HEDGE_MIN_DELAY, ordered[index])
+            return self._cached
+
+def _retryable(response):
+    return getattr(response, 'status_code', 200) >= 500
+
+def _backoff(attempt):
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * (2 ** attempt)))
+
+class ReadPolicy:
+    """Retries and hedging for the reads of one database (one per admission Gate)"""
+
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, name):
+        self.name = name
+        self.budget = RetryBudget()
+        self.latency = LatencyWindow()
+
+    @classmethod
+    def _pool(cls):
+        if cls._executor is None:
+            with cls._executor_lock:
+                if cls._executor is None:
+                    cls._executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='hedged-read')
+        return cls._executor
+
+    def _spend(self, kind):
+        if self.budget.withdraw():
+            return True
+        metrics.RETRY_BUDGET_EXHAUSTED.inc(backend=self.name, kind=kind)
+        return False
+
+    def _timed(self, send):
+        started = time.perf_counter()
+        response = send()
+        if not _retryable(response):
+            self.latency.observe(time.perf_counter() - started)
+        return response
+
+    async def _timed_async(self, send):
+        started = time.perf_counter()
+        response = await send()
+        if not _retryable(response):
+            self.latency.observe(time.perf_counter() - started)
+        return response
+
+    def _hedged(self, send):
+        delay = self.latency.hedge_delay() if HEDGE_READS else None
+        if delay is None:
+            return self._timed(send)
+        # The calling thread waits on the pool so it can take whichever answer comes first
+        pool = self._pool()
+        pending = {pool.submit(contextvars.copy_context().run, self._timed, send): 'primary'}
+        done, _ = wait(pending, timeout=delay)
+        if not done and self._spend('hedge'):
+            pending[pool.submit(contextvars.copy_context().run, self._timed, send)] = 'hedge'
+        hedged = len(pending) > 1
+        result = error = None
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                role = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if not _retryable(result) or not pending:
+                    if hedged:
+                        metrics.HEDGED_READS.inc(backend=self.name, winner=role)
+                    # A slower twin keeps its slot until it finishes; its answer is dropped
+                    return result
+        if result is not None:
+            return result
+        raise error
+
+    async def _hedged_async(self, send):
+        delay = self.latency.hedge_delay() if HEDGE_READS else None
+        if delay is None:
+            return await self._timed_async(send)
+        primary = asyncio.ensure_future(self._timed_async(send))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not self._spend('hedge'):
+            return await primary
+        pending = {primary: 'primary', asyncio.ensure_future(self._timed_async(send)): 'hedge'}
+        result = error = None
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    role = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        error = e
+                        continue
+                    if not _retryable(result) or not pending:
+                        metrics.HEDGED_READS.inc(backend=self.name, winner=role)
+                        return result
+        finally:
+            # Unlike a thread, the slower request can be abandoned
+            for task in pending:
+                task.cancel()
+        if result is not None:
+            return result
+        raise error
+
+    def read(self, send):
+        """``send()`` (one admitted GET) with hedging and retries; the last response, or raises"""
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            try:
+                response = self._hedged(send)
+                if not _retryable(response) or attempt >= DB_READ_RETRIES or not self._spend('retry'):
+                    return response
+                reason = f"http_{response.status_code}"
+            except BackendUnavailable:
+                raise
+            except Exception:
+                if attempt >= DB_READ_RETRIES or not self._spend('retry'):
+                    raise
+                reason = 'error'
+            metrics.DB_READ_RETRIES.inc(backend=self.name, reason=reason)
+            time.sleep(_backoff(attempt))
+            attempt += 1
+
+    async def read_async(self, send):
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            try:
+                response = await self._hedged_async(send)
+                if not _retryable(response) or attempt >= DB_READ_RETRIES or not self._spend('retry'):
+                    return response
+                reason = f"http_{response.status_code}"
+            except BackendUnavailable:
+                raise
+            except Exception:
+                if attempt >= DB_READ_RETRIES or not self._spend('retry'):
+                    raise
+                reason = 'error'
+            metrics.DB_READ_RETRIES.inc(backend=self.name, reason=reason)
+            await asyncio.sleep(_backoff(attempt))
+            attempt += 1
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+def policy(base_url):
+    """The ReadPolicy of the database at ``base_url``, keyed like its admission Gate"""
+    name = gate(base_url).name
+    found = _policies.get(name)
+    if found is None:
+        with _policies_lock:
+            found = _policies.setdefault(name, ReadPolicy(name))
+    return found
+
+def _after_fork():
+    global _policies_lock
+    _policies_lock = threading.Lock()
+    # Pool threads do not survive a fork
+    ReadPolicy._executor = None
+    ReadPolicy._executor_lock = threading.Lock()
+    for found in _policies.values():
+        found.budget._lock = threading.Lock()
+        found.latency._lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_after_fork)
@@ -42,4 +42,11 @@ echo "💡 Tip: Add to home screen for the best experience!"
 echo ""
 
 # Start the application
+if [ "$1" = "prod" ]; then
+    echo "📦 Building static assets..."
+    python3 assets.py
+    echo "🏭 Starting production server (gunicorn)..."
+    exec gunicorn -c gunicorn.conf.py wsgi:app
+fi
+
 python3 app.py
@@ -0,0 +1,205 @@
+"""
+Full-text search over expense descriptions and categories.
+
+Each scope (one user, or everyone for admins) keeps an inverted index:
+token -> {expense id: weight}, plus the vocabulary in sorted order so a
+query token matches every indexed token it is a prefix of with a binary
+search. The index is built from one read the first time a scope is
+searched and then patched in place by the firebase_db write hook on every
+expense create, edit and delete, so a search only touches matching
+expenses.
+
+Results must match every query token (as a prefix) and are ranked by a
+tf-idf style score, exact token matches first, then newest first.
+``SEARCH_INDEX_TTL`` bounds how long a worker trusts an index that another
+gunicorn worker's writes could have made stale.
+"""
+
+import os
+import re
+import math
+import time
+import bisect
+import threading
+import metrics
+from profiling import traced
+from firebase_db import FirebaseExpense, on_user_data_change
+
+SEARCH_INDEX_TTL = float(os.environ.get('SEARCH_INDEX_TTL', 300))
+DESCRIPTION_WEIGHT = 1.0
+CATEGORY_WEIGHT = 0.5
+ALL_USERS = '*'
+
+_TOKEN = re.compile(r'\w+')
+
+def tokenize(text):
+    return _TOKEN.findall((text or '').lower())
+
+class ExpenseSearchIndex:
+    """Inverted index over one scope's expenses"""
+
+    def __init__(self, expenses=()):
+        self.docs = {}      # expense id -> (FirebaseExpense, {token: weight})
+        self.postings = {}  # token -> {expense id: weight}
+        self.vocab = []     # sorted tokens, for prefix lookups
+        self._lock = threading.RLock()
+        for expense in expenses:
+            self.add(expense)
+
+    def __len__(self):
+        return len(self.docs)
+
+    @staticmethod
+    def _terms(expense):
+        terms = {}
+        for token in tokenize(expense.description):
+            terms[token] = terms.get(token, 0.0) + DESCRIPTION_WEIGHT
+        for token in tokenize(expense.category):
+            terms[token] = terms.get(token, 0.0) + CATEGORY_WEIGHT
+        return terms
+
+    def add(self, expense):
+        """Index a new expense, or re-index an edited one"""
+        with self._lock:
+            self.remove(expense.id)
+            terms = self._terms(expense)
+            self.docs[expense.id] = (expense, terms)
+            for token, weight in terms.items():
+                posting = self.postings.get(token)
+                if posting is None:
+                    posting = self.postings[token] = {}
+                    bisect.insort(self.vocab, token)
+                posting[expense.id] = weight
+
+    def remove(self, expense_id):
+        with self._lock:
+            entry = self.docs.pop(expense_id, None)
+            if entry is None:
+                return
+            for token in entry[1]:
+                posting = self.postings[token]
+                posting.pop(expense_id, None)
+                if not posting:
+                    del self.postings[token]
+                    del self.vocab[bisect.bisect_left(self.vocab, token)]
+
+    def expand(self, prefix):
+        """Every indexed token starting with ``prefix``"""
+        # They sort together: from the prefix itself up to its longest possible completion
+        start = bisect.bisect_left(self.vocab, prefix)
+        end = bisect.bisect_right(self.vocab, prefix + '\U0010ffff', start)
+        return self.vocab[start:end]
+
+    def search(self, query, predicate=None):
+        """Expenses matching every token of ``query``, best first.
+
+        The returned objects are shared with the index; treat them as read-only.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+        with self._lock:
+            total_docs = len(self.docs)
+            scores = None
+            for term in terms:
+                best = {}
+                for token in self.expand(term):
+                    posting = self.postings[token]
+                    idf = math.log(1 + total_docs / len(posting))
+                    # Whole-word matches outrank completions of a prefix
+                    closeness = 1.0 if token == term else 0.5 + 0.5 * len(term) / len(token)
+                    for expense_id, weight in posting.items():
+                        score = weight * idf * closeness
+                        if score > best.get(expense_id, 0.0):
+                            best[expense_id] = score
+                if scores is None:
+                    scores = best
+                else:
+                    scores = {eid: scores[eid] + score for eid, score in best.items() if eid in scores}
+                if not scores:
+                    return []
+            matches = [(score, self.docs[eid][0]) for eid, score in scores.items()]
+
+        if predicate is not None:
+            matches = [m for m in matches if predicate(m[1])]
+        # Newest first, then a stable sort by score
+        matches.sort(key=lambda m: m[1].date, reverse=True)
+        matches.sort(key=lambda m: m[0], reverse=True)
+        return [expense for _, expense in matches]
+
+class SearchIndexCache:
+    """ExpenseSearchIndex per scope, patched by writes and versioned like
+    UserSessionCache so an index built while a write landed is not kept"""
+
+    def __init__(self, ttl=None):
+        self.ttl = SEARCH_INDEX_TTL if ttl is None else ttl
+        self._entries = {}  # scope -> (index, version, expires_at)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, scope, load):
+        entry = self._entries.get(scope)
+        if entry is not None:
+            index, version, expires_at = entry
+            if version == self._versions.get(scope, 0) and expires_at >= time.monotonic():
+                metrics.record_cache_lookup('search_index', True)
+                return index
+        metrics.record_cache_lookup('search_index', False)
+
+        with self._lock:
+            version = self._versions.get(scope, 0)
+        index = ExpenseSearchIndex(load())
+        if self.ttl > 0:
+            with self._lock:
+                if version == self._versions.get(scope, 0):
+                    self._entries[scope] = (index, version, time.monotonic() + self.ttl)
+        return index
+
+    def apply(self, user_id, kind, change=None):
+        """Write hook: patch cached indexes in place, or drop them after bulk writes"""
+        if kind != 'expenses':
+            return
+        with self._lock:
+            for scope in (user_id, ALL_USERS):
+                version = self._versions[scope] = self._versions.get(scope, 0) + 1
+                entry = self._entries.get(scope)
+                if entry is None:
+                    continue
+                if change is None:
+                    del self._entries[scope]
+                    continue
+                index, _, expires_at = entry
+                if change['data'] is None:
+                    index.remove(change['id'])
+                else:
+                    index.add(FirebaseExpense(change['data'], change['id']))
+                self._entries[scope] = (index, version, expires_at)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            for scope in self._entries:
+                self._versions[scope] = self._versions.get(scope, 0) + 1
+            self._entries.clear()
+
+# Shared cache, kept current by firebase_db writes
+search_indexes = SearchIndexCache()
+on_user_data_change(search_indexes.apply)
+os.register_at_fork(after_in_child=search_indexes._after_fork)
+
+@traced('search.expenses')
+def search_expenses(query, user_id=None, is_admin=False, category=None, expense_type=None,
+                    start_date=None, end_date=None):
+    """Ranked text search combined with the same filters as get_filtered_expenses"""
+    if is_admin:
+        index = search_indexes.get(ALL_USERS, FirebaseExpense.get_all_expenses)
+    else:
+        index = search_indexes.get(user_id, lambda: FirebaseExpense.get_by_user_id(user_id))
+
+    def predicate(expense):
+        return FirebaseExpense.matches_filters(expense, category, expense_type, start_date, end_date)
+
+    filtered = category or expense_type or start_date or end_date
+    return index.search(query, predicate if filtered else None)
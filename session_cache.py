@@ -0,0 +1,71 @@
+import os
+import copy
+import time
+import threading
+import metrics
+
+class UserSessionCache:
+    """Short-lived cache of loaded users for the Flask-Login user_loader.
+
+    Entries are keyed by user id and expire after ``ttl`` seconds. Every
+    invalidation bumps a per-user version stamp; a load that started before
+    the invalidation carries the old stamp and is refused by ``put``, so a
+    stale user (e.g. an old ``is_admin`` flag) is never cached again.
+    """
+
+    def __init__(self, ttl=None):
+        if ttl is None:
+            ttl = float(os.environ.get('USER_CACHE_TTL', 30))
+        self.ttl = ttl
+        self._entries = {}  # user_id -> (user, version, expires_at)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def version(self, user_id):
+        with self._lock:
+            return self._versions.get(user_id, 0)
+
+    def get(self, user_id):
+        """Return a private copy of the cached user, or None on miss/expiry"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            metrics.record_cache_lookup('user_session', False)
+            return None
+        user, version, expires_at = entry
+        if expires_at < time.monotonic() or version != self._versions.get(user_id, 0):
+            with self._lock:
+                if self._entries.get(user_id) is entry:
+                    del self._entries[user_id]
+            metrics.record_cache_lookup('user_session', False)
+            return None
+        metrics.record_cache_lookup('user_session', True)
+        # Views mutate current_user before saving, so never hand out the shared object
+        return copy.copy(user)
+
+    def put(self, user_id, user, version):
+        """Cache a user loaded while ``version`` was current"""
+        if self.ttl <= 0:
+            return False
+        with self._lock:
+            if version != self._versions.get(user_id, 0):
+                return False
+            self._entries[user_id] = (copy.copy(user), version, time.monotonic() + self.ttl)
+            return True
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._entries.pop(user_id, None)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            for user_id in self._entries:
+                self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._entries.clear()
+
+# Shared cache instance
+user_cache = UserSessionCache()
+os.register_at_fork(after_in_child=user_cache._after_fork)
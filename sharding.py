@@ -0,0 +1,300 @@
+"""
+Sharding of per-user data across several Realtime Database instances.
+
+``FIREBASE_SHARDS`` lists the instances as ``name=url`` pairs separated by
+commas (a bare URL is named ``shard<i>`` by position, so keep the order
+stable). Each user's expenses and savings goals live on one shard; users,
+the shard directory and background jobs stay in the primary database
+(``FIREBASE_DATABASE_URL``), which may itself be one of the shards.
+
+New users are placed by consistent hashing (``SHARD_VNODES`` points per
+shard on the ring) and their placement is recorded in the directory under
+``user_shards/<user_id>``, so adding a shard never moves anyone implicitly.
+Users with no directory entry predate sharding and are read from the first
+shard. ``rebalance.py`` moves users to where the ring now places them.
+
+Directory entries are cached for ``SHARD_DIRECTORY_TTL`` seconds. While a
+user is being moved their entry carries ``moving_to``; writes for them are
+refused with ``ShardMoving`` (a retryable 503) and reads keep using the
+source shard until the copy is complete.
+
+Without ``FIREBASE_SHARDS`` there is a single shard backed by the primary
+database and none of this adds a round trip.
+"""
+
+import os
+import time
+import bisect
+import asyncio
+import hashlib
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from firebase_config import (database, async_database, LazyDatabase, FirebaseRESTDatabase, MockDatabase,
+                             get_async_database)
+from write_behind import WriteBuffer, write_buffer, WRITE_BEHIND, WRITE_BEHIND_DIR
+
+FIREBASE_SHARDS = os.environ.get('FIREBASE_SHARDS', '')
+SHARD_VNODES = int(os.environ.get('SHARD_VNODES', 64))
+SHARD_DIRECTORY_TTL = float(os.environ.get('SHARD_DIRECTORY_TTL', 30))
+SHARD_SCATTER_WORKERS = int(os.environ.get('SHARD_SCATTER_WORKERS', 8))
+SHARDED_NODES = ('expenses', 'savings_goals')
+# Nodes holding one subtree per user id (see archive.py and change_feed.py)
+USER_KEYED_NODES = ('expense_archive', 'expense_archive_summaries', 'change_log')
+
+class ShardMoving(Exception):
+    """The user's data is being moved to another shard; retry shortly"""
+
+class Shard:
+    def __init__(self, name, db, async_db, buffer):
+        self.name = name
+        self.database = db
+        self.async_database = async_db
+        self.write_buffer = buffer
+
+    def __repr__(self):
+        return f"Shard({self.name!r})"
+
+def _backend(url):
+    """Database for one shard URL; ``mock://name`` keeps an isolated subtree of the mock store"""
+    if url.startswith('mock://'):
+        return MockDatabase(f"__shards/{url[len('mock://'):]}")
+    return FirebaseRESTDatabase(url)
+
+def parse_shards(spec):
+    """[(name, url)] from a FIREBASE_SHARDS value"""
+    shards = []
+    for i, part in enumerate(p.strip() for p in spec.split(',') if p.strip()):
+        name, sep, url = part.partition('=')
+        if not sep or '://' in name:
+            name, url = f"shard{i}", part
+        shards.append((name.strip(), url.strip()))
+    return shards
+
+def _point(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+class HashRing:
+    """Consistent hashing: each shard owns ``vnodes`` points on a 64-bit ring"""
+
+    def __init__(self, names, vnodes=SHARD_VNODES):
+        self.points = sorted((_point(f"{name}#{i}"), name) for name in names for i in range(vnodes))
+        self._keys = [point for point, _ in self.points]
+
+    def lookup(self, key):
+        i = bisect.bisect(self._keys, _point(key)) % len(self._keys)
+        return self.points[i][1]
+
+class ShardMap:
+    def __init__(self, shards, directory=database, ttl=SHARD_DIRECTORY_TTL, workers=SHARD_SCATTER_WORKERS):
+        self.shards = {shard.name: shard for shard in shards}
+        self.default = shards[0]
+        self.ring = HashRing(list(self.shards))
+        self.directory = directory
+        self.ttl = ttl
+        self.workers = workers
+        self._after_fork()
+
+    def _after_fork(self):
+        self._entries = {}  # user_id -> (entry, expires_at)
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def sharded(self):
+        return len(self.shards) > 1
+
+    def all(self):
+        return list(self.shards.values())
+
+    # Directory
+
+    def _cached(self, user_id):
+        cached = self._entries.get(user_id)
+        return cached[0] if cached is not None and cached[1] >= time.monotonic() else None
+
+    def entry(self, user_id):
+        """The user's directory entry: {'shard': name}, plus 'moving_to' during a move"""
+        entry = self._cached(user_id)
+        if entry is not None:
+            return entry
+        entry = self.directory.child("user_shards").child(user_id).get().val()
+        if not isinstance(entry, dict) or entry.get('shard') not in self.shards:
+            entry = {'shard': self.default.name}
+        self._entries[user_id] = (entry, time.monotonic() + self.ttl)
+        return entry
+
+    async def entry_async(self, user_id):
+        # A directory miss is one blocking read; keep it off the event loop
+        entry = self._cached(user_id)
+        return entry if entry is not None else await asyncio.to_thread(self.entry, user_id)
+
+    def set_entry(self, user_id, entry):
+        self.directory.child("user_shards").child(user_id).set(entry)
+        self._entries.pop(user_id, None)
+
+    def assign(self, user_id):
+        """Record a new user's placement on the ring; returns the shard"""
+        if not self.sharded:
+            return self.default
+        shard = self.shards[self.ring.lookup(user_id)]
+        self.set_entry(user_id, {'shard': shard.name})
+        return shard
+
+    def forget(self, user_id):
+        if self.sharded:
+            self.directory.child("user_shards").child(user_id).delete()
+            self._entries.pop(user_id, None)
+
+    def _resolve(self, entry, write):
+        if write and entry.get('moving_to'):
+            raise ShardMoving(f"User data is moving to shard {entry['moving_to']}; try again shortly")
+        return self.shards[entry['shard']]
+
+    def shard_for(self, user_id):
+        """Shard holding the user's data, for reads"""
+        if not self.sharded:
+            return self.default
+        return self._resolve(self.entry(user_id), write=False)
+
+    def shard_for_write(self, user_id):
+        """Shard to write the user's data to; raises ShardMoving during a move"""
+        if not self.sharded:
+            return self.default
+        return self._resolve(self.entry(user_id), write=True)
+
+    async def shard_for_async(self, user_id):
+        if not self.sharded:
+            return self.default
+        return self._resolve(await self.entry_async(user_id), write=False)
+
+    async def shard_for_write_async(self, user_id):
+        if not self.sharded:
+            return self.default
+        return self._resolve(await self.entry_async(user_id), write=True)
+
+    def invalidate(self, user_id=None):
+        if user_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(user_id, None)
+
+    # Scatter-gather
+
+    def scatter(self, fn, shards=None):
+        """[fn(shard) for each shard], run in parallel when there is more than one"""
+        shards = self.all() if shards is None else shards
+        if len(shards) == 1:
+            return [fn(shards[0])]
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='shard-scatter')
+        # Carry the request's context so per-request db call counts and traces still add up
+        futures = [self._executor.submit(contextvars.copy_context().run, fn, shard) for shard in shards]
+        return [future.result() for future in futures]
+
+    async def scatter_async(self, fn, shards=None):
+        shards = self.all() if shards is None else shards
+        return await asyncio.gather(*(fn(shard) for shard in shards))
+
+def build_shard_map(spec=FIREBASE_SHARDS):
+    """The ShardMap for a FIREBASE_SHARDS value (a single default shard if empty)"""
+    if not spec:
+        return ShardMap([Shard('default', database, async_database, write_buffer)])
+    shards = []
+    for name, url in parse_shards(spec):
+        db = LazyDatabase(lambda url=url: _backend(url))
+        async_db = LazyDatabase(lambda db=db: get_async_database(db.resolve()))
+        buffer = WriteBuffer(enabled=WRITE_BEHIND, directory=os.path.join(WRITE_BEHIND_DIR, name), db=db, name=name)
+        os.register_at_fork(after_in_child=buffer._after_fork)
+        shards.append(Shard(name, db, async_db, buffer))
+    return ShardMap(shards)
+
+# Shared shard map, built from the environment
+shard_map = build_shard_map()
+os.register_at_fork(after_in_child=shard_map._after_fork)
+
+# Moving users between shards (see rebalance.py)
+
+def user_records(shard, user_id):
+    """{node: {record id: record}} of the user's data on ``shard``"""
+    records = {}
+    for node in SHARDED_NODES:
+        data = shard.database.child(node).get().val() or {}
+        records[node] = {rid: record for rid, record in data.items()
+                         if isinstance(record, dict) and record.get('user_id') == user_id}
+    for node in USER_KEYED_NODES:
+        data = shard.database.child(node).child(user_id).get().val()
+        records[node] = {user_id: data} if data else {}
+    return records
+
+def move_user(user_id, target, settle=None, batch_size=500, log=print):
+    """Move a user's expenses and goals to shard ``target`` (a name).
+
+    ``settle`` is how long to wait for every worker's cached directory entry
+    (and write-behind journal) to catch up before copying and before deleting
+    the source copy; it defaults to SHARD_DIRECTORY_TTL plus a margin. Pass 0
+    only when no app workers are running.
+    """
+    settle = shard_map.ttl + 2 if settle is None else settle
+    source = shard_map.shard_for(user_id)
+    destination = shard_map.shards[target]
+    if source is destination:
+        return 0
+
+    shard_map.set_entry(user_id, {'shard': source.name, 'moving_to': destination.name})
+    try:
+        time.sleep(settle)
+        source.write_buffer.flush_all()
+        unflushed = [path for node in SHARDED_NODES
+                     for path, data in source.write_buffer.pending_under(node).items()
+                     if isinstance(data, dict) and data.get('user_id') == user_id]
+        if unflushed:
+            raise RuntimeError(f"{len(unflushed)} journaled writes for the user are not flushed yet")
+        records = user_records(source, user_id)
+        paths = [(f"{node}/{rid}", record) for node, items in records.items() for rid, record in items.items()]
+        for i in range(0, len(paths), batch_size):
+            if not destination.database.update(dict(paths[i:i + batch_size])):
+                raise RuntimeError(f"write to shard {destination.name} failed")
+        copied = user_records(destination, user_id)
+        if any(set(copied[node]) != set(records[node]) for node in records):
+            raise RuntimeError(f"copy to shard {destination.name} is incomplete")
+    except BaseException:
+        shard_map.set_entry(user_id, {'shard': source.name})
+        raise
+
+    shard_map.set_entry(user_id, {'shard': destination.name})
+    time.sleep(settle)
+    for i in range(0, len(paths), batch_size):
+        source.database.update({path: None for path, _ in paths[i:i + batch_size]})
+    log(f"➡️ Moved {user_id}: {len(paths)} records {source.name} -> {destination.name}")
+    return len(paths)
+
+def split_dataset(data):
+    """(primary data, {shard name: data}) placing each user's records where the ring puts them, for seeding"""
+    primary = {node: value for node, value in data.items() if node not in SHARDED_NODES + USER_KEYED_NODES}
+    parts = {shard.name: {} for shard in shard_map.all()}
+    directory = {}
+    for node in SHARDED_NODES:
+        for rid, record in (data.get(node) or {}).items():
+            name = shard_map.ring.lookup(record['user_id'])
+            parts[name].setdefault(node, {})[rid] = record
+    for node in USER_KEYED_NODES:
+        for user_id, subtree in (data.get(node) or {}).items():
+            parts[shard_map.ring.lookup(user_id)].setdefault(node, {})[user_id] = subtree
+    for user_id in data.get('users') or {}:
+        directory[user_id] = {'shard': shard_map.ring.lookup(user_id)}
+    if shard_map.sharded:
+        primary['user_shards'] = directory
+    return primary, parts
+
+def plan_rebalance(user_ids):
+    """[(user_id, current shard name, ring shard name)] for users not where the ring places them"""
+    moves = []
+    for user_id in user_ids:
+        current = shard_map.shard_for(user_id).name
+        wanted = shard_map.ring.lookup(user_id)
+        if current != wanted:
+            moves.append((user_id, current, wanted))
+    return moves
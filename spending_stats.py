@@ -0,0 +1,310 @@
+"""
+Running per-category spending statistics and "unusual spending" insights.
+
+For every user and category this keeps each month's total, the running mean
+and variance (Welford's method) of the totals of the completed months and of
+the individual expense amounts, and from those the trend of the last
+``TREND_MONTHS`` months. The state is built from one read of the hot tier
+plus the archive summaries the first time a user's dashboard asks for it;
+after that the firebase_db write hook patches it in O(1) per write: an edit
+or delete takes the old amount out of the running moments before the new one
+goes in, so history is never rescanned.
+
+An expense is unusual when it lies more than ``ANOMALY_Z`` standard
+deviations above the category's other expenses (given at least
+``ANOMALY_MIN_SAMPLES`` of them); it is judged when it is written. A category
+is unusual this month when its total already lies ``MONTH_ANOMALY_Z``
+standard deviations above its monthly mean (given ``MONTH_MIN_HISTORY``
+months of history). Months without spending count as zero.
+
+Bulk writes, writes to expenses this worker never saw (archived ones, or
+another worker's) and the start of a new month rebuild the state;
+``SPENDING_STATS_TTL`` bounds how long a worker trusts state that another
+gunicorn worker's writes could have made stale.
+"""
+
+import os
+import math
+import time
+import threading
+from datetime import datetime
+import metrics
+from profiling import traced
+from archive import month_of
+from firebase_db import FirebaseExpense, on_user_data_change
+
+SPENDING_STATS_TTL = float(os.environ.get('SPENDING_STATS_TTL', 300))
+ANOMALY_Z = float(os.environ.get('ANOMALY_Z', 3))
+ANOMALY_MIN_SAMPLES = int(os.environ.get('ANOMALY_MIN_SAMPLES', 5))
+MONTH_ANOMALY_Z = float(os.environ.get('MONTH_ANOMALY_Z', 2))
+MONTH_MIN_HISTORY = int(os.environ.get('MONTH_MIN_HISTORY', 3))
+TREND_MONTHS = int(os.environ.get('TREND_MONTHS', 3))
+# A trend is reported when it adds this fraction of the monthly mean every month
+TREND_THRESHOLD = 0.15
+# Spreads are at least this fraction of the mean, or near-identical amounts would flag every small rise
+SPREAD_FLOOR = 0.1
+MAX_INSIGHTS = 5
+
+def _index(month):
+    """Months since year 0 of a 'YYYY-MM' string, or None if it is not one"""
+    try:
+        return int(month[:4]) * 12 + int(month[5:7]) - 1
+    except (TypeError, ValueError):
+        return None
+
+def _month(index):
+    return f"{index // 12:04d}-{index % 12 + 1:02d}"
+
+class RunningMoments:
+    """Welford's running mean and variance, with removal"""
+
+    __slots__ = ('n', 'mean', 'm2')
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def remove(self, x):
+        if self.n <= 1:
+            self.n, self.mean, self.m2 = 0, 0.0, 0.0
+            return
+        delta = x - self.mean
+        self.n -= 1
+        self.mean -= delta / self.n
+        self.m2 = max(0.0, self.m2 - delta * (x - self.mean))
+
+    def without(self, x):
+        """A copy with one ``x`` taken out"""
+        other = RunningMoments()
+        other.n, other.mean, other.m2 = self.n, self.mean, self.m2
+        other.remove(x)
+        return other
+
+    def std(self):
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else 0.0
+
+    def zscore(self, x):
+        spread = max(self.std(), abs(self.mean) * SPREAD_FLOOR)
+        return (x - self.mean) / spread if spread > 0 else 0.0
+
+class CategoryStats:
+    __slots__ = ('months', 'monthly', 'amounts')
+
+    def __init__(self, history=0):
+        self.months = {}                 # 'YYYY-MM' -> total
+        self.monthly = RunningMoments()  # totals of the completed months
+        self.amounts = RunningMoments()  # individual expenses in the hot tier
+        # A category first seen now spent nothing in the earlier months
+        self.monthly.n = history
+
+    def trend(self, current):
+        """Least-squares change per month over the last TREND_MONTHS completed months"""
+        if TREND_MONTHS < 2 or self.monthly.n < TREND_MONTHS:
+            return 0.0
+        totals = [self.months.get(_month(current - TREND_MONTHS + i), 0.0) for i in range(TREND_MONTHS)]
+        middle = (TREND_MONTHS - 1) / 2
+        mean = sum(totals) / TREND_MONTHS
+        spread = sum((i - middle) ** 2 for i in range(TREND_MONTHS))
+        return sum((i - middle) * (total - mean) for i, total in enumerate(totals)) / spread
+
+class UserSpendingStats:
+    """One user's statistics, as of ``month``"""
+
+    def __init__(self, expenses, archived, month, built_at):
+        self.month = month
+        self.current = _index(month)
+        self.built_at = built_at
+        self.categories = {}
+        self.expenses = {}  # expense id -> (category, month, amount), to undo on edit and delete
+        self.unusual = {}   # expense id -> insight, for this month's unusual expenses
+
+        first = self.current
+        for archived_month, totals in archived.items():
+            for category, total in totals.items():
+                stats = self.categories.setdefault(category, CategoryStats())
+                stats.months[archived_month] = stats.months.get(archived_month, 0.0) + total
+            first = min(first, _index(archived_month) or first)
+        for expense in expenses:
+            expense_month = month_of(expense.date)
+            self.expenses[expense.id] = (expense.category, expense_month, expense.amount)
+            stats = self.categories.setdefault(expense.category, CategoryStats())
+            stats.months[expense_month] = stats.months.get(expense_month, 0.0) + expense.amount
+            stats.amounts.add(expense.amount)
+            first = min(first, _index(expense_month) or first)
+        self.first = first
+
+        for stats in self.categories.values():
+            for index in range(first, self.current):
+                stats.monthly.add(stats.months.get(_month(index), 0.0))
+        for expense in expenses:
+            if month_of(expense.date) == month:
+                amounts = self.categories[expense.category].amounts.without(expense.amount)
+                self._judge(expense.id, expense.category, expense.amount, expense.description, amounts)
+
+    def _stats(self, category):
+        stats = self.categories.get(category)
+        if stats is None:
+            stats = self.categories[category] = CategoryStats(history=self.current - self.first)
+        return stats
+
+    def _retotal(self, stats, month, delta):
+        before = stats.months.get(month, 0.0)
+        stats.months[month] = before + delta
+        index = _index(month)
+        if index is not None and self.first <= index < self.current:
+            stats.monthly.remove(before)
+            stats.monthly.add(before + delta)
+
+    def _judge(self, expense_id, category, amount, description, amounts):
+        if amounts.n < ANOMALY_MIN_SAMPLES:
+            return
+        z = amounts.zscore(amount)
+        if z > ANOMALY_Z:
+            self.unusual[expense_id] = {
+                'kind': 'expense', 'category': category, 'score': z,
+                'message': f"₹{amount:,.2f} on {category}{f' ({description})' if description else ''} is far more "
+                           f"than you usually spend there (₹{amounts.mean:,.2f} on average).",
+            }
+
+    def apply(self, expense_id, data):
+        """Patch in one expense write; False if the state has to be rebuilt instead"""
+        old = self.expenses.get(expense_id)
+        if old is None and (data is None or data.get('created_at', '') < self.built_at):
+            # Older than this state yet not part of it: archived, or written by another worker
+            return False
+        if data is not None:
+            month = month_of(data.get('date'))
+            index = _index(month)
+            if index is not None and index < self.first:
+                return False
+
+        if old is not None:
+            old_category, old_month, old_amount = self.expenses.pop(expense_id)
+            stats = self.categories[old_category]
+            stats.amounts.remove(old_amount)
+            self._retotal(stats, old_month, -old_amount)
+            self.unusual.pop(expense_id, None)
+        if data is not None:
+            category, amount = data.get('category', ''), float(data.get('amount', 0.0))
+            stats = self._stats(category)
+            if month == self.month:
+                # Judged against the expenses before it
+                self._judge(expense_id, category, amount, data.get('description'), stats.amounts)
+                if expense_id in self.unusual:
+                    metrics.SPENDING_ANOMALIES.inc()
+            self.expenses[expense_id] = (category, month, amount)
+            stats.amounts.add(amount)
+            self._retotal(stats, month, amount)
+        return True
+
+    def insights(self, limit=MAX_INSIGHTS):
+        """Unusual months first, then unusual expenses, then rising trends; strongest first"""
+        found = []
+        for category, stats in self.categories.items():
+            total = stats.months.get(self.month, 0.0)
+            if stats.monthly.n >= MONTH_MIN_HISTORY and total > 0:
+                z = stats.monthly.zscore(total)
+                if z > MONTH_ANOMALY_Z:
+                    found.append((0, -z, {
+                        'kind': 'month', 'category': category, 'score': z,
+                        'message': f"You've spent ₹{total:,.2f} on {category} this month, well above "
+                                   f"your usual ₹{stats.monthly.mean:,.2f} a month.",
+                    }))
+            slope = stats.trend(self.current)
+            if stats.monthly.mean > 0 and slope > TREND_THRESHOLD * stats.monthly.mean:
+                found.append((2, -slope / stats.monthly.mean, {
+                    'kind': 'trend', 'category': category, 'score': slope / stats.monthly.mean,
+                    'message': f"Your {category} spending has been rising over the last {TREND_MONTHS} months "
+                               f"(about ₹{slope:,.2f} more each month).",
+                }))
+        for insight in self.unusual.values():
+            found.append((1, -insight['score'], insight))
+        found.sort(key=lambda item: item[:2])
+        return [dict(insight) for _, _, insight in found[:limit]]
+
+def load_spending(user_id):
+    # The archive summaries stand in for the archived expenses' monthly totals
+    return (FirebaseExpense.get_by_user_id(user_id, include_archived=False),
+            FirebaseExpense.archived_category_totals(user_id))
+
+class SpendingStatsCache:
+    """UserSpendingStats per user, patched by writes and versioned like
+    SearchIndexCache so state built while a write landed is not kept"""
+
+    def __init__(self, load=load_spending, ttl=None):
+        self.load = load
+        self.ttl = SPENDING_STATS_TTL if ttl is None else ttl
+        self._entries = {}  # user_id -> (state, version, expires_at)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        month = datetime.now().strftime('%Y-%m')
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            state, version, expires_at = entry
+            if (version == self._versions.get(user_id, 0) and state.month == month
+                    and expires_at >= time.monotonic()):
+                metrics.record_cache_lookup('spending_stats', True)
+                return state
+        metrics.record_cache_lookup('spending_stats', False)
+
+        with self._lock:
+            version = self._versions.get(user_id, 0)
+        built_at = datetime.utcnow().isoformat()
+        expenses, archived = self.load(user_id)
+        state = UserSpendingStats(expenses, archived, month, built_at)
+        if self.ttl > 0:
+            with self._lock:
+                if version == self._versions.get(user_id, 0):
+                    self._entries[user_id] = (state, version, time.monotonic() + self.ttl)
+        return state
+
+    def insights(self, user_id):
+        state = self.get(user_id)
+        # Writes patch the state under the lock
+        with self._lock:
+            return state.insights()
+
+    def apply(self, user_id, kind, change=None):
+        """Write hook: patch cached state in place, or drop it so the next read rebuilds it"""
+        if kind != 'expenses':
+            return
+        with self._lock:
+            version = self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            state, _, expires_at = entry
+            if change is None or not state.apply(change['id'], change['data']):
+                del self._entries[user_id]
+                metrics.SPENDING_STATS_WRITES.inc(outcome='rebuilt')
+                return
+            self._entries[user_id] = (state, version, expires_at)
+        metrics.SPENDING_STATS_WRITES.inc(outcome='patched')
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            for user_id in self._entries:
+                self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._entries.clear()
+
+# Shared cache, kept current by firebase_db writes
+spending_statistics = SpendingStatsCache()
+on_user_data_change(spending_statistics.apply)
+os.register_at_fork(after_in_child=spending_statistics._after_fork)
+
+@traced('spending.insights')
+def spending_insights(user_id):
+    """The user's 'unusual spending' insights for the dashboard"""
+    return spending_statistics.insights(user_id)
@@ -272,6 +272,33 @@ function showNotification(message, type = 'info', duration = 5000) {
     }, duration);
 }
 
+// Background jobs: poll a job's status until it finishes
+function pollJob(jobId, onProgress, interval = 1000) {
+    return new Promise((resolve, reject) => {
+        function check() {
+            fetch(`/jobs/${jobId}`, { cache: 'no-store' })
+                .then(response => response.json().then(data => ({ ok: response.ok, data })))
+                .then(({ ok, data }) => {
+                    if (!ok) {
+                        throw new Error(data.error || 'Job status unavailable');
+                    }
+                    if (data.status === 'succeeded') {
+                        resolve(data);
+                    } else if (data.status === 'failed') {
+                        reject(new Error(data.error || 'Job failed'));
+                    } else {
+                        if (onProgress) {
+                            onProgress(data);
+                        }
+                        setTimeout(check, interval);
+                    }
+                })
+                .catch(reject);
+        }
+        check();
+    });
+}
+
 // Network status monitoring
 function initNetworkMonitoring() {
     function updateOnlineStatus() {
@@ -358,4 +385,5 @@ window.toggleTheme = toggleTheme;
 window.installApp = installApp;
 window.dismissInstall = dismissInstall;
 window.showNotification = showNotification;
+window.pollJob = pollJob;
 window.formatCurrency = formatCurrency;
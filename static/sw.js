@@ -62,6 +62,11 @@ self.addEventListener('fetch', function(event) {
         !url.hostname.includes('fonts.gstatic.com')) {
         return;
     }
+    
+    // Job status and downloads change while the page polls them
+    if (url.origin === location.origin && url.pathname.startsWith('/jobs/')) {
+        return;
+    }
 
     event.respondWith(
         caches.match(event.request)
@@ -0,0 +1,143 @@
+"""
+Cached savings suggestions.
+
+Suggestions depend only on a user's expenses, monthly income and savings goal
+(and the current month), so they are computed once and kept until firebase_db
+reports a write to that data. A write schedules the recomputation on a small
+background pool straight away, so by the time the dashboard asks again the
+answer is usually ready and the endpoint is a dictionary lookup.
+
+Other gunicorn workers do not see this worker's writes; ``SUGGESTIONS_CACHE_TTL``
+bounds how long they keep serving an older answer (refreshed in the background).
+"""
+
+import os
+import time
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+import metrics
+from analytics import savings_suggestions
+from firebase_db import FirebaseUser, FirebaseExpense, FirebaseSavingsGoal, on_user_data_change
+
+SUGGESTIONS_CACHE_TTL = float(os.environ.get('SUGGESTIONS_CACHE_TTL', 300))
+SUGGESTIONS_WAIT = float(os.environ.get('SUGGESTIONS_WAIT', 2))
+SUGGESTIONS_WORKERS = int(os.environ.get('SUGGESTIONS_WORKERS', 2))
+
+def compute_suggestions(user_id):
+    """Read a user's data and build their suggestion list from scratch"""
+    user = FirebaseUser.get_by_id(user_id)
+    if user is None:
+        return []
+    # Suggestions only look at the current month, which is never archived
+    expenses = FirebaseExpense.get_by_user_id(user_id, include_archived=False)
+    savings_goal = FirebaseSavingsGoal.get_by_user_id(user_id)
+    return savings_suggestions(expenses, user.monthly_income, savings_goal)
+
+def _month():
+    now = datetime.now()
+    return (now.year, now.month)
+
+class SuggestionEngine:
+    """Per-user suggestion cache recomputed off the request path.
+
+    Like UserSessionCache, every invalidation bumps a per-user version; a
+    computation that started before a write is discarded and redone, so a
+    result never outlives the data it was built from.
+    """
+
+    def __init__(self, compute=compute_suggestions, ttl=SUGGESTIONS_CACHE_TTL,
+                 wait=SUGGESTIONS_WAIT, workers=SUGGESTIONS_WORKERS):
+        self.compute = compute
+        self.ttl = ttl
+        self.wait = wait
+        self.workers = workers
+        self._entries = {}  # user_id -> (suggestions, version, month, computed_at)
+        self._versions = {}
+        self._pending = {}  # user_id -> Future of the running recomputation
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _pool(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='suggestions')
+        return self._executor
+
+    def _run(self, user_id):
+        while True:
+            with self._lock:
+                version = self._versions.get(user_id, 0)
+            month = _month()
+            try:
+                suggestions = self.compute(user_id)
+            except Exception:
+                with self._lock:
+                    self._pending.pop(user_id, None)
+                raise
+            with self._lock:
+                if version == self._versions.get(user_id, 0):
+                    self._entries[user_id] = (suggestions, version, month, time.monotonic())
+                    self._pending.pop(user_id, None)
+                    return suggestions
+            # A write landed while we were computing; start over
+
+    def refresh(self, user_id):
+        """Schedule a recomputation unless one is already running; return its future"""
+        with self._lock:
+            future = self._pending.get(user_id)
+            if future is None:
+                future = self._pending[user_id] = self._pool().submit(self._run, user_id)
+            return future
+
+    def prefetch(self, user_id):
+        """Warm the cache (e.g. at login) without waiting for the result"""
+        if self.ttl > 0 and user_id not in self._entries:
+            self.refresh(user_id)
+
+    def get(self, user_id):
+        """Return the user's suggestions, from the cache whenever it is current"""
+        if self.ttl <= 0:
+            return self.compute(user_id)
+
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            suggestions, version, month, computed_at = entry
+            if version == self._versions.get(user_id, 0) and month == _month():
+                if time.monotonic() - computed_at > self.ttl:
+                    # Another worker may have written since; serve this one and refresh
+                    self.refresh(user_id)
+                metrics.record_cache_lookup('savings_suggestions', True)
+                return list(suggestions)
+
+        metrics.record_cache_lookup('savings_suggestions', False)
+        future = self.refresh(user_id)
+        try:
+            return list(future.result(timeout=self.wait if entry is not None else None))
+        except FutureTimeout:
+            # Still recomputing after a write: the previous answer beats a slow page
+            return list(entry[0])
+
+    def invalidate(self, user_id, kind=None, change=None):
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            warm = user_id in self._entries
+        # Only users whose suggestions are in use are worth recomputing eagerly
+        if self.ttl > 0 and warm:
+            self.refresh(user_id)
+
+    def _after_fork(self):
+        # Pool threads and their futures do not survive a fork
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = {}
+
+    def clear(self):
+        with self._lock:
+            for user_id in self._entries:
+                self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._entries.clear()
+
+# Shared engine instance, kept current by firebase_db writes
+suggestion_engine = SuggestionEngine()
+on_user_data_change(suggestion_engine.invalidate)
+os.register_at_fork(after_in_child=suggestion_engine._after_fork)
@@ -0,0 +1,124 @@
+"""
+Seeded generator of realistic household expense data for benchmarks and load tests
+"""
+
+import math
+import uuid
+import random
+from datetime import datetime, timedelta
+
+# category -> (relative frequency, median amount in ₹, spread, share marked unwanted)
+CATEGORIES = {
+    'Food': (0.34, 350, 0.8, 0.30),
+    'Transportation': (0.18, 180, 0.7, 0.15),
+    'Shopping': (0.12, 1200, 1.0, 0.45),
+    'Entertainment': (0.09, 600, 0.9, 0.55),
+    'Bills': (0.10, 2200, 0.6, 0.02),
+    'Healthcare': (0.06, 900, 1.1, 0.05),
+    'Education': (0.04, 3000, 1.0, 0.05),
+    'Other': (0.07, 400, 1.2, 0.35),
+}
+
+DESCRIPTIONS = {
+    'Food': ['Groceries', 'Lunch', 'Dinner out', 'Coffee', 'Snacks', 'Swiggy order', 'Vegetables', 'Milk'],
+    'Transportation': ['Fuel', 'Metro card', 'Auto rickshaw', 'Cab to office', 'Parking', 'Bus pass'],
+    'Shopping': ['Clothes', 'Shoes', 'Amazon order', 'Kitchen items', 'Gift', 'Electronics'],
+    'Entertainment': ['Movie tickets', 'Streaming subscription', 'Concert', 'Weekend trip', 'Games'],
+    'Bills': ['Electricity bill', 'Water bill', 'Internet bill', 'Mobile recharge', 'Gas cylinder', 'Rent'],
+    'Healthcare': ['Pharmacy', 'Doctor visit', 'Lab tests', 'Dental checkup', 'Health insurance'],
+    'Education': ['School fees', 'Books', 'Online course', 'Tuition', 'Stationery'],
+    'Other': ['Donation', 'Haircut', 'Repairs', 'Miscellaneous', 'Pet supplies'],
+}
+
+PROFILES = {
+    'small': {'users': 50, 'expenses': 20000},
+    'medium': {'users': 200, 'expenses': 200000},
+    'large': {'users': 1000, 'expenses': 1000000},
+}
+
+def _uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+def generate_dataset(users=50, expenses=20000, years=3, seed=42, end_date=None, password_hash=''):
+    """Generate users, expenses and savings goals in the database's storage layout.
+
+    Users belong to households of 1-5 members; the first user is the admin.
+    Activity per user is skewed (a few heavy spenders), amounts are log-normal
+    per category and monthly bills recur. The same seed always yields the
+    same data.
+
+    Returns a dict with 'users', 'expenses' and 'savings_goals' nodes.
+    """
+    rng = random.Random(seed)
+    end_date = end_date or datetime(2026, 1, 1)
+    start_date = end_date - timedelta(days=365 * years)
+    span_seconds = int((end_date - start_date).total_seconds())
+
+    user_nodes = {}
+    goal_nodes = {}
+    weights = []
+    household = 0
+    remaining_in_household = 0
+    for i in range(users):
+        if remaining_in_household == 0:
+            household += 1
+            remaining_in_household = rng.randint(1, 5)
+        remaining_in_household -= 1
+
+        user_id = _uuid(rng)
+        created_at = start_date + timedelta(seconds=rng.randrange(span_seconds // 4 or 1))
+        user_nodes[user_id] = {
+            'id': user_id,
+            'uid': None,
+            'username': f"user{i:05d}",
+            'email': f"user{i:05d}@household{household}.example",
+            'password_hash': password_hash,
+            'is_admin': i == 0,
+            'monthly_income': round(rng.lognormvariate(math.log(60000), 0.5), -2),
+            'created_at': created_at.isoformat(),
+        }
+        goal_id = _uuid(rng)
+        goal_nodes[goal_id] = {
+            'id': goal_id,
+            'user_id': user_id,
+            'target_amount': rng.choice([50000.0, 100000.0, 200000.0, 500000.0]),
+            'target_months': rng.choice([3, 6, 12]),
+            'current_savings': 0.0,
+            'created_at': created_at.isoformat(),
+        }
+        # Pareto-distributed activity: most users are light, a few are heavy
+        weights.append(rng.paretovariate(1.5))
+
+    user_ids = list(user_nodes)
+    category_names = list(CATEGORIES)
+    category_weights = [CATEGORIES[c][0] for c in category_names]
+
+    expense_nodes = {}
+    for _ in range(expenses):
+        user_id = rng.choices(user_ids, weights)[0] if user_ids else None
+        category = rng.choices(category_names, category_weights)[0]
+        _, median, spread, unwanted_share = CATEGORIES[category]
+
+        when = start_date + timedelta(seconds=rng.randrange(span_seconds))
+        if category == 'Bills':
+            # Bills land in the first week of the month
+            when = when.replace(day=rng.randint(1, 7))
+
+        expense_id = _uuid(rng)
+        expense_nodes[expense_id] = {
+            'id': expense_id,
+            'user_id': user_id,
+            'amount': round(rng.lognormvariate(math.log(median), spread), 2),
+            'category': category,
+            'description': rng.choice(DESCRIPTIONS[category]),
+            'expense_type': 'unwanted' if rng.random() < unwanted_share else 'wanted',
+            'date': when.replace(hour=0, minute=0, second=0).isoformat(),
+            'created_at': (when + timedelta(minutes=rng.randint(0, 600))).isoformat(),
+        }
+
+    return {'users': user_nodes, 'expenses': expense_nodes, 'savings_goals': goal_nodes}
+
+def load_dataset(db, dataset):
+    """Write a generated dataset into ``db``, one top-level node at a time"""
+    for node, records in dataset.items():
+        db.child(node).set(records)
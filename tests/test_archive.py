@@ -0,0 +1,119 @@
+import os
+os.environ.setdefault('FIREBASE_BACKEND', 'mock')
+os.environ.setdefault('PASSWORD_HASH_WORKERS', '0')
+
+import uuid
+import pytest
+import archive
+from datetime import datetime
+from firebase_config import database, MockDatabase
+from firebase_db import FirebaseExpense, WriteConflict
+
+@pytest.fixture
+def user_id():
+    user_id = str(uuid.uuid4())
+    yield user_id
+    FirebaseExpense.delete_by_user_id(user_id)
+
+def old_expense(user_id, amount, day=5):
+    return FirebaseExpense.create_expense(user_id, amount, 'Food', f'old {amount}', 'wanted',
+                                          date=datetime(2020, 1, day))
+
+def archive_all(user_id):
+    return archive.archive_expenses(user_id=user_id, now=datetime(2021, 6, 1))['expenses']
+
+def block(user_id, month='2020-01'):
+    return archive.read_blocks(database, user_id, [month])[month]
+
+def summary(user_id, month='2020-01'):
+    return archive.read_summaries(database, user_id).get(month)
+
+def test_edit_within_the_month_changes_the_block(user_id):
+    expense = old_expense(user_id, 10.0)
+    old_expense(user_id, 5.0)
+    assert archive_all(user_id) == 2
+    assert database.child('expenses').child(expense.id).get().val() is None
+
+    archived = FirebaseExpense.get_by_id(expense.id, user_id=user_id)
+    assert archived.archived_month == '2020-01'
+    archived.amount = 12.0
+    archived.save()
+
+    assert block(user_id)[expense.id]['amount'] == 12.0
+    assert summary(user_id)['total'] == 17.0
+    assert database.child('expenses').child(expense.id).get().val() is None
+    assert FirebaseExpense.get_by_id(expense.id, user_id=user_id).amount == 12.0
+
+def test_edit_to_another_month_thaws_to_the_hot_tier(user_id):
+    expense = old_expense(user_id, 10.0)
+    archive_all(user_id)
+
+    archived = FirebaseExpense.get_by_id(expense.id, user_id=user_id)
+    archived.date = datetime(2021, 5, 1).isoformat()
+    archived.save()
+
+    assert archived.archived_month is None
+    assert block(user_id) == {}
+    assert summary(user_id) is None
+    assert database.child('expenses').child(expense.id).get().val()['date'].startswith('2021-05')
+
+def test_delete_takes_it_out_of_the_block(user_id):
+    expense = old_expense(user_id, 10.0)
+    kept = old_expense(user_id, 5.0)
+    archive_all(user_id)
+
+    FirebaseExpense.get_by_id(expense.id, user_id=user_id).delete()
+    assert set(block(user_id)) == {kept.id}
+    assert summary(user_id)['count'] == 1
+
+def test_edit_of_an_expense_deleted_meanwhile_is_refused(user_id):
+    expense = old_expense(user_id, 10.0)
+    archive_all(user_id)
+    first = FirebaseExpense.get_by_id(expense.id, user_id=user_id)
+    FirebaseExpense.get_by_id(expense.id, user_id=user_id).delete()
+
+    first.amount = 11.0
+    with pytest.raises(WriteConflict):
+        first.save()
+    assert block(user_id) == {}
+
+def test_hot_edit_while_archiving_keeps_the_edit(user_id, monkeypatch):
+    expense = old_expense(user_id, 10.0)
+    original = archive._still_hot
+
+    def still_hot(db, records):
+        etags = original(db, records)
+        # Edited after it was checked, before it is removed from the hot tier
+        edited = FirebaseExpense.get_by_id(expense.id)
+        edited.amount = 99.0
+        edited.save()
+        return etags
+
+    monkeypatch.setattr(archive, '_still_hot', still_hot)
+    assert archive_all(user_id) == 0
+    assert database.child('expenses').child(expense.id).get().val()['amount'] == 99.0
+    assert block(user_id) == {}
+
+def test_block_edit_racing_an_archive_run_keeps_both(user_id, monkeypatch):
+    archived = old_expense(user_id, 10.0)
+    archive_all(user_id)
+    new = old_expense(user_id, 5.0, day=20)
+    original = MockDatabase.set_if_unchanged
+    raced = []
+
+    def set_if_unchanged(self, etag, data):
+        if self.path.startswith(archive.ARCHIVE_NODE) and not raced:
+            # Another worker edits the archived expense between our read and write
+            raced.append(True)
+            edit = FirebaseExpense.get_by_id(archived.id, user_id=user_id)
+            edit.amount = 11.0
+            edit.save()
+        return original(self, etag, data)
+
+    monkeypatch.setattr(MockDatabase, 'set_if_unchanged', set_if_unchanged)
+    assert archive_all(user_id) == 1
+    assert raced
+    records = block(user_id)
+    assert records[archived.id]['amount'] == 11.0
+    assert new.id in records
+    assert summary(user_id)['total'] == 16.0
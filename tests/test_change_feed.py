@@ -0,0 +1,70 @@
+import os
+os.environ.setdefault('FIREBASE_BACKEND', 'mock')
+os.environ.setdefault('PASSWORD_HASH_WORKERS', '0')
+
+import uuid
+import pytest
+from change_feed import ChangeFeed, changes_since, entry_for, _log, _key
+from sharding import shard_map
+
+@pytest.fixture
+def feed():
+    feed = ChangeFeed(enabled=True, keep=5, compact_every=2)
+    users = []
+
+    def log(count, user_id=None):
+        if user_id is None:
+            user_id = str(uuid.uuid4())
+            users.append(user_id)
+        for _ in range(count):
+            n = (_head(user_id).get('seq') or 0) + 1
+            feed.append(user_id, entry_for('expenses', {'id': f'e{n}', 'data': {'amount': n}}))
+        return user_id
+
+    yield log
+    for user_id in users:
+        feed.delete_user(user_id)
+
+def _head(user_id):
+    return _log(shard_map.shard_for(user_id).database, user_id).child('head').get().val() or {}
+
+def ids(found):
+    return [entry['id'] for entry in found]
+
+def test_token_at_or_above_the_floor_gets_the_entries_after_it(feed):
+    user_id = feed(8)
+    assert _head(user_id) == {'seq': 8, 'floor': 3}
+
+    token, found, reset = changes_since(user_id, 3)
+    assert (token, ids(found), reset) == (8, ['e4', 'e5', 'e6', 'e7', 'e8'], set())
+    assert changes_since(user_id, 6)[:2] == (8, found[3:])
+    assert changes_since(user_id, 8) == (8, [], set())
+
+def test_token_below_the_floor_refetches_everything(feed):
+    user_id = feed(8)
+    assert changes_since(user_id, 2) == (8, [], None)
+    assert changes_since(user_id, 0) == (8, [], None)
+    assert changes_since(user_id, None) == (8, [], None)
+
+def test_client_keeps_syncing_across_a_later_compaction(feed):
+    user_id = feed(8)
+    behind = changes_since(user_id, 3)[0]
+    far_behind = 5
+    feed(4, user_id)
+    assert _head(user_id) == {'seq': 12, 'floor': 7}
+
+    token, found, reset = changes_since(user_id, behind)
+    assert (token, ids(found), reset) == (12, ['e9', 'e10', 'e11', 'e12'], set())
+    assert changes_since(user_id, far_behind) == (12, [], None)
+
+def test_head_trailing_the_last_slot(feed):
+    user_id = feed(8)
+    log = _log(shard_map.shard_for(user_id).database, user_id)
+    # A worker died between claiming slot 9 and moving head/seq
+    log.child('entries').child(_key(9)).set(entry_for('expenses', {'id': 'e9', 'data': {'amount': 9}}))
+
+    token, found, reset = changes_since(user_id, 8)
+    assert (token, ids(found), reset) == (9, ['e9'], set())
+    assert changes_since(user_id, 9) == (9, [], set())
+    # A token past anything written means the log was lost
+    assert changes_since(user_id, 20) == (9, [], None)
@@ -0,0 +1,52 @@
+import os
+os.environ.setdefault('FIREBASE_BACKEND', 'mock')
+os.environ.setdefault('PASSWORD_HASH_WORKERS', '0')
+
+import pytest
+import firebase_db
+from admission import BackendUnavailable
+from firebase_config import MockDatabase
+from firebase_db import FirebaseUser, FirebaseExpense, FirebaseSavingsGoal
+
+@pytest.fixture
+def notified(monkeypatch):
+    changes = []
+    monkeypatch.setattr(firebase_db, '_change_listeners', [lambda user_id, kind, change: changes.append(kind)])
+    return changes
+
+@pytest.fixture
+def failing_writes(monkeypatch):
+    """Make every mock set and delete report a failed request"""
+    def fail():
+        monkeypatch.setattr(MockDatabase, 'set', lambda self, data: False)
+        monkeypatch.setattr(MockDatabase, 'delete', lambda self: False)
+    return fail
+
+@pytest.fixture
+def user():
+    user = FirebaseUser.create_user('writes', 'writes@example.com', 'pw')
+    yield user
+    FirebaseExpense.delete_by_user_id(user.id)
+    FirebaseSavingsGoal.delete_by_user_id(user.id)
+    user.delete()
+
+def test_failed_create_raises_before_notifying(failing_writes, notified):
+    failing_writes()
+    with pytest.raises(BackendUnavailable):
+        FirebaseUser.create_user('nowhere', 'nowhere@example.com', 'pw')
+    with pytest.raises(BackendUnavailable):
+        FirebaseExpense.create_expense('nobody', 1.0, 'Food', 'lost', 'wanted')
+    with pytest.raises(BackendUnavailable):
+        FirebaseSavingsGoal.create_goal('nobody')
+    assert notified == []
+
+def test_failed_delete_raises_before_notifying(user, failing_writes, notified):
+    expense = FirebaseExpense.create_expense(user.id, 1.0, 'Food', 'kept', 'wanted')
+    goal = FirebaseSavingsGoal.create_goal(user.id)
+    del notified[:]
+
+    failing_writes()
+    for record in (expense, goal, user):
+        with pytest.raises(BackendUnavailable):
+            record.delete()
+    assert notified == []
@@ -0,0 +1,82 @@
+import os
+os.environ.setdefault('FIREBASE_BACKEND', 'mock')
+os.environ.setdefault('PASSWORD_HASH_WORKERS', '0')
+
+import pytest
+import fragment_cache as fc
+from fragment_cache import FragmentCache, fragment_cache
+
+def test_has_pins_html_for_the_render():
+    cache = FragmentCache(ttl=60)
+    cache.render('card', cache.scope('u1'), lambda: '<p>stored</p>')
+
+    fragments = cache.scope('u1')
+    assert fragments.has('card') == {'card': '<p>stored</p>'}
+    cache.invalidate('u1')
+    # The entry is gone now, but this render already committed to it
+    assert cache.render('card', fragments, lambda: pytest.fail('rendered without data')) == '<p>stored</p>'
+    # A new render does not see it
+    assert cache.scope('u1').has('card') is None
+
+def test_has_pins_nothing_on_a_partial_hit():
+    cache = FragmentCache(ttl=60)
+    cache.render('a', cache.scope('u1'), lambda: 'A')
+    fragments = cache.scope('u1')
+    assert fragments.has('a', 'b') is None
+    assert fragments.pinned == {}
+
+@pytest.fixture
+def invalidate_after_has(monkeypatch):
+    """Retire the scope's fragments right after a view has checked for them"""
+    original = fc.FragmentScope.has
+
+    def has(self, *names):
+        found = original(self, *names)
+        fragment_cache.invalidate(self.scope)
+        return found
+
+    monkeypatch.setattr(fc.FragmentScope, 'has', has)
+
+@pytest.fixture
+def login():
+    """A test client signed in as a new user with one expense"""
+    from app import app
+    from firebase_db import FirebaseUser, FirebaseExpense
+    users = []
+
+    def login(is_admin=False):
+        user = FirebaseUser.create_user(f'fragments{len(users)}', f'fragments{len(users)}@example.com', 'pw',
+                                        monthly_income=5000, is_admin=is_admin)
+        users.append(user)
+        FirebaseExpense.create_expense(user.id, 12.5, 'Food', 'cached lunch', 'wanted')
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = user.id
+            session['_fresh'] = True
+        return client
+
+    yield login
+    for user in users:
+        user.delete()
+
+@pytest.mark.parametrize('is_admin', [False, True], ids=['user', 'admin'])
+def test_dashboard_renders_when_fragments_go_stale_after_the_check(login, is_admin, request):
+    client = login(is_admin)
+    # The first view creates the savings goal, the second fills the cache
+    client.get('/dashboard')
+    assert client.get('/dashboard').status_code == 200
+
+    request.getfixturevalue('invalidate_after_has')
+    response = client.get('/dashboard')
+    assert response.status_code == 200
+    assert 'cached lunch' in response.get_data(as_text=True)
+
+def test_admin_renders_when_fragments_go_stale_after_the_check(login, request):
+    client = login(is_admin=True)
+    client.get('/admin')
+    assert client.get('/admin').status_code == 200
+
+    request.getfixturevalue('invalidate_after_has')
+    response = client.get('/admin')
+    assert response.status_code == 200
+    assert 'fragments0@example.com' in response.get_data(as_text=True)
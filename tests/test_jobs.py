@@ -0,0 +1,69 @@
+import os
+os.environ.setdefault('FIREBASE_BACKEND', 'mock')
+os.environ.setdefault('PASSWORD_HASH_WORKERS', '0')
+
+import time
+import threading
+from datetime import datetime, timedelta
+import jobs
+from jobs import JobRunner, job_handler, RUNNING, SUCCEEDED
+from firebase_config import database
+
+runs = []
+
+@job_handler('sample_job')
+def sample_job(job, n):
+    runs.append(n)
+    return {'n': n}
+
+def _wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+def _abandoned(job_id, n):
+    old = (datetime.utcnow() - timedelta(hours=1)).isoformat()
+    record = {'id': job_id, 'kind': 'sample_job', 'owner_id': 'u', 'params': {'n': n}, 'key': job_id,
+              'status': RUNNING, 'progress': 0.3, 'message': 'Running', 'attempts': 1, 'max_attempts': 3,
+              'error': None, 'result': None, 'created_at': old, 'updated_at': old, 'finished_at': None}
+    database.child('jobs').child(job_id).set(record)
+
+def test_start_resumes_jobs_left_running_by_a_dead_worker():
+    _abandoned('abandoned-1', 41)
+    runner = JobRunner(workers=1)
+    runner.start()
+    # No enqueue needed: the sweeper picks it up
+    assert _wait_for(lambda: (runner.get('abandoned-1') or {}).get('status') == SUCCEEDED)
+    assert runs.count(41) == 1
+    assert runner.get('abandoned-1')['attempts'] == 2
+
+def test_sweeps_repeat(monkeypatch):
+    monkeypatch.setattr(jobs, 'SWEEP_INTERVAL', 0.05)
+    runner = JobRunner(workers=1)
+    runner.start()
+    time.sleep(0.1)
+    _abandoned('abandoned-2', 42)
+    assert _wait_for(lambda: (runner.get('abandoned-2') or {}).get('status') == SUCCEEDED)
+
+def test_heartbeat_stops_without_recreating_a_deleted_record(monkeypatch):
+    monkeypatch.setattr(jobs, 'HEARTBEAT_INTERVAL', 0.02)
+    runner = JobRunner(workers=0)
+    _abandoned('beating', 43)
+    ref = database.child('jobs').child('beating')
+    record = ref.get().val()
+    record['updated_at'] = datetime.utcnow().isoformat()
+    ref.set(record)
+
+    stop = threading.Event()
+    beat = threading.Thread(target=runner._heartbeat, args=('beating', stop), daemon=True)
+    beat.start()
+    assert _wait_for(lambda: ref.get().val()['updated_at'] > record['updated_at'])
+
+    ref.delete()
+    beat.join(timeout=2)
+    assert not beat.is_alive()
+    assert ref.get().val() is None
+    stop.set()
@@ -0,0 +1,90 @@
+import os
+os.environ.setdefault('FIREBASE_BACKEND', 'mock')
+os.environ.setdefault('PASSWORD_HASH_WORKERS', '0')
+
+import time
+import uuid
+import types
+import pytest
+import sharding
+import firebase_db
+from sharding import ShardMap, ShardMoving, build_shard_map, move_user, user_records
+from firebase_config import database
+from firebase_db import FirebaseExpense
+
+@pytest.fixture
+def workers(monkeypatch):
+    """Two workers' shard maps over the same two mock shards; the first is this process's"""
+    name = uuid.uuid4().hex
+    here = build_shard_map(f"a=mock://{name}-a,b=mock://{name}-b")
+    elsewhere = ShardMap(here.all(), ttl=3600)
+    monkeypatch.setattr(sharding, 'shard_map', here)
+    monkeypatch.setattr(firebase_db, 'shard_map', here)
+    yield here, elsewhere
+    for shard in ('a', 'b'):
+        database.child('__shards').child(f"{name}-{shard}").delete()
+
+@pytest.fixture
+def settle(monkeypatch):
+    """Run ``steps[i]`` in place of the i-th settle wait of a move"""
+    steps = []
+
+    def sleep(seconds):
+        steps.pop(0)()
+
+    monkeypatch.setattr(sharding, 'time', types.SimpleNamespace(sleep=sleep, monotonic=time.monotonic))
+    return steps
+
+def expense_ids(shard, user_id):
+    return set(user_records(shard, user_id)['expenses'])
+
+def test_move_user_while_the_user_is_being_written(workers, settle):
+    here, elsewhere = workers
+    a, b = here.shards['a'], here.shards['b']
+    user_id = str(uuid.uuid4())
+    here.set_entry(user_id, {'shard': 'a'})
+    before = FirebaseExpense.create_expense(user_id, 10.0, 'Food', 'before the move')
+    assert elsewhere.shard_for_write(user_id) is a  # cached until its TTL runs out
+    written = {}
+
+    def while_copying():
+        # This worker sees the move and is told to retry
+        with pytest.raises(ShardMoving):
+            FirebaseExpense.create_expense(user_id, 1.0, 'Food', 'refused')
+        # A worker that cached the entry before the move still writes to the source...
+        late = dict(before.to_dict(), id='late', description='cached entry')
+        elsewhere.shard_for_write(user_id).database.child('expenses').child('late').set(late)
+        # ...until its entry expires, which the settle time waits for
+        elsewhere.invalidate(user_id)
+        with pytest.raises(ShardMoving):
+            elsewhere.shard_for_write(user_id)
+
+    def while_cleaning_up():
+        assert expense_ids(b, user_id) == {before.id, 'late'}
+        written['after'] = FirebaseExpense.create_expense(user_id, 2.0, 'Food', 'after the switch').id
+
+    settle.extend([while_copying, while_cleaning_up])
+    assert move_user(user_id, 'b', log=lambda message: None) == 2
+    assert not settle
+
+    assert expense_ids(a, user_id) == set()
+    assert expense_ids(b, user_id) == {before.id, 'late', written['after']}
+    assert here.entry(user_id) == {'shard': 'b'}
+    here.forget(user_id)
+
+def test_failed_copy_leaves_the_user_on_the_source(workers, settle, monkeypatch):
+    here, _ = workers
+    a, b = here.shards['a'], here.shards['b']
+    user_id = str(uuid.uuid4())
+    here.set_entry(user_id, {'shard': 'a'})
+    expense = FirebaseExpense.create_expense(user_id, 10.0, 'Food', 'stays')
+    monkeypatch.setattr(b.database.resolve(), 'update', lambda data: False)
+
+    settle.append(lambda: None)
+    with pytest.raises(RuntimeError):
+        move_user(user_id, 'b', log=lambda message: None)
+    assert here.entry(user_id) == {'shard': 'a'}
+    assert expense_ids(a, user_id) == {expense.id}
+    # Writes are accepted again
+    FirebaseExpense.create_expense(user_id, 1.0, 'Food', 'after the failed move')
+    here.forget(user_id)
@@ -0,0 +1,101 @@
+import os
+os.environ.setdefault('FIREBASE_BACKEND', 'mock')
+os.environ.setdefault('PASSWORD_HASH_WORKERS', '0')
+
+import uuid
+import pytest
+import write_behind
+from write_behind import WriteBuffer
+from firebase_config import database
+
+@pytest.fixture
+def db():
+    ref = database.child(f'write_behind_test_{uuid.uuid4().hex}')
+    yield ref
+    ref.delete()
+
+@pytest.fixture
+def worker(tmp_path, db, monkeypatch):
+    """Start a buffer as if it ran in worker process ``pid``, all on one journal directory"""
+    buffers = []
+
+    def worker(pid):
+        buffer = WriteBuffer(enabled=True, directory=str(tmp_path), interval=3600, fsync=False, db=db,
+                             name=f'worker{pid}')
+        with monkeypatch.context() as m:
+            m.setattr(write_behind.os, 'getpid', lambda: pid)
+            buffer._ensure_started()
+        buffers.append(buffer)
+        return buffer
+
+    yield worker
+    for buffer in buffers:
+        buffer.close()
+
+def crash(buffer):
+    """Drop the journal's lock without flushing, like a killed worker"""
+    buffer._journal.close()
+    buffer._journal = None
+    buffer._pending = {}
+
+def value(db, path):
+    return db.child(path).get().val()
+
+@pytest.mark.parametrize('newer_first', [True, False], ids=['newer-flushed-first', 'older-flushed-first'])
+def test_older_write_from_another_worker_never_overwrites_a_newer_one(worker, db, newer_first):
+    a, b = worker(1001), worker(1002)
+    a.put('expenses/e1', {'amount': 1})
+    b.put('expenses/e1', {'amount': 2})
+
+    if newer_first:
+        assert b.flush_all()
+        assert a.flush_all()
+    else:
+        assert a.flush_all()
+        assert value(db, 'expenses/e1') is None  # b's write is still pending and wins
+        assert b.flush_all()
+    assert value(db, 'expenses/e1') == {'amount': 2}
+    assert not a._pending and not b._pending
+
+def test_unrelated_paths_flush_from_both_workers(worker, db):
+    a, b = worker(1001), worker(1002)
+    a.put('expenses/e1', {'amount': 1})
+    b.put('expenses/e2', {'amount': 2})
+    assert b.flush_all() and a.flush_all()
+    assert value(db, 'expenses') == {'e1': {'amount': 1}, 'e2': {'amount': 2}}
+
+def test_restart_replays_its_own_journal(worker, db):
+    a = worker(1001)
+    a.put('expenses/e1', {'amount': 1})
+    a.put('expenses/e2', {'amount': 2})
+    a.put('expenses/e2', None)
+    crash(a)
+
+    again = worker(1001)
+    assert again.pending_under('expenses') == {'e1': {'amount': 1}, 'e2': None}
+    assert again.flush_all()
+    assert value(db, 'expenses') == {'e1': {'amount': 1}}
+
+def test_journal_of_a_dead_worker_is_adopted(worker, db, tmp_path):
+    a = worker(1001)
+    a.put('expenses/e1', {'amount': 1})
+    b = worker(1002)
+    # Live workers read each other's pending writes
+    assert b.read_through('expenses/e1', db.child('expenses/e1').get()).val() == {'amount': 1}
+    crash(a)
+
+    b.adopt_orphans()
+    assert not os.path.exists(tmp_path / 'journal-1001.log')
+    assert b.flush_all()
+    assert value(db, 'expenses/e1') == {'amount': 1}
+
+def test_adopted_write_older_than_a_flushed_one_is_dropped(worker, db):
+    a, b = worker(1001), worker(1002)
+    a.put('expenses/e1', {'amount': 1})
+    b.put('expenses/e1', {'amount': 2})
+    assert b.flush_all()
+    crash(a)
+
+    c = worker(1003)  # adopts a's journal on start
+    assert c.flush_all()
+    assert value(db, 'expenses/e1') == {'amount': 2}
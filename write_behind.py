@@ -0,0 +1,351 @@
+"""
+Write-behind buffering for expense writes (``WRITE_BEHIND=1``).
+
+With write-behind on, an expense create, edit or delete is acknowledged as
+soon as it is appended (and fsynced) to this worker's journal file in
+``WRITE_BEHIND_DIR``, instead of after a round trip to Firebase. A
+background thread sends everything pending every ``WRITE_BEHIND_INTERVAL``
+seconds as one multi-path PATCH of up to ``WRITE_BEHIND_BATCH`` paths.
+Repeated writes to the same record before a flush coalesce into one, and
+the journal is rewritten to what is still pending after every flush.
+
+Reads of the buffered nodes go through ``read_through``, which lays every
+acknowledged but unflushed write on top of the database's answer. Other
+workers' journals on the same host are included, so a user sees their own
+writes whichever gunicorn worker serves the next request. (Several hosts
+would need sticky sessions for the same guarantee.)
+
+Each worker holds an exclusive flock on its journal while it runs. A
+journal nobody holds a lock on belongs to a worker that died before
+flushing; the next worker to notice adopts its entries and flushes them.
+
+Workers on a host take turns to flush (an flock on ``flush.lock``), and a
+path is only sent if no other journal holds a newer write to it and no newer
+write to it has already been flushed (``flushed.json``, the timestamps of
+flushes that older pending writes could still overwrite). Otherwise a worker
+flushing late would put an old copy of a record over a newer one.
+"""
+
+import os
+import glob
+import json
+import time
+import fcntl
+import atexit
+import itertools
+import threading
+import metrics
+from firebase_config import database, FirebaseSnapshot
+
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', '0') == '1'
+WRITE_BEHIND_DIR = os.environ.get('WRITE_BEHIND_DIR', os.path.join('instance', 'write_behind'))
+WRITE_BEHIND_INTERVAL = float(os.environ.get('WRITE_BEHIND_INTERVAL', 0.2))
+WRITE_BEHIND_BATCH = int(os.environ.get('WRITE_BEHIND_BATCH', 500))
+WRITE_BEHIND_FSYNC = os.environ.get('WRITE_BEHIND_FSYNC', '1') == '1'
+MAX_BACKOFF = 5.0
+ADOPT_INTERVAL = 10.0
+JOURNAL_PATTERN = 'journal-*.log'
+FLUSH_LOCK = 'flush.lock'
+FLUSHED_INDEX = 'flushed.json'
+
+def _read_entries(f):
+    """(ts, path, data) for every complete line of a journal"""
+    entries = []
+    for line in f:
+        try:
+            entry = json.loads(line)
+            entries.append((entry['ts'], entry['path'], entry['data']))
+        except (ValueError, KeyError):
+            # A torn final line from a worker that died mid-append was never acknowledged
+            continue
+    return entries
+
+def _journal_line(ts, path, data):
+    return json.dumps({'ts': ts, 'path': path, 'data': data}, separators=(',', ':')) + '\n'
+
+def _apply(value, rel_path, data):
+    """Copy of ``value`` with ``data`` written at ``rel_path`` (None deletes)"""
+    key, _, rest = rel_path.partition('/')
+    result = dict(value) if isinstance(value, dict) else {}
+    child = _apply(result.get(key), rest, data) if rest else data
+    if child is None:
+        result.pop(key, None)
+    else:
+        result[key] = child
+    return result or None
+
+class WriteBuffer:
+    def __init__(self, enabled=WRITE_BEHIND, directory=WRITE_BEHIND_DIR, interval=WRITE_BEHIND_INTERVAL,
+                 batch_size=WRITE_BEHIND_BATCH, fsync=WRITE_BEHIND_FSYNC, db=None, name='default'):
+        self.enabled = enabled
+        self.name = name
+        self.db = database if db is None else db
+        self.directory = directory
+        self.interval = interval
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self._exit_registered = False
+        self._after_fork()
+
+    def _after_fork(self):
+        # The parent keeps its journal and pending writes; start clean
+        journal = getattr(self, '_journal', None)
+        if journal is not None:
+            journal.close()  # our copy of the descriptor; the parent's lock stays
+        self._lock = threading.Lock()
+        self._flushing = threading.Lock()
+        self._wake = threading.Event()
+        self._pending = {}  # path -> (ts, data)
+        self._journal = None
+        self._journal_path = None
+        self._foreign = {}  # journal path -> (size, mtime, entries)
+        self._thread = None
+
+    # Journal files
+
+    def _open_locked(self, path, mode):
+        """Open ``path`` and flock it, retrying if an adopter removed it meanwhile"""
+        while True:
+            f = open(path, mode)
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                    return f
+            except FileNotFoundError:
+                pass
+            f.close()
+
+    def _append(self, lines):
+        self._journal.write(''.join(lines))
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+
+    def _rewrite_journal(self):
+        """Replace the journal with just the pending entries (caller holds _lock)"""
+        tmp = self._journal_path + '.tmp'
+        f = open(tmp, 'w')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(''.join(_journal_line(ts, path, data) for path, (ts, data) in self._pending.items()))
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+        os.replace(tmp, self._journal_path)
+        self._journal.close()
+        self._journal = f
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._journal_path = os.path.join(self.directory, f"journal-{os.getpid()}.log")
+            self._journal = self._open_locked(self._journal_path, 'a+')
+            # A dead process with our pid may have left entries behind
+            self._journal.seek(0)
+            for ts, path, data in _read_entries(self._journal):
+                self._pending[path] = (ts, data)
+            metrics.WRITE_BEHIND_PENDING.set(len(self._pending), buffer=self.name)
+            self._thread = threading.Thread(target=self._run, name=f'write-behind-{self.name}', daemon=True)
+            self._thread.start()
+            if not self._exit_registered:
+                atexit.register(self.close)
+                self._exit_registered = True
+        self.adopt_orphans()
+
+    def adopt_orphans(self):
+        """Take over journals left by workers that exited without flushing"""
+        for path in glob.glob(os.path.join(self.directory, JOURNAL_PATTERN)):
+            if path == self._journal_path:
+                continue
+            try:
+                f = open(path, 'r')
+            except FileNotFoundError:
+                continue
+            with f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # its worker is alive
+                try:
+                    if os.fstat(f.fileno()).st_ino != os.stat(path).st_ino:
+                        continue  # replaced by a compaction since we opened it
+                except FileNotFoundError:
+                    continue
+                entries = _read_entries(f)
+                if entries:
+                    with self._lock:
+                        adopted = [(ts, p, data) for ts, p, data in entries
+                                   if p not in self._pending or self._pending[p][0] <= ts]
+                        for ts, p, data in adopted:
+                            self._pending[p] = (ts, data)
+                        self._append([_journal_line(ts, p, data) for ts, p, data in adopted])
+                        metrics.WRITE_BEHIND_PENDING.set(len(self._pending), buffer=self.name)
+                    print(f"♻️ Adopted {len(entries)} unflushed writes from {os.path.basename(path)}")
+                os.remove(path)
+        if self._pending:
+            self._wake.set()
+
+    # Writes
+
+    def put(self, path, data):
+        """Acknowledge a write of ``data`` at ``path`` (None deletes) once it is journaled"""
+        self._ensure_started()
+        ts = time.time()
+        line = _journal_line(ts, path, data)
+        with self._lock:
+            self._append([line])
+            coalesced = path in self._pending
+            self._pending[path] = (ts, data)
+            pending = len(self._pending)
+        metrics.WRITE_BEHIND_WRITES.inc(op='delete' if data is None else 'set', coalesced=str(coalesced).lower())
+        metrics.WRITE_BEHIND_PENDING.set(pending, buffer=self.name)
+        if pending >= self.batch_size:
+            self._wake.set()
+
+    def flush(self):
+        """Send one batch as a multi-path update; False if the database refused it"""
+        with self._flushing:
+            if not self._pending:
+                return True
+            with open(os.path.join(self.directory, FLUSH_LOCK), 'a') as host_lock:
+                fcntl.flock(host_lock, fcntl.LOCK_EX)
+                return self._flush_batch()
+
+    def _flush_batch(self):
+        """Flush one batch (caller holds the host's flush lock)"""
+        with self._lock:
+            batch = dict(itertools.islice(self._pending.items(), self.batch_size))
+        if not batch:
+            return True
+        foreign = self._foreign_entries()
+        flushed = self._read_flushed()
+        newer = dict(flushed)
+        for ts, path, data in foreign:
+            newer[path] = max(ts, newer.get(path, ts))
+        # Superseded by another worker's write; sending ours would undo it
+        send = {path: entry for path, entry in batch.items() if newer.get(path, 0) <= entry[0]}
+        metrics.WRITE_BEHIND_BATCH_PATHS.observe(len(send))
+        ok = True
+        if send:
+            try:
+                ok = self.db.update({path: data for path, (ts, data) in send.items()})
+            except Exception as e:
+                print(f"⚠️ Write-behind flush failed: {e}")
+                ok = False
+            metrics.WRITE_BEHIND_FLUSHES.inc(outcome='ok' if ok else 'error')
+        if not ok:
+            return False
+        with self._lock:
+            for path, entry in batch.items():
+                # Keep anything rewritten while the batch was in flight
+                if self._pending.get(path) is entry:
+                    del self._pending[path]
+            self._rewrite_journal()
+            metrics.WRITE_BEHIND_PENDING.set(len(self._pending), buffer=self.name)
+            oldest = min([ts for ts, data in self._pending.values()] + [ts for ts, path, data in foreign],
+                         default=None)
+        for path, (ts, data) in send.items():
+            flushed[path] = max(ts, flushed.get(path, ts))
+        # Only a pending write older than a flush could overwrite it; every later write is newer
+        self._write_flushed({path: ts for path, ts in flushed.items() if oldest is not None and ts >= oldest})
+        return True
+
+    def _read_flushed(self):
+        try:
+            with open(os.path.join(self.directory, FLUSHED_INDEX)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_flushed(self, flushed):
+        path = os.path.join(self.directory, FLUSHED_INDEX)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(flushed, f, separators=(',', ':'))
+        os.replace(path + '.tmp', path)
+
+    def flush_all(self):
+        """Flush until nothing is pending; False if a batch failed"""
+        while self._pending:
+            if not self.flush():
+                return False
+        return True
+
+    def _run(self):
+        delay = self.interval
+        last_adopt = time.monotonic()
+        while True:
+            self._wake.wait(delay)
+            self._wake.clear()
+            ok = self.flush_all()
+            delay = self.interval if ok else min(MAX_BACKOFF, delay * 2)
+            if time.monotonic() - last_adopt >= ADOPT_INTERVAL:
+                last_adopt = time.monotonic()
+                self.adopt_orphans()
+
+    def close(self):
+        """Flush on shutdown; a journal that could not be flushed is left for adoption"""
+        if self._journal is None:
+            return
+        self.flush_all()
+        with self._lock:
+            if not self._pending:
+                os.remove(self._journal_path)
+            self._journal.close()
+            self._journal = None
+
+    # Reads
+
+    def _foreign_entries(self):
+        """Entries in other workers' journals, re-read only when a file changes"""
+        entries = []
+        seen = set()
+        for path in glob.glob(os.path.join(self.directory, JOURNAL_PATTERN)):
+            if path == self._journal_path:
+                continue
+            try:
+                stat = os.stat(path)
+                cached = self._foreign.get(path)
+                if cached is None or cached[:2] != (stat.st_size, stat.st_mtime_ns):
+                    with open(path) as f:
+                        cached = (stat.st_size, stat.st_mtime_ns, _read_entries(f))
+                    self._foreign[path] = cached
+            except FileNotFoundError:
+                continue
+            seen.add(path)
+            entries.extend(cached[2])
+        for path in set(self._foreign) - seen:
+            del self._foreign[path]
+        return entries
+
+    def pending_under(self, path):
+        """{relative path: data} for acknowledged, unflushed writes at or below ``path``"""
+        prefix = path.strip('/') + '/'
+        with self._lock:
+            latest = {p: entry for p, entry in self._pending.items() if p.startswith(prefix)}
+        for ts, p, data in self._foreign_entries():
+            if p.startswith(prefix) and (p not in latest or latest[p][0] < ts):
+                latest[p] = (ts, data)
+        return {p[len(prefix):]: data for p, (ts, data) in sorted(latest.items(), key=lambda item: item[1][0])}
+
+    def read_through(self, path, snapshot):
+        """``snapshot`` of ``path`` with pending writes applied (read-your-writes)"""
+        if not self.enabled:
+            return snapshot
+        parent, _, leaf = path.strip('/').rpartition('/')
+        changes = self.pending_under(parent) if parent else {}
+        if leaf and leaf in changes:
+            return FirebaseSnapshot(changes[leaf])
+        changes = self.pending_under(path)
+        if not changes:
+            return snapshot
+        value = snapshot.val()
+        for rel_path, data in changes.items():
+            value = _apply(value, rel_path, data)
+        return FirebaseSnapshot(value)
+
+# Shared buffer; journal and flusher thread start on the first buffered write
+write_buffer = WriteBuffer()
+os.register_at_fork(after_in_child=write_buffer._after_fork)
@@ -0,0 +1,19 @@
+"""
+Production WSGI entry point.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+With ``preload_app`` the master imports this module once, warms the caches
+below and forks workers that inherit them copy-on-write. Per-process
+resources (HTTP connection pools, the password hashing pool) are rebuilt in
+each worker after fork.
+"""
+
+from app import app
+
+def warm_templates():
+    """Compile every Jinja template so workers start with them cached"""
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+warm_templates()